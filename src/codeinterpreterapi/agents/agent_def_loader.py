@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import yaml
+from gui_agent_loop_core.schema.agent.schema import AgentDefinition
+from pydantic import ValidationError
+
+from codeinterpreterapi.config import settings
+
+CONFIG_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "config"))
+AGENTS_CONFIG_FILE = "agents_config.yaml"
+
+
+class AgentDefinitionLoader:
+    """
+    agents/config以下のagent定義(yaml)を読み込んでプロセス内でキャッシュする
+
+    - 各yamlのmtimeが変わった時だけ読み直す
+    - settings.AGENT_DEF_SNAPSHOT_PATHを指定すると、パース済みの定義をjsonに保存して次のプロセスでも再利用する
+    - load()は呼び出し側でagent_executorを設定できるように毎回コピーを返す
+    """
+
+    _lock = threading.Lock()
+    # config_dir => {"mtimes": {path: mtime}, "agent_defs": [AgentDefinition]}
+    _cache: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def load(cls, config_dir: str = CONFIG_DIR) -> List[AgentDefinition]:
+        with cls._lock:
+            entry = cls._cache.get(config_dir)
+            if entry is None or not cls._is_fresh(entry["mtimes"]):
+                entry = cls._load_entry(config_dir)
+                cls._cache[config_dir] = entry
+            agent_defs = entry["agent_defs"]
+        return [agent_def.model_copy() for agent_def in agent_defs]
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._cache.clear()
+
+    @staticmethod
+    def _get_mtimes(paths: List[str]) -> Dict[str, float]:
+        return {path: os.path.getmtime(path) for path in paths}
+
+    @staticmethod
+    def _is_fresh(mtimes: Dict[str, float]) -> bool:
+        try:
+            return all(os.path.getmtime(path) == mtime for path, mtime in mtimes.items())
+        except OSError:
+            return False
+
+    @classmethod
+    def _load_entry(cls, config_dir: str) -> Dict[str, Any]:
+        raw_configs = cls._load_snapshot(config_dir)
+        if raw_configs is None:
+            raw_configs = cls._load_yaml(config_dir)
+            cls._save_snapshot(config_dir, raw_configs)
+
+        agent_defs = []
+        for agent_name, config in raw_configs["agents"]:
+            try:
+                print(f"AgentDefinitionLoader Agent: {agent_name}")
+                agent_def = AgentDefinition(**config["agent_definition"])
+                agent_def.build_prompt()
+                agent_defs.append(agent_def)
+            except ValidationError as e:
+                print(f"設定ファイルの検証に失敗しました（Agent: {agent_name}）: {e}")
+
+        return {"mtimes": raw_configs["mtimes"], "agent_defs": agent_defs}
+
+    @classmethod
+    def _load_yaml(cls, config_dir: str) -> Dict[str, Any]:
+        agents_config_path = os.path.join(config_dir, AGENTS_CONFIG_FILE)
+        with open(agents_config_path, "r", encoding="utf8") as f:
+            agents_config = yaml.safe_load(f)
+
+        paths = [agents_config_path]
+        agents = []
+        for agent in agents_config["agents"]:
+            config_path = os.path.join(config_dir, agent["config_path"])
+            with open(config_path, "r", encoding="utf8") as f:
+                config = yaml.safe_load(f)
+            paths.append(config_path)
+            agents.append((agent["name"], config))
+
+        return {"mtimes": cls._get_mtimes(paths), "agents": agents}
+
+    @classmethod
+    def _load_snapshot(cls, config_dir: str) -> Optional[Dict[str, Any]]:
+        snapshot_path = settings.AGENT_DEF_SNAPSHOT_PATH
+        if not snapshot_path or not os.path.isfile(snapshot_path):
+            return None
+        try:
+            with open(snapshot_path, "r", encoding="utf8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            print("AgentDefinitionLoader snapshot load error=", e)
+            return None
+        if snapshot.get("config_dir") != config_dir or not cls._is_fresh(snapshot["mtimes"]):
+            return None
+        return {"mtimes": snapshot["mtimes"], "agents": [tuple(agent) for agent in snapshot["agents"]]}
+
+    @staticmethod
+    def _save_snapshot(config_dir: str, raw_configs: Dict[str, Any]) -> None:
+        snapshot_path = settings.AGENT_DEF_SNAPSHOT_PATH
+        if not snapshot_path:
+            return
+        snapshot = {"config_dir": config_dir, **raw_configs}
+        try:
+            tmp_path = snapshot_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                json.dump(snapshot, f, ensure_ascii=False)
+            os.replace(tmp_path, snapshot_path)
+        except OSError as e:
+            print("AgentDefinitionLoader snapshot save error=", e)
+
+
+def test():
+    agent_defs = AgentDefinitionLoader.load()
+    print("agent_defs=", [agent_def.agent_name for agent_def in agent_defs])
+    assert len(agent_defs) > 0
+    agent_defs_cached = AgentDefinitionLoader.load()
+    assert agent_defs_cached[0] is not agent_defs[0]
+    assert agent_defs_cached[0].agent_name == agent_defs[0].agent_name
+
+
+if __name__ == "__main__":
+    test()
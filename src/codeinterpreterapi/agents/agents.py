@@ -1,7 +1,5 @@
-import os
 from typing import List
 
-import yaml
 from gui_agent_loop_core.schema.agent.schema import AgentDefinition, AgentType
 from langchain.agents import AgentExecutor, BaseSingleActionAgent, ConversationalAgent, ConversationalChatAgent
 from langchain.agents.openai_functions_agent.base import OpenAIFunctionsAgent
@@ -9,8 +7,8 @@ from langchain_anthropic import ChatAnthropic
 from langchain_core.prompts.chat import MessagesPlaceholder
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_openai import AzureChatOpenAI, ChatOpenAI
-from pydantic import ValidationError
 
+from codeinterpreterapi.agents.agent_def_loader import AgentDefinitionLoader
 from codeinterpreterapi.agents.structured_chat.agent_executor import load_structured_chat_agent_executor
 from codeinterpreterapi.agents.tool_calling.agent_executor import load_tool_calling_agent_executor
 from codeinterpreterapi.brain.params import CodeInterpreterParams
@@ -23,31 +21,14 @@ from codeinterpreterapi.tools.tools import CodeInterpreterTools
 class CodeInterpreterAgent:
     @staticmethod
     def choose_agent_executors(ci_params: CodeInterpreterParams) -> List[AgentExecutor]:
-        CONFIG_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "config"))
-        with open(os.path.join(CONFIG_DIR, "agents_config.yaml"), "r", encoding="utf8") as f:
-            agents_config = yaml.safe_load(f)
-
+        # agent定義はAgentDefinitionLoaderがキャッシュしたもののコピーを使う
         agent_executors = []
-        for agent in agents_config["agents"]:
-            agent_name = agent["name"]
-            config_path = agent["config_path"]
-
-            with open(os.path.join(CONFIG_DIR, config_path), "r", encoding="utf8") as f:
-                config = yaml.safe_load(f)
-
-            try:
-                print(f"choose_agent_executors Agent: {agent_name}")
-                # print(f"config: {config}")
-                agent_def = AgentDefinition(**config["agent_definition"])
-                agent_def.build_prompt()
-                print("agent_def=", agent_def)
-                print("---")
-                agent_executor = CodeInterpreterAgent.choose_agent_executor(ci_params, agent_def)
-                agent_executors.append(agent_executor)
-                agent_def.agent_executor = agent_executor
-                ci_params.agent_def_list.append(agent_def)
-            except ValidationError as e:
-                print(f"設定ファイルの検証に失敗しました（Agent: {agent_name}）: {e}")
+        for agent_def in AgentDefinitionLoader.load():
+            print(f"choose_agent_executors Agent: {agent_def.agent_name}")
+            agent_executor = CodeInterpreterAgent.choose_agent_executor(ci_params, agent_def)
+            agent_executors.append(agent_executor)
+            agent_def.agent_executor = agent_executor
+            ci_params.agent_def_list.append(agent_def)
 
         return agent_executors
 
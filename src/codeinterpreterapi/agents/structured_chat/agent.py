@@ -172,7 +172,7 @@ def create_structured_chat_agent(
         | prompt
         | llm_with_stop
     )
-    agent = assign_runnable_history(agent, runnable_config)
+    agent = assign_runnable_history(agent, runnable_config, llm)
     agent = agent | output_parser
     return agent
 
@@ -117,7 +117,7 @@ def create_tool_calling_agent(
         | prompt
         | llm_with_tools
     )
-    agent = assign_runnable_history(agent, runnable_config)
+    agent = assign_runnable_history(agent, runnable_config, llm)
     agent = agent | output_parser
     return agent
 
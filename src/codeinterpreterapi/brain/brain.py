@@ -1,19 +1,23 @@
 from langchain_core.prompts import PromptTemplate
+import asyncio
 import random
+import threading
 import traceback
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
 from gui_agent_loop_core.schema.core.schema import AgentName
 from gui_agent_loop_core.schema.message.schema import BaseMessageContent
 from langchain.agents import AgentExecutor
+from langchain_core.messages import BaseMessage
 from langchain_core.runnables import Runnable, RunnableConfig
 from langchain_core.runnables.utils import Input, Output
 
 from codeinterpreterapi.agents.agents import CodeInterpreterAgent
 from codeinterpreterapi.brain.params import CodeInterpreterParams
+from codeinterpreterapi.brain.router import FastPathRouter, RouteType
 from codeinterpreterapi.config import settings
 from codeinterpreterapi.crew.crew_agent import CodeInterpreterCrew
-from codeinterpreterapi.llm.llm import prepare_test_llm
+from codeinterpreterapi.llm.llm import CodeInterpreterLlm, prepare_test_llm
 from codeinterpreterapi.planners.planners import CodeInterpreterPlanner
 from codeinterpreterapi.schema import CodeInterpreterIntermediateResult, CodeInterpreterPlanList
 from codeinterpreterapi.supervisors.supervisors import CodeInterpreterSupervisor
@@ -23,6 +27,15 @@ from codeinterpreterapi.tools.tools import CodeInterpreterTools
 from codeinterpreterapi.utils.multi_converter import MultiConverter
 
 
+class BrainRunContext(NamedTuple):
+    """1回のrun/arunで使うagentの状態(runの開始時に確定させる)"""
+
+    input: BaseMessageContent
+    agent: AgentName
+    agent_executor: Optional[AgentExecutor]
+    plan_list: Optional[CodeInterpreterPlanList]
+
+
 class CodeInterpreterBrain(Runnable):
     AGENT_SCORE_MAX = 100
     AGENT_SCORE_MIN = -100
@@ -38,13 +51,17 @@ class CodeInterpreterBrain(Runnable):
         self.current_agent: AgentName = AgentName.SUPERVISOR
         self.current_agent_score: int = 0
 
-        # agents
-        self.agent_executors: Optional[List[Runnable]] = []
-        self.agent_executor: Optional[AgentExecutor] = None
-        self.llm_planner: Optional[Runnable] = None
-        self.supervisor: Optional[CodeInterpreterSupervisor] = None
-        self.thought: Optional[Runnable] = None
-        self.crew_agent: Optional[CodeInterpreterCrew] = None
+        # agents(初回アクセス時に生成してキャッシュする)
+        self._agent_executors: Optional[List[Runnable]] = None
+        self._agent_executor: Optional[AgentExecutor] = None
+        self._llm_planner: Optional[Runnable] = None
+        self._supervisor: Optional[CodeInterpreterSupervisor] = None
+        self._thought: Optional[Runnable] = None
+        self._crew_agent: Optional[CodeInterpreterCrew] = None
+        self._initialize_lock = threading.RLock()
+        # current_agent, plan_list, *_resultなどの状態を更新するためのlock(abatchで同時に実行されるため)
+        self._state_lock = threading.RLock()
+        self.router = FastPathRouter(self.ci_params)
 
         # agent_results
         self.agent_executor_result: Optional[str] = ""
@@ -53,32 +70,97 @@ class CodeInterpreterBrain(Runnable):
         self.thought_result: Optional[str] = ""
         self.crew_result: Optional[str] = ""
 
-        # initialize agents
-        self.initialize()
-
     def initialize(self):
-        self.initialize_agent_executor()
-        self.initialize_crew()
-        self.initialize_llm_planner()
-        self.initialize_supervisor()
-        self.initialize_thought()
+        """
+        全てのagentを生成する(事前ウォームアップ用)。生成済みのものは作り直さない。
+        通常は呼ばなくても各agentは初回アクセス時に生成される。
+        """
+        with self._initialize_lock:
+            _ = self.agent_executors
+            _ = self.crew_agent
+            _ = self.llm_planner
+            _ = self.supervisor
+            _ = self.thought
 
     def initialize_agent_executor(self):
-        self.agent_executors = CodeInterpreterAgent.choose_agent_executors(ci_params=self.ci_params)
-        self.agent_executor = self.agent_executors[0]
+        with self._initialize_lock:
+            if self._agent_executors is not None:
+                return
+            agent_executors = CodeInterpreterAgent.choose_agent_executors(ci_params=self.ci_params)
+            if self._agent_executor is None:
+                self._agent_executor = agent_executors[0]
+            self._agent_executors = agent_executors
 
     def initialize_llm_planner(self):
-        self.llm_planner = CodeInterpreterPlanner.choose_planner(ci_params=self.ci_params)
+        with self._initialize_lock:
+            if self._llm_planner is not None:
+                return
+            # plannerのpromptはagent_def_listを参照する
+            self.initialize_crew()
+            self._llm_planner = CodeInterpreterPlanner.choose_planner(ci_params=self.ci_params)
 
     def initialize_supervisor(self):
-        self.supervisor = CodeInterpreterSupervisor(planner=self.llm_planner, ci_params=self.ci_params)
+        with self._initialize_lock:
+            if self._supervisor is not None:
+                return
+            # supervisorはci_params.planner_agentとci_params.crew_agentを使う
+            self.initialize_llm_planner()
+            self._supervisor = CodeInterpreterSupervisor(planner=self._llm_planner, ci_params=self.ci_params)
 
     def initialize_thought(self):
-        self.thought = CodeInterpreterToT.get_runnable_tot_chain(ci_params=self.ci_params)
+        with self._initialize_lock:
+            if self._thought is not None:
+                return
+            self._thought = CodeInterpreterToT.get_runnable_tot_chain(ci_params=self.ci_params)
 
     def initialize_crew(self):
-        self.crew_agent = CodeInterpreterCrew(ci_params=self.ci_params)
-        self.ci_params.crew_agent = self.crew_agent
+        with self._initialize_lock:
+            if self._crew_agent is not None:
+                return
+            # crewはagent_executorsが登録したci_params.agent_def_listから作る
+            self.initialize_agent_executor()
+            self._crew_agent = CodeInterpreterCrew(ci_params=self.ci_params)
+            self.ci_params.crew_agent = self._crew_agent
+
+    @property
+    def agent_executors(self) -> List[Runnable]:
+        if self._agent_executors is None:
+            self.initialize_agent_executor()
+        return self._agent_executors
+
+    @property
+    def agent_executor(self) -> AgentExecutor:
+        if self._agent_executor is None:
+            self.initialize_agent_executor()
+        return self._agent_executor
+
+    @agent_executor.setter
+    def agent_executor(self, agent_executor: AgentExecutor) -> None:
+        self._agent_executor = agent_executor
+
+    @property
+    def llm_planner(self) -> Runnable:
+        if self._llm_planner is None:
+            self.initialize_llm_planner()
+        return self._llm_planner
+
+    @property
+    def supervisor(self) -> CodeInterpreterSupervisor:
+        if self._supervisor is None:
+            self.initialize_supervisor()
+        return self._supervisor
+
+    @property
+    def thought(self) -> Runnable:
+        if self._thought is None:
+            self.initialize_thought()
+        return self._thought
+
+    @property
+    def crew_agent(self) -> CodeInterpreterCrew:
+        if self._crew_agent is None:
+            self.initialize_crew()
+        return self._crew_agent
 
     def prepare_input(self, input_dict: Dict):
         ca = self.current_agent
@@ -105,65 +187,157 @@ class CodeInterpreterBrain(Runnable):
 
         return input_dict
 
+    def _prepare_run_input(self, input: BaseMessageContent) -> BrainRunContext:
+        """
+        次のagentを選んで、このrunで使う状態をまとめて返す
+        同時に実行される他のrunがcurrent_agentなどを変えても、このrunの途中では影響を受けない
+        """
+        with self._state_lock:
+            self.update_next_agent()
+            last_input = input
+            if isinstance(input, list):
+                last_input = input[-1]
+                if isinstance(last_input, Dict):
+                    input[-1] = self.prepare_input(last_input)
+            else:
+                if isinstance(last_input, Dict):
+                    input = self.prepare_input(last_input)
+            print("Brain run self.current_agent=", self.current_agent)
+            return BrainRunContext(
+                input=input, agent=self.current_agent, agent_executor=self._agent_executor, plan_list=self.plan_list
+            )
+
+    def _set_result(self, name: str, result: Any) -> Any:
+        with self._state_lock:
+            setattr(self, name, result)
+        return result
+
+    def _create_error_output(self, e: Exception) -> CodeInterpreterIntermediateResult:
+        if self.verbose:
+            traceback.print_exc()
+        context = f"Error in CodeInterpreterSession: {e.__class__.__name__}  - {e}"
+        return CodeInterpreterIntermediateResult(context=context)
+
+    def _finalize_output(self, output: Any) -> CodeInterpreterIntermediateResult:
+        with self._state_lock:
+            self.update_agent_score()
+        if isinstance(output, str):
+            output = CodeInterpreterIntermediateResult(context=output)
+        elif not isinstance(output, CodeInterpreterIntermediateResult):
+            output = CodeInterpreterIntermediateResult(context=str(output))
+        return output
+
     def run(
         self, input: BaseMessageContent, runnable_config: Optional[RunnableConfig] = None
     ) -> CodeInterpreterIntermediateResult:
-        self.update_next_agent()
-        last_input = input
-        if isinstance(input, list):
-            last_input = input[-1]
-            if isinstance(last_input, Dict):
-                input[-1] = self.prepare_input(last_input)
-        else:
-            if isinstance(last_input, Dict):
-                input = self.prepare_input(last_input)
-        print("Brain run self.current_agent=", self.current_agent)
+        context = self._prepare_run_input(input)
+        input = context.input
+        agent_executor = context.agent_executor or self.agent_executor
         try:
-            ca = self.current_agent
+            ca = context.agent
             if ca == AgentName.AGENT_EXECUTOR:
                 # TODO: set output
-                self.agent_executor_result = self.agent_executor.invoke(input, config=runnable_config)
-                result = self.agent_executor_result
+                result = self._set_result("agent_executor_result", agent_executor.invoke(input, config=runnable_config))
             elif ca == AgentName.LLM_PLANNER:
                 # TODO: set output
-                self.plan_list = self.llm_planner.invoke(input)
-                result = self.plan_list
+                result = self._set_result("plan_list", self.llm_planner.invoke(input))
             elif ca == AgentName.SUPERVISOR:
-                self.supervisor_result = self.supervisor.invoke(input)
-                result = self.supervisor_result
+                route = self.router.route(input) if settings.ROUTER_ENABLED else RouteType.SUPERVISOR
+                if route == RouteType.DIRECT:
+                    result = self._run_direct(input)
+                elif route == RouteType.AGENT:
+                    result = self._set_result(
+                        "agent_executor_result", agent_executor.invoke(input, config=runnable_config)
+                    )
+                else:
+                    result = self._set_result("supervisor_result", self.supervisor.invoke(input))
             elif ca == AgentName.THOUGHT:
                 # TODO: fix it and set output
-                self.thought_result = self.thought.invoke(input, config=runnable_config)
-                result = self.thought_result
+                result = self._set_result("thought_result", self.thought.invoke(input, config=runnable_config))
             else:
                 # ca == AgentName.CREW
-                self.crew_result = self.crew_agent.run(input, self.plan_list)
-                result = self.crew_result
+                result = self._set_result("crew_result", self.crew_agent.run(input, context.plan_list))
             output = self._set_output_llm_result(result)
         except Exception as e:
-            if self.verbose:
-                traceback.print_exc()
-            context = "Error in CodeInterpreterSession: " f"{e.__class__.__name__}  - {e}"
-            output = CodeInterpreterIntermediateResult(context=context)
+            output = self._create_error_output(e)
 
-        self.update_agent_score()
-        if isinstance(output, str):
-            output = CodeInterpreterIntermediateResult(context=output)
-        elif not isinstance(output, CodeInterpreterIntermediateResult):
-            output = CodeInterpreterIntermediateResult(context=str(output))
-        return output
+        return self._finalize_output(output)
+
+    async def arun(
+        self, input: BaseMessageContent, runnable_config: Optional[RunnableConfig] = None
+    ) -> CodeInterpreterIntermediateResult:
+        context = self._prepare_run_input(input)
+        input = context.input
+        agent_executor = context.agent_executor or self.agent_executor
+        try:
+            ca = context.agent
+            if ca == AgentName.AGENT_EXECUTOR:
+                # TODO: set output
+                result = self._set_result(
+                    "agent_executor_result", await agent_executor.ainvoke(input, config=runnable_config)
+                )
+            elif ca == AgentName.LLM_PLANNER:
+                # TODO: set output
+                result = self._set_result("plan_list", await self.llm_planner.ainvoke(input))
+            elif ca == AgentName.SUPERVISOR:
+                route = await self.router.aroute(input) if settings.ROUTER_ENABLED else RouteType.SUPERVISOR
+                if route == RouteType.DIRECT:
+                    result = await self._arun_direct(input)
+                elif route == RouteType.AGENT:
+                    result = self._set_result(
+                        "agent_executor_result", await agent_executor.ainvoke(input, config=runnable_config)
+                    )
+                else:
+                    result = self._set_result("supervisor_result", await self.supervisor.ainvoke(input))
+            elif ca == AgentName.THOUGHT:
+                # TODO: fix it and set output
+                result = self._set_result("thought_result", await self.thought.ainvoke(input, config=runnable_config))
+            else:
+                # ca == AgentName.CREW
+                result = self._set_result("crew_result", await self.crew_agent.arun(input, context.plan_list))
+            output = await self._aset_output_llm_result(result)
+        except Exception as e:
+            output = self._create_error_output(e)
+
+        return self._finalize_output(output)
+
+    def _run_direct(self, input: BaseMessageContent) -> CodeInterpreterIntermediateResult:
+        """agentを使わずにllmで直接回答する(会話履歴は使う)"""
+        direct_input = {"input": FastPathRouter.get_text(input)}
+        output = self.router.direct_runnable.invoke(direct_input, config=self.ci_params.runnable_config)
+        return self._to_direct_result(output)
+
+    async def _arun_direct(self, input: BaseMessageContent) -> CodeInterpreterIntermediateResult:
+        direct_input = {"input": FastPathRouter.get_text(input)}
+        output = await self.router.direct_runnable.ainvoke(direct_input, config=self.ci_params.runnable_config)
+        return self._to_direct_result(output)
+
+    @staticmethod
+    def _to_direct_result(output: Any) -> CodeInterpreterIntermediateResult:
+        if isinstance(output, BaseMessage) and isinstance(output.content, str):
+            return CodeInterpreterIntermediateResult(context=output.content)
+        return CodeInterpreterIntermediateResult(context=MultiConverter.to_str(output))
+
+    def _pre_set_output_llm_result(
+        self, result: Union[Dict[str, Any], CodeInterpreterIntermediateResult, CodeInterpreterPlanList]
+    ) -> Tuple[Union[CodeInterpreterIntermediateResult, str], bool]:
+        """llmによる変換が必要かどうかを(output, is_done)で返す。is_done=Falseならoutputはllmに渡すstr"""
+        if isinstance(result, CodeInterpreterPlanList):
+            plan_list: CodeInterpreterPlanList = result
+            return CodeInterpreterIntermediateResult(context=str(plan_list)), True
+
+        # まずはllmを使わずに変換し、確からしさが低い時だけllmで変換する
+        output, confidence = MultiConverter.to_CodeInterpreterIntermediateResult_with_confidence(result)
+        if confidence >= settings.CONVERTER_LLM_FALLBACK_THRESHOLD:
+            return output, True
+        print(f"brain _pre_set_output_llm_result low confidence={confidence}, fallback to llm")
+        return MultiConverter.to_str(result), False
 
     def _set_output_llm_result(
         self, result: Union[Dict[str, Any], CodeInterpreterIntermediateResult, CodeInterpreterPlanList]
     ) -> CodeInterpreterIntermediateResult:
-        output = CodeInterpreterIntermediateResult(context="")
-        if isinstance(result, Dict):
-            output = MultiConverter.to_CodeInterpreterIntermediateResult(result)
-        elif isinstance(result, CodeInterpreterIntermediateResult):
-            return result
-        elif isinstance(result, CodeInterpreterPlanList):
-            plan_list: CodeInterpreterPlanList = result
-            output.context = str(plan_list)
+        output, is_done = self._pre_set_output_llm_result(result)
+        if is_done:
             return output
 
         # convert by llm
@@ -171,6 +345,18 @@ class CodeInterpreterBrain(Runnable):
         output = self.llm_convert_to_CodeInterpreterIntermediateResult(output)
         return output
 
+    async def _aset_output_llm_result(
+        self, result: Union[Dict[str, Any], CodeInterpreterIntermediateResult, CodeInterpreterPlanList]
+    ) -> CodeInterpreterIntermediateResult:
+        output, is_done = self._pre_set_output_llm_result(result)
+        if is_done:
+            return output
+
+        # convert by llm
+        print(f"brain _aset_output_llm_result type(output)={type(output)}")
+        output = await self.allm_convert_to_CodeInterpreterIntermediateResult(output)
+        return output
+
     def __call__(self, input: Input) -> Output:
         return self.run(input)
 
@@ -181,7 +367,7 @@ class CodeInterpreterBrain(Runnable):
         return [self.run(input_item) for input_item in inputs]
 
     async def ainvoke(self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Output:
-        return self.run(input, config)
+        return await self.arun(input, config)
 
     async def abatch(
         self,
@@ -191,7 +377,22 @@ class CodeInterpreterBrain(Runnable):
         return_exceptions: bool = False,
         **kwargs: Optional[Any],
     ) -> List[Output]:
-        return [self.run(input_item) for input_item in inputs]
+        if not inputs:
+            return []
+        configs = config if isinstance(config, list) else [config] * len(inputs)
+        max_concurrency = settings.BRAIN_MAX_CONCURRENCY
+        if configs[0] and configs[0].get("max_concurrency"):
+            max_concurrency = configs[0]["max_concurrency"]
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def arun_with_semaphore(input_item: Input, config_item: Optional[RunnableConfig]) -> Output:
+            async with semaphore:
+                return await self.arun(input_item, config_item)
+
+        return await asyncio.gather(
+            *(arun_with_semaphore(input_item, config_item) for input_item, config_item in zip(inputs, configs)),
+            return_exceptions=return_exceptions,
+        )
 
     def update_agent_score(self):
         self.current_agent_score = CodeInterpreterBrain.AGENT_SCORE_MIN - 1  # temp: switch every time
@@ -223,12 +424,10 @@ class CodeInterpreterBrain(Runnable):
 
     def use_agent(self, new_agent: AgentName):
         print("CodeInterpreterBrain use_agent=", new_agent)
-        self.current_agent = new_agent
+        with self._state_lock:
+            self.current_agent = new_agent
 
-    def llm_convert_to_CodeInterpreterIntermediateResult(
-        self,
-        output_str: str,
-    ) -> CodeInterpreterIntermediateResult:
+    def _create_llm_convert_runnable(self) -> Runnable:
         prompt_template = """
         出力されたoutput_dictの内容をCodeInterpreterIntermediateResultクラスに詰め替えてください。
         inputで示された作業目的を考慮して重要な情報から可能な限り詰めてください。
@@ -243,16 +442,31 @@ class CodeInterpreterBrain(Runnable):
             input_variables=["final_goal", "agent_scratchpad", "crew_output"], template=prompt_template
         )
 
-        structured_llm = self.ci_params.llm.with_structured_output(
-            schema=CodeInterpreterIntermediateResult, include_raw=False
-        )
+        llm = CodeInterpreterLlm.with_cache(self.ci_params.llm, "converter")
+        structured_llm = llm.with_structured_output(schema=CodeInterpreterIntermediateResult, include_raw=False)
         runnable = prompt | structured_llm
+        return runnable
 
+    def llm_convert_to_CodeInterpreterIntermediateResult(
+        self,
+        output_str: str,
+    ) -> CodeInterpreterIntermediateResult:
+        runnable = self._create_llm_convert_runnable()
         last_input = {}
         last_input["output_str"] = output_str
         output = runnable.invoke(input=last_input)
         return output
 
+    async def allm_convert_to_CodeInterpreterIntermediateResult(
+        self,
+        output_str: str,
+    ) -> CodeInterpreterIntermediateResult:
+        runnable = self._create_llm_convert_runnable()
+        last_input = {}
+        last_input["output_str"] = output_str
+        output = await runnable.ainvoke(input=last_input)
+        return output
+
 
 def test():
     settings.WORK_DIR = "/tmp"
@@ -0,0 +1,212 @@
+import re
+from enum import Enum
+from typing import Any, List, Optional, Tuple
+
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate
+from langchain_core.runnables import Runnable
+
+from codeinterpreterapi.brain.params import CodeInterpreterParams
+from codeinterpreterapi.config import settings
+from codeinterpreterapi.llm.llm import CodeInterpreterLlm
+from codeinterpreterapi.utils.runnable_history import assign_runnable_history
+
+
+class RouteType(str, Enum):
+    DIRECT = "direct"  # llmで直接回答する
+    AGENT = "agent"  # 単一のagent_executorで実行する
+    SUPERVISOR = "supervisor"  # planner + crewで実行する
+
+
+# 複数の工程が必要そうな依頼
+COMPLEX_KEYWORDS = [
+    "設計",
+    "計画",
+    "プロジェクト",
+    "アプリ",
+    "システム",
+    "テストケース",
+    "レビュー",
+    "リファクタ",
+    "複数",
+    "段階",
+    "design",
+    "architecture",
+    "project",
+    "application",
+    "refactor",
+    "review",
+    "step by step",
+]
+# ツール(コード実行、ファイル操作)が必要そうな依頼
+TOOL_KEYWORDS = [
+    "python",
+    "コード",
+    "プログラム",
+    "実行",
+    "計算",
+    "ファイル",
+    "グラフ",
+    "csv",
+    "bash",
+    "インストール",
+    "code",
+    "program",
+    "run",
+    "execute",
+    "calculate",
+    "file",
+    "plot",
+    "install",
+]
+
+
+def create_keyword_pattern(keywords: List[str]) -> re.Pattern:
+    """
+    英単語のキーワードは単語単位で一致させる("run"が"rerun"に、"file"が"profile"に一致しないように)
+    日本語のキーワードは単語の区切りが無いので部分一致させる
+    """
+    patterns = []
+    for keyword in keywords:
+        if keyword.isascii():
+            patterns.append(rf"\b{re.escape(keyword)}s?\b")
+        else:
+            patterns.append(re.escape(keyword))
+    return re.compile("|".join(patterns))
+
+
+COMPLEX_KEYWORD_PATTERN = create_keyword_pattern(COMPLEX_KEYWORDS)
+TOOL_KEYWORD_PATTERN = create_keyword_pattern(TOOL_KEYWORDS)
+ARITHMETIC_PATTERN = re.compile(r"\d+(\.\d+)?\s*[-+*/%^]\s*\d")
+CODE_BLOCK_PATTERN = re.compile(r"```")
+STEP_PATTERN = re.compile(r"^\s*(\d+[.)]|[-*+])\s", re.MULTILINE)
+
+ROUTER_PROMPT = """次のユーザーの依頼を処理する方法を1つ選び、その単語だけを答えてください。
+- direct: 知識だけで答えられる質問や会話
+- agent: コード実行やファイル操作などのツールを1つのエージェントが使えば完了する依頼
+- supervisor: 設計、実装、テストなど複数の工程や複数のエージェントが必要な依頼
+
+# 依頼
+{input}
+
+# 回答(direct/agent/supervisorのどれか)
+"""
+
+
+class FastPathRouter:
+    """
+    supervisor(zoltraak前処理 + planner + crew)を使う前の振り分け
+
+    まずヒューリスティックで判定し、確信が持てない時だけsettings.ROUTER_USE_LLMならllm_liteに判定させる。
+    - DIRECT: 短い質問や会話
+    - AGENT: 計算やコード実行など1つのagentで足りる依頼
+    - SUPERVISOR: 長い依頼、複数の工程が必要な依頼
+    """
+
+    def __init__(self, ci_params: CodeInterpreterParams):
+        self.ci_params = ci_params
+        self._llm_router: Optional[Runnable] = None
+        self._direct_runnable: Optional[Runnable] = None
+
+    @staticmethod
+    def get_text(input: Any) -> str:
+        if isinstance(input, list):
+            input = input[-1] if input else ""
+        if isinstance(input, dict):
+            for key in ("input", "content"):
+                if key in input:
+                    return str(input[key])
+        return str(input)
+
+    @staticmethod
+    def classify(text: str) -> Tuple[RouteType, bool]:
+        """
+        ヒューリスティックによる判定。(route, 確信があるか)を返す
+        """
+        lower_text = text.lower()
+        if len(text) > settings.ROUTER_MAX_SIMPLE_CHARS:
+            return RouteType.SUPERVISOR, True
+        if len(STEP_PATTERN.findall(text)) >= 2:
+            return RouteType.SUPERVISOR, True
+        if COMPLEX_KEYWORD_PATTERN.search(lower_text):
+            return RouteType.SUPERVISOR, False
+        if ARITHMETIC_PATTERN.search(text) or CODE_BLOCK_PATTERN.search(text):
+            return RouteType.AGENT, True
+        if TOOL_KEYWORD_PATTERN.search(lower_text):
+            return RouteType.AGENT, False
+        return RouteType.DIRECT, len(text) <= settings.ROUTER_MAX_DIRECT_CHARS
+
+    @property
+    def llm_router(self) -> Optional[Runnable]:
+        if self._llm_router is None:
+            llm = self.ci_params.llm_lite or self.ci_params.llm
+            if llm is None:
+                return None
+            prompt = PromptTemplate(input_variables=["input"], template=ROUTER_PROMPT)
+            self._llm_router = prompt | CodeInterpreterLlm.with_cache(llm, "router")
+        return self._llm_router
+
+    @property
+    def direct_runnable(self) -> Runnable:
+        """
+        DIRECTで回答するrunnable
+
+        agentやplannerと同じセッションの会話履歴を使い、回答も履歴に残す(次のターンのagentから見えるように)
+        """
+        if self._direct_runnable is None:
+            prompt = ChatPromptTemplate.from_messages(
+                [MessagesPlaceholder("history", optional=True), ("human", "{input}")]
+            )
+            runnable = prompt | self.ci_params.llm
+            if self.ci_params.runnable_config:
+                runnable = assign_runnable_history(runnable, self.ci_params.runnable_config, self.ci_params.llm)
+            self._direct_runnable = runnable
+        return self._direct_runnable
+
+    def route(self, input: Any) -> RouteType:
+        text = self.get_text(input)
+        route, is_confident = self.classify(text)
+        if not is_confident and settings.ROUTER_USE_LLM and self.llm_router is not None:
+            try:
+                route = self._parse_route(self.llm_router.invoke({"input": text}), route)
+            except Exception as e:
+                print("FastPathRouter llm error=", e)
+        print(f"FastPathRouter route={route.value} is_confident={is_confident}")
+        return route
+
+    async def aroute(self, input: Any) -> RouteType:
+        text = self.get_text(input)
+        route, is_confident = self.classify(text)
+        if not is_confident and settings.ROUTER_USE_LLM and self.llm_router is not None:
+            try:
+                route = self._parse_route(await self.llm_router.ainvoke({"input": text}), route)
+            except Exception as e:
+                print("FastPathRouter llm error=", e)
+        print(f"FastPathRouter route={route.value} is_confident={is_confident}")
+        return route
+
+    @staticmethod
+    def _parse_route(output: Any, default_route: RouteType) -> RouteType:
+        content = output.content if hasattr(output, "content") else str(output)
+        content = str(content).lower()
+        # 最初に出てきたroute名を採用する
+        positions = [(content.find(route.value), route) for route in RouteType if route.value in content]
+        if not positions:
+            return default_route
+        return min(positions)[1]
+
+
+def test():
+    assert FastPathRouter.classify("こんにちは")[0] == RouteType.DIRECT
+    assert FastPathRouter.classify("calculate 2*5+2") == (RouteType.AGENT, True)
+    assert FastPathRouter.classify("1. 設計する\n2. 実装する\n3. テストする")[0] == RouteType.SUPERVISOR
+    assert FastPathRouter.classify("x" * 1000) == (RouteType.SUPERVISOR, True)
+    assert FastPathRouter.classify("run main.py")[0] == RouteType.AGENT
+    assert FastPathRouter.classify("show my profile")[0] == RouteType.DIRECT
+    assert FastPathRouter.classify("what does rerun mean")[0] == RouteType.DIRECT
+    assert FastPathRouter._parse_route("agent", RouteType.DIRECT) == RouteType.AGENT
+    assert FastPathRouter._parse_route("unknown", RouteType.DIRECT) == RouteType.DIRECT
+    assert FastPathRouter.get_text([{"input": "a"}, {"input": "b"}]) == "b"
+
+
+if __name__ == "__main__":
+    test()
@@ -12,12 +12,35 @@ from langchain_core.agents import AgentAction
 
 from langchain_core.outputs import LLMResult
 
+from codeinterpreterapi.callbacks.writer import BufferedFileWriter
+from codeinterpreterapi.config import settings
+
 
 class MarkdownFileCallbackHandler(FileCallbackHandler):
-    def __init__(self, filename: str = "langchain_log.md"):
+    def __init__(self, filename: str = "langchain_log.md", buffered: Optional[bool] = None):
         if os.path.isfile(filename):
             os.remove(filename)
-        super().__init__(filename, "a")
+        if buffered is None:
+            buffered = settings.LOG_BUFFERED
+        self.buffered = buffered
+        if buffered:
+            # ディスクへの書き込みはバックグラウンドスレッドで行う
+            self.file = BufferedFileWriter(
+                filename,
+                queue_size=settings.LOG_QUEUE_SIZE,
+                flush_size=settings.LOG_FLUSH_SIZE,
+                flush_interval=settings.LOG_FLUSH_INTERVAL,
+                max_bytes=settings.LOG_MAX_BYTES,
+                backup_count=settings.LOG_BACKUP_COUNT,
+                compress=settings.LOG_COMPRESS,
+            )
+            # FileCallbackHandler.__init__は呼ばないので、継承したon_text/_writeが使う属性をここで設定する
+            self.filename = filename
+            self.mode = "a"
+            self.color = None
+            self._file_opened_in_context = False
+        else:
+            super().__init__(filename, "a")
         self.step_count = 0
 
     def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
@@ -103,7 +126,18 @@ class MarkdownFileCallbackHandler(FileCallbackHandler):
 
     def _write_to_file(self, text: str) -> None:
         self.file.write(text)
-        self.file.flush()
+        if not self.buffered:
+            self.file.flush()
+
+    def flush(self) -> None:
+        """書き込み待ちのログを全てファイルに書き込む"""
+        if self.buffered:
+            self.file.sync()
+        else:
+            self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
 
     def _get_timestamp(self) -> str:
         return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
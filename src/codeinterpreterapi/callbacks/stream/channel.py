@@ -0,0 +1,73 @@
+import asyncio
+import queue
+from typing import Any, AsyncIterator, Iterator, Optional
+
+
+class StreamChannel:
+    """
+    callbackからconsumerへ応答を受け渡すキュー
+
+    loopを指定しない場合はスレッドセーフなqueue.Queue、指定した場合はasyncio.Queueを使う。
+    put()はどのスレッドから呼んでもよく、待っているconsumerは即座に起こされる。
+    """
+
+    _END = object()
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop
+        if loop is None:
+            self.queue: Any = queue.Queue()
+        else:
+            self.queue = asyncio.Queue()
+        self.closed = False
+
+    def put(self, item: Any) -> None:
+        if self.loop is None:
+            self.queue.put(item)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.put(self._END)
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            item = self.queue.get()
+            if item is self._END:
+                return
+            yield item
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        while True:
+            item = await self.queue.get()
+            if item is self._END:
+                return
+            yield item
+
+
+def test():
+    import threading
+
+    channel = StreamChannel()
+    producer = threading.Thread(target=lambda: [channel.put(i) for i in range(3)] and channel.close())
+    producer.start()
+    items = list(channel)
+    producer.join()
+    print("items=", items)
+    assert items == [0, 1, 2]
+
+    async def atest():
+        achannel = StreamChannel(loop=asyncio.get_running_loop())
+        threading.Thread(target=lambda: [achannel.put(i) for i in range(3)] and achannel.close()).start()
+        return [item async for item in achannel]
+
+    aitems = asyncio.run(atest())
+    print("aitems=", aitems)
+    assert aitems == [0, 1, 2]
+
+
+if __name__ == "__main__":
+    test()
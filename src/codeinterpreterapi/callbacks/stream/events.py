@@ -0,0 +1,41 @@
+from enum import Enum
+from typing import Any
+
+from pydantic import BaseModel
+
+
+class StreamEventType(str, Enum):
+    TOKEN = "token"  # LLMのトークン差分
+    TOOL_START = "tool_start"
+    TOOL_END = "tool_end"
+    CHAIN_END = "chain_end"  # チェーンの出力(トークンストリーム無効時の従来の粒度)
+    ERROR = "error"
+
+
+class StreamEvent(BaseModel):
+    """
+    AgentCallbackHandlerからStreamChannelに流すイベント
+
+    start: そのセグメント(LLMの1回の応答やツール呼び出し)の最初のイベントならTrue
+    """
+
+    type: StreamEventType
+    content: Any = ""
+    name: str = ""
+    start: bool = False
+
+    def __str__(self) -> str:
+        return self.__repr__()
+
+    def __repr__(self) -> str:
+        return f"StreamEvent(type={self.type.value}, name={self.name}, start={self.start}, content={self.content})"
+
+
+def test():
+    event = StreamEvent(type=StreamEventType.TOKEN, content="Hello", start=True)
+    print("event=", event)
+    assert event.type == "token"
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,241 @@
+import datetime
+import json
+import os
+import random
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+from uuid import UUID
+
+from langchain_core.agents import AgentAction, AgentFinish
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+
+from codeinterpreterapi.callbacks.writer import BufferedFileWriter
+from codeinterpreterapi.config import settings
+
+
+def get_trace_path(trace_dir: str, session_id: str) -> str:
+    return os.path.join(trace_dir, f"{session_id}.jsonl")
+
+
+class JsonlTraceCallbackHandler(BaseCallbackHandler):
+    """
+    セッションごとのjsonlトレース({trace_dir}/{session_id}.jsonl)
+
+    1行が1イベントで、run_id/parent_run_idで木構造を復元できる。
+    ファイルはセッションごとに分かれるので、同じプロセスで複数セッションを同時に実行しても混ざらない。
+    sample_rate: ルートのrun単位で記録するかを決める(1.0なら全て記録、0.1なら1割のrunだけ記録)
+    Markdownへの変換はcallbacks/trace/render.pyで行う。
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        trace_dir: Optional[str] = None,
+        sample_rate: Optional[float] = None,
+        buffered: Optional[bool] = None,
+    ):
+        self.session_id = session_id
+        self.trace_dir = trace_dir or settings.TRACE_DIR
+        self.sample_rate = settings.TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.buffered = settings.LOG_BUFFERED if buffered is None else buffered
+        self.path = get_trace_path(self.trace_dir, session_id)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        if self.buffered:
+            self.file = BufferedFileWriter(
+                self.path,
+                queue_size=settings.LOG_QUEUE_SIZE,
+                flush_size=settings.LOG_FLUSH_SIZE,
+                flush_interval=settings.LOG_FLUSH_INTERVAL,
+                max_bytes=settings.LOG_MAX_BYTES,
+                backup_count=settings.LOG_BACKUP_COUNT,
+                compress=settings.LOG_COMPRESS,
+            )
+        else:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.lock = threading.Lock()
+        # run_id => ルートのrun_id(サンプリング対象のrunだけ保持する)
+        self.sampled_runs: Dict[UUID, UUID] = {}
+        # サンプリング対象外のrun_id
+        self.skipped_runs: Dict[UUID, UUID] = {}
+
+    # CallbackManagerMixin
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any) -> None:
+        self._write_start("llm_start", serialized, {"prompts": prompts}, **kwargs)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], **kwargs: Any) -> Any:
+        data = {"messages": [[self._message_to_dict(message) for message in batch] for batch in messages]}
+        self._write_start("chat_model_start", serialized, data, **kwargs)
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], **kwargs: Any) -> None:
+        self._write_start("chain_start", serialized, {"inputs": inputs}, **kwargs)
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, **kwargs: Any) -> Any:
+        self._write_start("tool_start", serialized, {"input": input_str}, **kwargs)
+
+    # LLMManagerMixin, ChainManagerMixin, ToolManagerMixin
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        texts = [[generation.text for generation in generations] for generations in response.generations]
+        self._write_end("llm_end", {"generations": texts, "llm_output": response.llm_output}, **kwargs)
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        self._write_end("llm_error", {"error": repr(error)}, **kwargs)
+
+    def on_chain_end(self, outputs: Dict[str, Any], **kwargs: Any) -> None:
+        self._write_end("chain_end", {"outputs": outputs}, **kwargs)
+
+    def on_chain_error(self, error: BaseException, **kwargs: Any) -> None:
+        self._write_end("chain_error", {"error": repr(error)}, **kwargs)
+
+    def on_agent_action(self, action: AgentAction, **kwargs: Any) -> Any:
+        self._write_event("agent_action", {"tool": action.tool, "tool_input": action.tool_input}, **kwargs)
+
+    def on_agent_finish(self, finish: AgentFinish, **kwargs: Any) -> None:
+        self._write_event("agent_finish", {"return_values": finish.return_values}, **kwargs)
+
+    def on_tool_end(self, output: Any, **kwargs: Any) -> None:
+        self._write_end("tool_end", {"output": output}, **kwargs)
+
+    def on_tool_error(self, error: BaseException, **kwargs: Any) -> Any:
+        self._write_end("tool_error", {"error": repr(error)}, **kwargs)
+
+    def flush(self) -> None:
+        """書き込み待ちのトレースを全てファイルに書き込む"""
+        if self.buffered:
+            self.file.sync()
+        else:
+            with self.lock:
+                self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+    def _is_sampled(self, run_id: Optional[UUID], parent_run_id: Optional[UUID], is_start: bool) -> bool:
+        if run_id is None:
+            return True
+        with self.lock:
+            if run_id in self.sampled_runs:
+                return True
+            if run_id in self.skipped_runs:
+                return False
+            if not is_start:
+                return False
+            if parent_run_id is None:
+                root_run_id = run_id
+                sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+            elif parent_run_id in self.sampled_runs:
+                root_run_id = self.sampled_runs[parent_run_id]
+                sampled = True
+            elif parent_run_id in self.skipped_runs:
+                root_run_id = self.skipped_runs[parent_run_id]
+                sampled = False
+            else:
+                # 親のstartを受け取っていない(途中から追加されたなど)場合は記録する
+                root_run_id = parent_run_id
+                sampled = True
+            runs = self.sampled_runs if sampled else self.skipped_runs
+            runs[run_id] = root_run_id
+            return sampled
+
+    def _forget_run(self, run_id: Optional[UUID], parent_run_id: Optional[UUID]) -> None:
+        # ルートのrunが終わったらその配下のrunをまとめて忘れる
+        if run_id is None or parent_run_id is not None:
+            return
+        with self.lock:
+            for runs in (self.sampled_runs, self.skipped_runs):
+                for child_run_id in [k for k, v in runs.items() if v == run_id]:
+                    del runs[child_run_id]
+
+    def _write_start(self, event: str, serialized: Optional[Dict[str, Any]], data: Dict[str, Any], **kwargs: Any):
+        run_id = kwargs.get("run_id")
+        parent_run_id = kwargs.get("parent_run_id")
+        if not self._is_sampled(run_id, parent_run_id, is_start=True):
+            return
+        name = kwargs.get("name") or self._get_name(serialized)
+        data = {"tags": kwargs.get("tags"), **data}
+        self._write_record(event, run_id, parent_run_id, name, data)
+
+    def _write_end(self, event: str, data: Dict[str, Any], **kwargs: Any):
+        run_id = kwargs.get("run_id")
+        parent_run_id = kwargs.get("parent_run_id")
+        if self._is_sampled(run_id, parent_run_id, is_start=False):
+            self._write_record(event, run_id, parent_run_id, kwargs.get("name", ""), data)
+        self._forget_run(run_id, parent_run_id)
+
+    def _write_event(self, event: str, data: Dict[str, Any], **kwargs: Any):
+        run_id = kwargs.get("run_id")
+        parent_run_id = kwargs.get("parent_run_id")
+        if self._is_sampled(run_id, parent_run_id, is_start=False):
+            self._write_record(event, run_id, parent_run_id, kwargs.get("name", ""), data)
+
+    def _write_record(
+        self, event: str, run_id: Optional[UUID], parent_run_id: Optional[UUID], name: str, data: Dict[str, Any]
+    ) -> None:
+        record = {
+            "timestamp": datetime.datetime.now().isoformat(),
+            "session_id": self.session_id,
+            "event": event,
+            "run_id": str(run_id) if run_id else None,
+            "parent_run_id": str(parent_run_id) if parent_run_id else None,
+            "name": name,
+            "data": data,
+        }
+        line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+        if self.buffered:
+            self.file.write(line)
+        else:
+            with self.lock:
+                self.file.write(line)
+                self.file.flush()
+
+    @staticmethod
+    def _get_name(serialized: Optional[Dict[str, Any]]) -> str:
+        if not serialized:
+            return ""
+        return serialized.get("name") or serialized.get("id", ["<unknown>"])[-1]
+
+    @staticmethod
+    def _message_to_dict(message: BaseMessage) -> Dict[str, Any]:
+        return {"type": message.type, "content": message.content}
+
+
+def read_trace(path: str) -> Sequence[Dict[str, Any]]:
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # 書き込み途中の行などは無視する
+                continue
+    return records
+
+
+def test():
+    import tempfile
+    from uuid import uuid4
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        handler = JsonlTraceCallbackHandler("test_session", trace_dir=tmp_dir, sample_rate=1.0)
+        root_run_id = uuid4()
+        child_run_id = uuid4()
+        handler.on_chain_start({"name": "TestChain"}, {"input": "hello"}, run_id=root_run_id, parent_run_id=None)
+        handler.on_tool_start({"name": "python"}, "print(1)", run_id=child_run_id, parent_run_id=root_run_id)
+        handler.on_tool_end("1", run_id=child_run_id, parent_run_id=root_run_id)
+        handler.on_chain_end({"output": "world"}, run_id=root_run_id, parent_run_id=None)
+        handler.close()
+        records = read_trace(handler.path)
+        print("records=", [record["event"] for record in records])
+        assert [record["event"] for record in records] == ["chain_start", "tool_start", "tool_end", "chain_end"]
+        assert not handler.sampled_runs
+
+        handler = JsonlTraceCallbackHandler("test_session_skip", trace_dir=tmp_dir, sample_rate=0.0)
+        handler.on_chain_start({"name": "TestChain"}, {"input": "hello"}, run_id=root_run_id, parent_run_id=None)
+        handler.on_chain_end({"output": "world"}, run_id=root_run_id, parent_run_id=None)
+        handler.close()
+        assert len(read_trace(handler.path)) == 0
+
+
+if __name__ == "__main__":
+    test()
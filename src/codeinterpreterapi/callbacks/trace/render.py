@@ -0,0 +1,112 @@
+import argparse
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+from codeinterpreterapi.callbacks.trace.callbacks import get_trace_path, read_trace
+from codeinterpreterapi.config import settings
+
+EVENT_TITLES = {
+    "llm_start": "LLM Start",
+    "chat_model_start": "Chat Model Start",
+    "llm_end": "LLM End",
+    "llm_error": "LLM Error",
+    "chain_start": "Chain Start",
+    "chain_end": "Chain End",
+    "chain_error": "Chain Error",
+    "tool_start": "Tool Start",
+    "tool_end": "Tool End",
+    "tool_error": "Tool Error",
+    "agent_action": "Agent Action",
+    "agent_finish": "Agent Finish",
+}
+
+
+class TraceMarkdownRenderer:
+    """
+    JsonlTraceCallbackHandlerのトレース(jsonl)を後からMarkdownに変換する
+
+    run_id毎にまとめて、親子関係を見出しのレベルで表す。
+    """
+
+    @staticmethod
+    def render(records: Sequence[Dict[str, Any]], max_chars: int = 0) -> str:
+        depths: Dict[str, int] = {}
+        lines: List[str] = []
+        if records:
+            lines.append(f"# Session {records[0].get('session_id', '')}\n\n")
+        step_count = 0
+        for record in records:
+            run_id = record.get("run_id")
+            parent_run_id = record.get("parent_run_id")
+            if run_id and run_id not in depths:
+                depths[run_id] = depths.get(parent_run_id, -1) + 1 if parent_run_id else 0
+            depth = depths.get(run_id, 0)
+            event = record.get("event", "")
+            title = EVENT_TITLES.get(event, event)
+            if event.endswith("_start"):
+                step_count += 1
+            if record.get("name"):
+                title += f" - {record['name']}"
+            heading = "#" * min(depth + 2, 6)
+            lines.append(f"{heading} Step {step_count}: {title}\n\n")
+            lines.append(f"**Timestamp:** {record.get('timestamp', '')}\n\n")
+            lines.append(f"**run_id:** {run_id}\n\n")
+            for key, value in (record.get("data") or {}).items():
+                if value is None:
+                    continue
+                lines.append(f"**{key}:**\n\n")
+                lines.append(f"```\n{TraceMarkdownRenderer._format_value(value, max_chars)}\n```\n\n")
+        return "".join(lines)
+
+    @staticmethod
+    def render_file(path: str, output_path: Optional[str] = None, max_chars: int = 0) -> str:
+        markdown = TraceMarkdownRenderer.render(read_trace(path), max_chars=max_chars)
+        if output_path:
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(markdown)
+        return markdown
+
+    @staticmethod
+    def render_session(session_id: str, trace_dir: Optional[str] = None, output_path: Optional[str] = None) -> str:
+        path = get_trace_path(trace_dir or settings.TRACE_DIR, session_id)
+        return TraceMarkdownRenderer.render_file(path, output_path)
+
+    @staticmethod
+    def _format_value(value: Any, max_chars: int) -> str:
+        if isinstance(value, str):
+            text = value
+        else:
+            text = json.dumps(value, ensure_ascii=False, indent=2, default=str)
+        if max_chars > 0 and len(text) > max_chars:
+            text = text[:max_chars] + f"... ({len(text) - max_chars} chars truncated)"
+        return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a session trace (jsonl) to Markdown.")
+    parser.add_argument("trace", help="trace file path or session_id")
+    parser.add_argument("-o", "--output", help="output markdown path (default: stdout)")
+    parser.add_argument("--trace-dir", default=settings.TRACE_DIR)
+    parser.add_argument("--max-chars", type=int, default=0, help="truncate each value to this length")
+    args = parser.parse_args()
+
+    path = args.trace if args.trace.endswith(".jsonl") else get_trace_path(args.trace_dir, args.trace)
+    markdown = TraceMarkdownRenderer.render_file(path, args.output, max_chars=args.max_chars)
+    if not args.output:
+        print(markdown)
+
+
+def test():
+    records = [
+        {"session_id": "s", "event": "chain_start", "run_id": "1", "parent_run_id": None, "name": "Chain", "data": {}},
+        {"session_id": "s", "event": "tool_start", "run_id": "2", "parent_run_id": "1", "name": "python", "data": {}},
+        {"session_id": "s", "event": "tool_end", "run_id": "2", "parent_run_id": "1", "data": {"output": "1"}},
+        {"session_id": "s", "event": "chain_end", "run_id": "1", "parent_run_id": None, "data": {"outputs": {}}},
+    ]
+    markdown = TraceMarkdownRenderer.render(records)
+    print(markdown)
+    assert "### Step 2: Tool Start - python" in markdown
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,11 @@
 import sys
-from copy import deepcopy
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, Iterable, List, Mapping, Tuple, Union
+
+# show_callback_info()で表示する時の上限
+MAX_DEPTH = 4
+MAX_ITEMS = 20
+MAX_VALUE_CHARS = 80
+MAX_TOTAL_CHARS = 4000
 
 
 def get_current_function_name(depth: int = 1) -> str:
@@ -13,65 +18,128 @@ def show_callback_info(name: str, tag: str, data: Any) -> None:
     print(f"{tag}=", trim_data(data))
 
 
-def trim_data(data: Union[Any, List[Any], Dict[str, Any]]) -> str:
+def trim_data(
+    data: Union[Any, List[Any], Dict[str, Any]],
+    max_depth: int = MAX_DEPTH,
+    max_items: int = MAX_ITEMS,
+    max_value_chars: int = MAX_VALUE_CHARS,
+    max_total_chars: int = MAX_TOTAL_CHARS,
+) -> str:
     """
     dataの構造をデバッグ表示用に短縮する関数
 
-    :data: 対象データ
-    """
-    data_copy = deepcopy(data)
-    return trim_data_iter("", data_copy)
-
+    dataはコピーせずに辿り、深さ(max_depth)、要素数(max_items)、値の長さ(max_value_chars)、
+    全体の長さ(max_total_chars)のどれかの上限に達したらそこで打ち切る。
+    どのcallback handlerからも使える。
 
-def trim_data_iter(indent: str, data: Union[Any, List[Any], Dict[str, Any]]) -> str:
-    """
-    dataの構造をデバッグ表示用に短縮する関数
-
-    :param data: 対象データ
-    """
-    indent_next = indent + "  "
-    if isinstance(data, dict):
-        return trim_data_dict(indent_next, data)
-    elif isinstance(data, list):
-        return trim_data_array(indent_next, data)
-    else:
-        return trim_data_other(indent, data)
-
-
-def trim_data_dict(indent: str, data: Dict[str, Any]) -> str:
-    """
-    dataの構造をデバッグ表示用に短縮する関数
-
-    :param indent: インデント文字列
-    :param data: 対象データ
+    :data: 対象データ
     """
-    new_data_list = []
-    for k, v in data.items():
-        new_data_list.append(f"{indent}dict[{k}]: " + trim_data_iter(indent, v))
-    return "\n".join(new_data_list)
+    summarizer = DataSummarizer(max_depth, max_items, max_value_chars, max_total_chars)
+    summarizer.walk("", data, 0)
+    return summarizer.result()
 
 
-def trim_data_array(indent: str, data: List[Any]) -> str:
-    """
-    dataの構造をデバッグ表示用に短縮する関数
-
-    :param indent: インデント文字列
-    :param data: 対象データ
+class DataSummarizer:
     """
-    new_data_list = []
-    for i, item in enumerate(data):
-        print(f"{indent}array[{str(i)}]: ")
-        new_data_list.append(trim_data_iter(indent, item))
-    return "\n".join(new_data_list)
-
-
-def trim_data_other(indent: str, data: Any) -> str:
+    trim_data()の実装。出力した文字数を数えながら辿り、上限に達したら残りは辿らない
     """
-    dataの構造をデバッグ表示用に短縮する関数
 
-    :param indent: インデント文字列
-    :param data: 対象データ
-    """
-    stype = str(type(data))
-    s = str(data)
-    return f"{indent}type={stype}, data={s[:80]}"
+    def __init__(self, max_depth: int, max_items: int, max_value_chars: int, max_total_chars: int):
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_value_chars = max_value_chars
+        self.max_total_chars = max_total_chars
+        self.lines: List[str] = []
+        self.total_chars = 0
+        self.truncated = False
+
+    def result(self) -> str:
+        if self.truncated:
+            self.lines.append(f"... (truncated at {self.max_total_chars} chars)")
+        return "\n".join(self.lines)
+
+    def walk(self, indent: str, data: Any, depth: int) -> None:
+        if self.truncated:
+            return
+        items = self._get_items(data)
+        if items is None:
+            self._append(indent + self._format_value(data))
+        elif depth >= self.max_depth:
+            self._append(f"{indent}type={type(data)}, len={self._get_len(data)}, ... (max depth)")
+        else:
+            self._walk_items(indent, data, items, depth)
+
+    def _walk_items(self, indent: str, data: Any, items: Iterable[Tuple[str, Any]], depth: int) -> None:
+        indent_next = indent + "  "
+        for i, (label, value) in enumerate(items):
+            if self.truncated:
+                return
+            if i >= self.max_items:
+                self._append(f"{indent}... ({self._get_len(data) - self.max_items} more items)")
+                return
+            if self._get_items(value) is None:
+                self._append(f"{indent}{label}: " + self._format_value(value))
+            else:
+                self._append(f"{indent}{label}:")
+                self.walk(indent_next, value, depth + 1)
+
+    def _append(self, line: str) -> None:
+        if self.total_chars + len(line) > self.max_total_chars:
+            self.truncated = True
+            return
+        self.lines.append(line)
+        self.total_chars += len(line) + 1
+
+    def _format_value(self, data: Any) -> str:
+        stype = str(type(data))
+        if isinstance(data, str):
+            s = data[: self.max_value_chars]
+            if len(data) > self.max_value_chars:
+                s += f"... ({len(data)} chars)"
+        elif isinstance(data, (bytes, bytearray)):
+            s = f"<{len(data)} bytes>"
+        else:
+            s = str(data)[: self.max_value_chars]
+        return f"type={stype}, data={s}"
+
+    @staticmethod
+    def _get_items(data: Any) -> Union[Iterable[Tuple[str, Any]], None]:
+        # コンテナは(ラベル, 値)を遅延で返す。コンテナでなければNone
+        if isinstance(data, Mapping):
+            return ((f"dict[{k}]", v) for k, v in data.items())
+        if isinstance(data, (list, tuple)):
+            return ((f"array[{i}]", v) for i, v in enumerate(data))
+        model_fields = getattr(type(data), "model_fields", None)
+        if isinstance(model_fields, dict):
+            # pydanticのモデル(BaseMessage, LLMResultなど)はmodel_dump()せずに属性を辿る
+            return ((f"{type(data).__name__}.{k}", getattr(data, k, None)) for k in model_fields)
+        return None
+
+    @staticmethod
+    def _get_len(data: Any) -> int:
+        model_fields = getattr(type(data), "model_fields", None)
+        if isinstance(model_fields, dict):
+            return len(model_fields)
+        try:
+            return len(data)
+        except TypeError:
+            return 0
+
+
+def test():
+    data = {
+        "prompts": ["x" * 100000, "short"],
+        "nested": {"a": {"b": {"c": {"d": {"e": 1}}}}},
+        "many": list(range(100)),
+        "bytes": b"\0" * 1000,
+    }
+    s = trim_data(data)
+    print(s)
+    assert "(100000 chars)" in s
+    assert "(max depth)" in s
+    assert "(80 more items)" in s
+    assert len(trim_data(data, max_total_chars=200)) < 300
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,204 @@
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+import weakref
+from typing import List, Optional
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+class _WriterWorker:
+    """
+    BufferedFileWriterのバックグラウンドスレッドとファイル
+
+    スレッドはこのオブジェクトだけを参照するので、BufferedFileWriterがGCされるとweakref.finalizeでcloseできる。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str,
+        queue_size: int,
+        flush_size: int,
+        flush_interval: float,
+        max_bytes: int,
+        backup_count: int,
+        compress: bool,
+    ):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.closed = False
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.file = open(path, mode, encoding="utf-8")
+        self.thread = threading.Thread(target=self.run, name=f"BufferedFileWriter({path})", daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put((_CLOSE, None))
+        self.thread.join(timeout=5.0)
+
+    def run(self) -> None:
+        buffer: List[str] = []
+        buffer_size = 0
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - last_flush))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, str):
+                buffer.append(item)
+                buffer_size += len(item)
+                if buffer_size < self.flush_size and time.monotonic() - last_flush < self.flush_interval:
+                    continue
+
+            self.write_buffer(buffer)
+            buffer = []
+            buffer_size = 0
+            last_flush = time.monotonic()
+
+            if isinstance(item, tuple):
+                command, done = item
+                if done is not None:
+                    done.set()
+                if command is _CLOSE:
+                    self.file.close()
+                    return
+
+    def write_buffer(self, buffer: List[str]) -> None:
+        if not buffer:
+            return
+        try:
+            self.file.write("".join(buffer))
+            self.file.flush()
+            if self.max_bytes > 0 and self.file.tell() >= self.max_bytes:
+                self.rotate()
+        except (OSError, ValueError) as e:
+            print("BufferedFileWriter write error=", e)
+
+    def rotate(self) -> None:
+        self.file.close()
+        suffix = ".gz" if self.compress else ""
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}{suffix}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}{suffix}")
+        if self.backup_count > 0:
+            if self.compress:
+                with open(self.path, "rb") as f_in, gzip.open(f"{self.path}.1.gz", "wb") as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(self.path)
+            else:
+                os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, "w", encoding="utf-8")
+
+
+class BufferedFileWriter:
+    """
+    バックグラウンドスレッドでファイルに書き込むfile-likeなwriter
+
+    write()はキューに積むだけなので呼び出し元のスレッドでディスクI/Oは発生しない。
+    - flush_size: バッファがこのバイト数を超えたら書き込む
+    - flush_interval: 最後の書き込みからこの秒数経ったら書き込む
+    - max_bytes: 0より大きければファイルがこのサイズを超えた時にローテーションする(path.1, path.2, ...)
+    - compress: ローテーションしたファイルをgzip圧縮する
+    キューが一杯の時(queue_size)は書き込みを捨ててdropped_countを増やす。
+    close()を呼ばなくても、GCされた時とプロセス終了時に書き残しを書き込んでスレッドとファイルを閉じる。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        mode: str = "a",
+        queue_size: int = 10000,
+        flush_size: int = 64 * 1024,
+        flush_interval: float = 1.0,
+        max_bytes: int = 0,
+        backup_count: int = 3,
+        compress: bool = False,
+    ):
+        self.path = path
+        self.dropped_count = 0
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self.worker = _WriterWorker(
+            path, mode, queue_size, flush_size, flush_interval, max_bytes, backup_count, compress
+        )
+        # atexit=True(デフォルト)なのでプロセス終了時にも呼ばれる
+        self._finalizer = weakref.finalize(self, self.worker.close)
+
+    @property
+    def closed(self) -> bool:
+        return self.worker.closed
+
+    def write(self, text: str) -> int:
+        if self.closed:
+            return 0
+        try:
+            self.worker.queue.put_nowait(text)
+        except queue.Full:
+            self.dropped_count += 1
+            if self.dropped_count == 1:
+                print("BufferedFileWriter queue is full, drop logs path=", self.path)
+        return len(text)
+
+    def flush(self) -> None:
+        """
+        file-likeとしてのflush。書き込みは非同期のまま行う(待たない)
+        """
+
+    def sync(self, timeout: Optional[float] = 5.0) -> bool:
+        """
+        ここまでにwriteした内容がファイルに書き込まれるまで待つ
+        """
+        if self.closed:
+            return True
+        done = threading.Event()
+        self.worker.queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    def close(self) -> None:
+        self._finalizer()
+
+
+def test():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "test.log")
+        writer = BufferedFileWriter(path, flush_interval=10, max_bytes=100, backup_count=2, compress=True)
+        for i in range(20):
+            writer.write(f"line {i}\n")
+        assert writer.sync()
+        writer.write("last\n")
+        writer.close()
+        print("files=", sorted(os.listdir(tmp_dir)))
+        with open(path, "r", encoding="utf-8") as f:
+            assert f.read().endswith("last\n")
+        assert os.path.exists(path + ".1.gz")
+
+        # closeしなくてもGCでスレッドが終わる
+        thread_count = threading.active_count()
+        writer = BufferedFileWriter(path)
+        writer.write("gc\n")
+        del writer
+        assert threading.active_count() == thread_count
+        with open(path, "r", encoding="utf-8") as f:
+            assert f.read().endswith("gc\n")
+
+
+if __name__ == "__main__":
+    test()
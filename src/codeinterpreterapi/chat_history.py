@@ -1,61 +1,139 @@
 import asyncio
 import json
-from typing import List
+from typing import List, Optional, Sequence
 
 from codeboxapi import CodeBox
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
 
+from codeinterpreterapi.config import settings
+
+HISTORY_FILE = "history.jsonl"
+LEGACY_HISTORY_FILE = "history.json"
+
 
 class CodeBoxChatMessageHistory(BaseChatMessageHistory):
     """
     Chat message history that stores history inside the codebox.
+
+    codebox内のhistory.jsonlに1行1メッセージで追記する。
+    - 読み込みは初期化時の1回だけで、以降はメモリ上のコピーを返す
+    - 追記はbatch_size件たまるまでまとめてから1回で書き込む(flush()で即時書き込み)
+    - compact_interval回追記したら、メモリ上のコピーでファイル全体を書き直す
     """
 
-    def __init__(self, codebox: CodeBox):
+    def __init__(self, codebox: CodeBox, batch_size: Optional[int] = None, compact_interval: Optional[int] = None):
         self.codebox = codebox
-
-        if "history.json" not in [f.name for f in self.codebox.list_files()]:
-            name, content = "history.json", b"{}"
-            if (loop := asyncio.get_event_loop()).is_running():
-                loop.create_task(self.codebox.aupload(name, content))
-            else:
-                self.codebox.upload(name, content)
+        self.batch_size = batch_size or settings.HISTORY_BATCH_SIZE
+        self.compact_interval = compact_interval or settings.HISTORY_COMPACT_INTERVAL
+        self._messages: List[BaseMessage] = []
+        self._pending: List[BaseMessage] = []
+        self._append_count = 0
+        self._load()
 
     @property
     def messages(self) -> List[BaseMessage]:  # type: ignore
-        """Retrieve the messages from the codebox"""
-        msgs = (
-            messages_from_dict(json.loads(file_content.decode("utf-8")))
-            if (
-                file_content := (
-                    loop.run_until_complete(self.codebox.adownload("history.json"))
-                    if (loop := asyncio.get_event_loop()).is_running()
-                    else self.codebox.download("history.json")
-                ).content
-            )
-            else []
-        )
-        return msgs
+        """Retrieve the messages from the local copy"""
+        return list(self._messages)
 
     def add_message(self, message: BaseMessage) -> None:
-        """Append the message to the record in the local file"""
-        print("Current messages: ", self.messages)
-        messages = messages_to_dict(self.messages)
-        print("Adding message: ", message)
-        messages.append(messages_to_dict([message])[0])
-        name, content = "history.json", json.dumps(messages).encode("utf-8")
-        if (loop := asyncio.get_event_loop()).is_running():
+        """Append the message to the local copy and upload it in batches"""
+        self._messages.append(message)
+        self._pending.append(message)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        self._messages.extend(messages)
+        self._pending.extend(messages)
+        self.flush()
+
+    def flush(self) -> None:
+        """Upload pending messages to the codebox"""
+        if not self._pending:
+            return
+        self._append_count += 1
+        if self._append_count >= self.compact_interval:
+            self.compact()
+            return
+        self._run(self._take_append_code())
+
+    async def aflush(self) -> None:
+        """Upload pending messages to the codebox and wait for it"""
+        if not self._pending:
+            return
+        self._append_count += 1
+        if self._append_count >= self.compact_interval:
+            await self.codebox.aupload(HISTORY_FILE, self._take_compact_content())
+            return
+        await self.codebox.arun(self._take_append_code())
+
+    def compact(self) -> None:
+        """Rewrite the whole history file from the local copy"""
+        self._upload(HISTORY_FILE, self._take_compact_content())
+
+    def _take_append_code(self) -> str:
+        lines = self._to_jsonl(self._pending)
+        self._pending = []
+        return f"with open({HISTORY_FILE!r}, 'a', encoding='utf-8') as f:\n    f.write({lines!r})"
+
+    def _take_compact_content(self) -> bytes:
+        self._pending = []
+        self._append_count = 0
+        return self._to_jsonl(self._messages).encode("utf-8")
+
+    def clear(self) -> None:
+        """Clear session memory from the codebox"""
+        print("Clearing history CLEARING HISTORY")
+        self._messages = []
+        self.compact()
+
+    def __del__(self) -> None:
+        # stop()されずに破棄された場合も書き込み待ちのメッセージを失わないようにする
+        try:
+            self.flush()
+        except Exception as e:
+            print("CodeBoxChatMessageHistory flush error on __del__ e=", e)
+
+    def _load(self) -> None:
+        file_names = [f.name for f in self.codebox.list_files()]
+        if HISTORY_FILE in file_names:
+            content = self.codebox.download(HISTORY_FILE).content or b""
+            for line in content.decode("utf-8").splitlines():
+                try:
+                    self._messages.extend(messages_from_dict([json.loads(line)]))
+                except (ValueError, KeyError):
+                    # 書き込み途中の行などは無視する
+                    print("CodeBoxChatMessageHistory skip broken line=", line[:80])
+        elif LEGACY_HISTORY_FILE in file_names:
+            # 旧形式(history.json)から移行する
+            content = self.codebox.download(LEGACY_HISTORY_FILE).content
+            if content:
+                self._messages = messages_from_dict(json.loads(content.decode("utf-8")) or [])
+            self.compact()
+        else:
+            self._upload(HISTORY_FILE, b"")
+
+    @staticmethod
+    def _to_jsonl(messages: Sequence[BaseMessage]) -> str:
+        return "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages_to_dict(messages))
+
+    @staticmethod
+    def _get_running_loop() -> Optional[asyncio.AbstractEventLoop]:
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループの外(別スレッドや__del__など)
+            return None
+
+    def _upload(self, name: str, content: bytes) -> None:
+        if loop := self._get_running_loop():
             loop.create_task(self.codebox.aupload(name, content))
         else:
             self.codebox.upload(name, content)
-        print("New messages: ", self.messages)
 
-    def clear(self) -> None:
-        """Clear session memory from the local file"""
-        print("Clearing history CLEARING HISTORY")
-        code = "import os; os.remove('history.json')"
-        if (loop := asyncio.get_event_loop()).is_running():
+    def _run(self, code: str) -> None:
+        if loop := self._get_running_loop():
             loop.create_task(self.codebox.arun(code))
         else:
             self.codebox.run(code)
@@ -1,18 +1,22 @@
-from typing import Dict, List
+from typing import AsyncIterable, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from crewai import Agent, Crew, Task
 from crewai.crews.crew_output import CrewOutput
 from gui_agent_loop_core.schema.message.schema import BaseMessageContent
 from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import Runnable
 
 from codeinterpreterapi.agents.agents import CodeInterpreterAgent
 from codeinterpreterapi.brain.params import CodeInterpreterParams
+from codeinterpreterapi.config import settings
 from codeinterpreterapi.crew.custom_agent import (
     CustomAgent,  # You need to build and extend your own agent logic with the CrewAI BaseAgent class then import it here.
 )
-from codeinterpreterapi.llm.llm import prepare_test_llm
+from codeinterpreterapi.crew.task_graph import CrewTaskGraph
+from codeinterpreterapi.llm.llm import CodeInterpreterLlm, prepare_test_llm
 from codeinterpreterapi.schema import CodeInterpreterIntermediateResult, CodeInterpreterPlan, CodeInterpreterPlanList
 from codeinterpreterapi.test_prompts.test_prompt import TestPrompt
+from codeinterpreterapi.utils.multi_converter import MultiConverter
 
 
 class CodeInterpreterCrew:
@@ -48,16 +52,53 @@ class CodeInterpreterCrew:
         return name_agent_dict
 
     def create_tasks(self, final_goal: str, plan_list: CodeInterpreterPlanList) -> List[Task]:
-        tasks = []
-        previous_task = None
-        for plan in plan_list.agent_task_list:
-            task = self.create_task(final_goal, plan, previous_task)
-            if task is not None:
-                tasks.append(task)
-                previous_task = task
-        return tasks
-
-    def create_task(self, final_goal: str, plan: CodeInterpreterPlan, previous_task: Task = None) -> Task:
+        return self.create_task_graph(final_goal, plan_list).tasks
+
+    def create_task_graph(self, final_goal: str, plan_list: CodeInterpreterPlanList) -> CrewTaskGraph:
+        """
+        planのdepends_onに従って依存するタスクをcontextに設定したタスクのDAGを作る
+        depends_onが無いplanは直前のタスクに依存する(従来の直列実行と同じ)
+        """
+        task_graph = CrewTaskGraph()
+        for task, depends_on in self.iter_tasks(task_graph, final_goal, plan_list.agent_task_list):
+            task_graph.add_task(task, depends_on)
+        return task_graph
+
+    def iter_tasks(
+        self, task_graph: CrewTaskGraph, final_goal: str, plans: Iterable[CodeInterpreterPlan]
+    ) -> Iterator[Tuple[Task, List[int]]]:
+        """
+        planを1つずつタスクに変換して(タスク, 依存するタスクのindex)を返す
+        返したタスクは次のplanを読む前にtask_graph.add_taskで追加されている必要がある(contextに使う)
+        """
+        for plan in plans:
+            plan_task = self.create_plan_task(task_graph, final_goal, plan)
+            if plan_task is not None:
+                yield plan_task
+
+    async def aiter_tasks(
+        self, task_graph: CrewTaskGraph, final_goal: str, plans: AsyncIterable[CodeInterpreterPlan]
+    ) -> AsyncIterator[Tuple[Task, List[int]]]:
+        async for plan in plans:
+            plan_task = self.create_plan_task(task_graph, final_goal, plan)
+            if plan_task is not None:
+                yield plan_task
+
+    def create_plan_task(
+        self, task_graph: CrewTaskGraph, final_goal: str, plan: CodeInterpreterPlan
+    ) -> Optional[Tuple[Task, List[int]]]:
+        has_agent = self.has_agent(plan)
+        depends_on = task_graph.add_plan(plan, has_agent)
+        if not has_agent:
+            print("WARN: no task found plan.agent_name=", plan.agent_name)
+            return None
+        context = [task_graph.tasks[j] for j in depends_on]
+        return self.create_task(final_goal, plan, context), depends_on
+
+    def has_agent(self, plan: CodeInterpreterPlan) -> bool:
+        return any(plan.agent_name == agent_def.agent_name for agent_def in self.ci_params.agent_def_list)
+
+    def create_task(self, final_goal: str, plan: CodeInterpreterPlan, context: Optional[List[Task]] = None) -> Task:
         print("create_task final_goal=", final_goal)
         # find
         for agent_def in self.ci_params.agent_def_list:
@@ -66,26 +107,20 @@ class CodeInterpreterCrew:
                 task_description += (
                     "\n\nサブタスク（これを達成したら完了として処理終了してください）： " + plan.task_description
                 )
-                context = []
-                if previous_task:
-                    context = [previous_task]
-
                 task = Task(
                     expected_output=plan.expected_output,
                     description=task_description,
                     agent=self.name_agent_dict[plan.agent_name],
-                    context=context,
+                    context=context or [],
                 )
                 return task
 
         print("WARN: no task found plan.agent_name=", plan.agent_name)
         return None
 
-    def run(self, inputs: BaseMessageContent, plan_list: CodeInterpreterPlanList) -> CodeInterpreterIntermediateResult:
+    @staticmethod
+    def get_final_goal(inputs: BaseMessageContent) -> Tuple[Dict, str]:
         # update task description
-        if plan_list is None:
-            return {}
-
         if isinstance(inputs, list):
             last_input = inputs[-1]
         else:
@@ -96,16 +131,92 @@ class CodeInterpreterCrew:
             final_goal = last_input["content"]
         else:
             final_goal = "ユーザの指示に従って最終的な回答をしてください"
+        return last_input, final_goal
+
+    def _prepare_run(
+        self, inputs: BaseMessageContent, plan_list: CodeInterpreterPlanList
+    ) -> Tuple[CrewTaskGraph, Dict, str]:
+        last_input, final_goal = self.get_final_goal(inputs)
+        task_graph = self.create_task_graph(final_goal=final_goal, plan_list=plan_list)
+        return task_graph, last_input, final_goal
+
+    def run(self, inputs: BaseMessageContent, plan_list: CodeInterpreterPlanList) -> CodeInterpreterIntermediateResult:
+        if plan_list is None:
+            return {}
 
-        tasks = self.create_tasks(final_goal=final_goal, plan_list=plan_list)
-        my_crew = Crew(agents=self.agents, tasks=tasks)
-        crew_output: CrewOutput = my_crew.kickoff(inputs=last_input)
-        result = self.llm_convert_to_CodeInterpreterIntermediateResult(crew_output, last_input, final_goal)
+        task_graph, last_input, final_goal = self._prepare_run(inputs, plan_list)
+        if settings.CREW_DAG_ENABLED:
+            crew_output: CrewOutput = task_graph.run()
+        else:
+            my_crew = Crew(agents=self.agents, tasks=task_graph.tasks)
+            crew_output: CrewOutput = my_crew.kickoff(inputs=last_input)
+        result = self.convert_to_CodeInterpreterIntermediateResult(crew_output)
+        if result is None:
+            result = self.llm_convert_to_CodeInterpreterIntermediateResult(crew_output, last_input, final_goal)
         return result
 
-    def llm_convert_to_CodeInterpreterIntermediateResult(
-        self, crew_output: CrewOutput, last_input: Dict, final_goal: str
+    async def arun(
+        self, inputs: BaseMessageContent, plan_list: CodeInterpreterPlanList
     ) -> CodeInterpreterIntermediateResult:
+        if plan_list is None:
+            return {}
+
+        task_graph, last_input, final_goal = self._prepare_run(inputs, plan_list)
+        if settings.CREW_DAG_ENABLED:
+            crew_output: CrewOutput = await task_graph.arun()
+        else:
+            my_crew = Crew(agents=self.agents, tasks=task_graph.tasks)
+            crew_output: CrewOutput = await my_crew.kickoff_async(inputs=last_input)
+        result = self.convert_to_CodeInterpreterIntermediateResult(crew_output)
+        if result is None:
+            result = await self.allm_convert_to_CodeInterpreterIntermediateResult(crew_output, last_input, final_goal)
+        return result
+
+    def run_stream(
+        self, inputs: BaseMessageContent, plans: Iterable[CodeInterpreterPlan]
+    ) -> CodeInterpreterIntermediateResult:
+        """
+        plannerのstreamから届いたplanを順にタスクにして、依存するタスクが終わっていればすぐに実行する
+        """
+        if not settings.CREW_DAG_ENABLED:
+            plan_list = CodeInterpreterPlanList(reliability=0, agent_task_list=list(plans))
+            return self.run(inputs, plan_list)
+
+        last_input, final_goal = self.get_final_goal(inputs)
+        task_graph = CrewTaskGraph()
+        crew_output: CrewOutput = task_graph.run_stream(self.iter_tasks(task_graph, final_goal, plans))
+        result = self.convert_to_CodeInterpreterIntermediateResult(crew_output)
+        if result is None:
+            result = self.llm_convert_to_CodeInterpreterIntermediateResult(crew_output, last_input, final_goal)
+        return result
+
+    async def arun_stream(
+        self, inputs: BaseMessageContent, plans: AsyncIterable[CodeInterpreterPlan]
+    ) -> CodeInterpreterIntermediateResult:
+        if not settings.CREW_DAG_ENABLED:
+            plan_list = CodeInterpreterPlanList(reliability=0, agent_task_list=[plan async for plan in plans])
+            return await self.arun(inputs, plan_list)
+
+        last_input, final_goal = self.get_final_goal(inputs)
+        task_graph = CrewTaskGraph()
+        crew_output: CrewOutput = await task_graph.arun_stream(self.aiter_tasks(task_graph, final_goal, plans))
+        result = self.convert_to_CodeInterpreterIntermediateResult(crew_output)
+        if result is None:
+            result = await self.allm_convert_to_CodeInterpreterIntermediateResult(crew_output, last_input, final_goal)
+        return result
+
+    @staticmethod
+    def convert_to_CodeInterpreterIntermediateResult(
+        crew_output: CrewOutput,
+    ) -> Optional[CodeInterpreterIntermediateResult]:
+        """llmを使わずに変換する。確からしさが低い場合はNoneを返す"""
+        output, confidence = MultiConverter.to_CodeInterpreterIntermediateResult_with_confidence(crew_output)
+        if confidence >= settings.CONVERTER_LLM_FALLBACK_THRESHOLD:
+            return output
+        print(f"CodeInterpreterCrew convert low confidence={confidence}, fallback to llm")
+        return None
+
+    def _prepare_llm_convert(self, crew_output: CrewOutput, last_input: Dict, final_goal: str) -> Tuple[Runnable, Dict]:
         prompt_template = """
         CrewOutputクラスの内容をCodeInterpreterIntermediateResultクラスに詰め替えてください。
         作業目的を考慮して重要な情報から可能な限り詰めてください。
@@ -123,17 +234,29 @@ class CodeInterpreterCrew:
             input_variables=["final_goal", "agent_scratchpad", "crew_output"], template=prompt_template
         )
 
-        structured_llm = self.ci_params.llm.with_structured_output(
-            schema=CodeInterpreterIntermediateResult, include_raw=False
-        )
+        llm = CodeInterpreterLlm.with_cache(self.ci_params.llm, "converter")
+        structured_llm = llm.with_structured_output(schema=CodeInterpreterIntermediateResult, include_raw=False)
         runnable = prompt | structured_llm
 
         last_input["final_goal"] = final_goal
         last_input["agent_scratchpad"] = crew_output.raw
         last_input["crew_output"] = crew_output.tasks_output
+        return runnable, last_input
+
+    def llm_convert_to_CodeInterpreterIntermediateResult(
+        self, crew_output: CrewOutput, last_input: Dict, final_goal: str
+    ) -> CodeInterpreterIntermediateResult:
+        runnable, last_input = self._prepare_llm_convert(crew_output, last_input, final_goal)
         output = runnable.invoke(input=last_input)
         return output
 
+    async def allm_convert_to_CodeInterpreterIntermediateResult(
+        self, crew_output: CrewOutput, last_input: Dict, final_goal: str
+    ) -> CodeInterpreterIntermediateResult:
+        runnable, last_input = self._prepare_llm_convert(crew_output, last_input, final_goal)
+        output = await runnable.ainvoke(input=last_input)
+        return output
+
 
 def test():
     llm, llm_tools, runnable_config = prepare_test_llm()
@@ -146,7 +269,10 @@ def test():
         expected_output="設計書のmdファイル",
     )
     plan2 = CodeInterpreterPlan(
-        agent_name="code_write_agent", task_description="TestPrompt.python_input_str", expected_output="pythonコード"
+        agent_name="code_write_agent",
+        task_description="TestPrompt.python_input_str",
+        expected_output="pythonコード",
+        depends_on=[0],
     )
     plan_list = CodeInterpreterPlanList(reliability=80, agent_task_list=[plan1, plan2])
     result = CodeInterpreterCrew(ci_params).run(inputs, plan_list)
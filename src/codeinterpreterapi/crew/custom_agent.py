@@ -44,18 +44,21 @@ class CustomAgent(BaseAgent):
         # TODO: 直接dictを返せるようにcrewaiを直す？
 
         # AgentExecutorを使用してタスクを実行
-        input_dict = self.create_input_dict(task)
+        input_dict = self.create_input_dict(task, context)
         result = self.agent_executor.invoke(input=input_dict, config=self.ci_params.runnable_config)
         result_str = MultiConverter.to_str(result)
 
         # TODO: return full dict when crewai is updated
         return result_str
 
-    def create_input_dict(self, task: CrewTask) -> None:
+    def create_input_dict(self, task: CrewTask, context: Optional[str] = None) -> None:
         # This is interface crewai <=> langchain
         # Tools will be set by langchain layer.
         task_description = task.description
-        if task.context:
+        if context:
+            # 依存するタスクの出力(crewaiが集約したもの)
+            task_description += f"\n\n### コンテキスト\n{context}"
+        elif task.context:
             task_description += f"\n\n### コンテキスト\n{task.context}"
         if task.expected_output:
             task_description += f"\n\n### 出力形式\n{task.expected_output}"
@@ -0,0 +1,305 @@
+import asyncio
+import contextlib
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import AsyncIterable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from crewai import Task
+from crewai.crews.crew_output import CrewOutput
+from crewai.tasks.task_output import TaskOutput
+
+from codeinterpreterapi.config import settings
+from codeinterpreterapi.schema import CodeInterpreterPlan
+
+# crewaiのaggregate_raw_outputs_from_task_outputsと同じ区切り
+CONTEXT_DIVIDER = "\n\n----------\n\n"
+
+
+class CrewTaskGraph:
+    """
+    planのdepends_onから作ったDAGに従ってcrewaiのTaskを実行する
+
+    依存するタスクが全て終わったタスクから順に、最大max_concurrency個を並列に実行する。
+    同じagentのタスクはagent_executorと会話履歴(session_id)を共有するので、同時には1つしか実行しない。
+    各タスクには依存するタスクの出力をcontextとして渡す。
+    結果はCrew.kickoff()と同じくCrewOutputで返す(rawは他のタスクから依存されていない全てのタスクの出力を連結したもの)。
+    """
+
+    def __init__(
+        self, tasks: List[Task] = None, dependencies: List[List[int]] = None, max_concurrency: Optional[int] = None
+    ):
+        self.tasks = tasks or []
+        self.dependencies = dependencies or []
+        self.max_concurrency = max_concurrency or settings.CREW_MAX_CONCURRENCY
+        # add_planで追加したplan毎のタスクのindex(タスクを作らなかったplanはNone)と依存するタスクのindex
+        self.plan_task_indexes: List[Optional[int]] = []
+        self.plan_dependencies: List[List[int]] = []
+
+    @staticmethod
+    def resolve_dependencies(
+        plans: Sequence[CodeInterpreterPlan], task_indexes: List[Optional[int]]
+    ) -> List[List[int]]:
+        """
+        planのdepends_onをタスクのindexの依存関係に変換する
+
+        - depends_onがNoneなら直前のplanに依存する(従来の直列実行)
+        - 自分より後ろや範囲外のindexは無視する(循環しないことを保証する)
+        - task_indexes[i]がNoneのplan(agentが見つからずタスクを作らなかった)への依存は、そのplanの依存に置き換える
+        """
+        task_graph = CrewTaskGraph()
+        for plan, task_index in zip(plans, task_indexes):
+            task_graph.add_plan(plan, task_index is not None)
+        return [task_graph.plan_dependencies[i] for i, task_index in enumerate(task_indexes) if task_index is not None]
+
+    def add_plan(self, plan: CodeInterpreterPlan, has_task: bool) -> List[int]:
+        """
+        次のplanの依存関係を解決して、依存するタスクのindexを返す(タスクはadd_taskで追加する)
+        planは前のplanにしか依存しないので、plannerが出力した順に追加すればよい
+        """
+        i = len(self.plan_task_indexes)
+        if plan.depends_on is None:
+            depends_on = [i - 1] if i > 0 else []
+        else:
+            depends_on = [j for j in plan.depends_on if 0 <= j < i]
+            if len(depends_on) != len(plan.depends_on):
+                print(f"CrewTaskGraph ignore invalid depends_on={plan.depends_on} index={i}")
+
+        # タスクを作らなかったplanへの依存を展開する
+        resolved = []
+        for j in depends_on:
+            if self.plan_task_indexes[j] is not None:
+                resolved.append(self.plan_task_indexes[j])
+            else:
+                resolved.extend(self.plan_dependencies[j])
+        resolved = sorted(set(resolved))
+
+        task_count = len([j for j in self.plan_task_indexes if j is not None])
+        self.plan_task_indexes.append(task_count if has_task else None)
+        self.plan_dependencies.append(resolved)
+        return resolved
+
+    def add_task(self, task: Task, depends_on: List[int]) -> int:
+        self.tasks.append(task)
+        self.dependencies.append(depends_on)
+        return len(self.tasks) - 1
+
+    def run(self) -> CrewOutput:
+        return self.run_stream([])
+
+    def run_stream(self, task_iter: Iterable[Tuple[Task, List[int]]]) -> CrewOutput:
+        """
+        task_iterから(タスク, 依存するタスクのindex)を受け取りながら実行する
+
+        plannerのstreamからタスクを作るiteratorを渡すと、planの生成中に最初のタスクの実行を始められる。
+        task_iterは別スレッドで読むので、planの生成中にタスクが終わってもすぐに次のタスクを開始できる。
+        """
+        outputs: Dict[int, TaskOutput] = {}
+        running: Dict[Future, int] = {}
+        # ("task", index) / ("end", None) / ("error", 例外) / ("done", future)
+        events: queue.Queue = queue.Queue()
+
+        def read_tasks() -> None:
+            try:
+                for task, depends_on in task_iter:
+                    # iter_tasksは次のplanを読む前にタスクが追加されていることを前提にしているのでここで追加する
+                    events.put(("task", self.add_task(task, depends_on)))
+            except BaseException as e:
+                events.put(("error", e))
+                return
+            events.put(("end", None))
+
+        reader = threading.Thread(target=read_tasks, name="CrewTaskGraphReader", daemon=True)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="CrewTaskGraph") as executor:
+            reader.start()
+            task_count = 0
+            is_end = False
+            while not is_end or len(outputs) < task_count:
+                self._submit_ready(executor, running, outputs, task_count, events)
+                if is_end and not running:
+                    raise RuntimeError(f"CrewTaskGraph no runnable task dependencies={self.dependencies}")
+                event_type, value = events.get()
+                if event_type == "task":
+                    task_count = value + 1
+                elif event_type == "end":
+                    is_end = True
+                elif event_type == "error":
+                    raise value
+                else:
+                    i = running.pop(value)
+                    # 失敗したタスクがあればCrew.kickoff()と同じく例外をそのまま投げる(未開始のタスクは実行しない)
+                    outputs[i] = value.result()
+        return self._create_crew_output(outputs)
+
+    async def arun(self) -> CrewOutput:
+        futures: Dict[int, asyncio.Future] = {}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        agent_locks: Dict[int, asyncio.Lock] = {}
+        # 依存先は必ず前のタスクなので、前から順に作れば依存先のfutureは作成済み
+        for i in range(len(self.tasks)):
+            futures[i] = asyncio.ensure_future(self._arun_task(i, futures, semaphore, agent_locks))
+        return await self._agather(futures)
+
+    async def arun_stream(self, task_iter: AsyncIterable[Tuple[Task, List[int]]]) -> CrewOutput:
+        futures: Dict[int, asyncio.Future] = {}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        agent_locks: Dict[int, asyncio.Lock] = {}
+        try:
+            async for task, depends_on in task_iter:
+                i = self.add_task(task, depends_on)
+                futures[i] = asyncio.ensure_future(self._arun_task(i, futures, semaphore, agent_locks))
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
+        return await self._agather(futures)
+
+    async def _arun_task(
+        self,
+        i: int,
+        futures: Dict[int, asyncio.Future],
+        semaphore: asyncio.Semaphore,
+        agent_locks: Dict[int, asyncio.Lock],
+    ) -> TaskOutput:
+        dependency_outputs = {j: await futures[j] for j in self.dependencies[i]}
+        agent_key = self._get_agent_key(i)
+        agent_lock = agent_locks.setdefault(agent_key, asyncio.Lock()) if agent_key is not None else None
+        async with agent_lock or contextlib.nullcontext(), semaphore:
+            print(f"CrewTaskGraph start task={i} depends_on={self.dependencies[i]}")
+            return await asyncio.to_thread(self._execute_task, i, self._get_context(i, dependency_outputs))
+
+    async def _agather(self, futures: Dict[int, asyncio.Future]) -> CrewOutput:
+        try:
+            task_outputs = await asyncio.gather(*futures.values())
+        except BaseException:
+            for future in futures.values():
+                future.cancel()
+            raise
+        return self._create_crew_output(dict(enumerate(task_outputs)))
+
+    def _submit_ready(
+        self,
+        executor: ThreadPoolExecutor,
+        running: Dict[Future, int],
+        outputs: Dict[int, TaskOutput],
+        task_count: int,
+        events: queue.Queue,
+    ) -> None:
+        for i in self._get_ready_indexes(outputs, running.values(), task_count):
+            print(f"CrewTaskGraph start task={i} depends_on={self.dependencies[i]}")
+            future = executor.submit(self._execute_task, i, self._get_context(i, outputs))
+            running[future] = i
+            future.add_done_callback(lambda done_future: events.put(("done", done_future)))
+
+    def _get_ready_indexes(
+        self, outputs: Dict[int, TaskOutput], running_indexes: Sequence[int], task_count: Optional[int] = None
+    ) -> List[int]:
+        """
+        依存するタスクが全て終わっていて、同じagentのタスクが実行中でないタスクのindex(task_count個目まで)
+        """
+        running_indexes = set(running_indexes)
+        busy_agent_keys = {self._get_agent_key(i) for i in running_indexes} - {None}
+        ready_indexes = []
+        task_count = len(self.tasks) if task_count is None else task_count
+        for i, depends_on in enumerate(self.dependencies[:task_count]):
+            if i in outputs or i in running_indexes:
+                continue
+            agent_key = self._get_agent_key(i)
+            if agent_key in busy_agent_keys:
+                continue
+            if all(j in outputs for j in depends_on):
+                ready_indexes.append(i)
+                if agent_key is not None:
+                    busy_agent_keys.add(agent_key)
+        return ready_indexes
+
+    def _get_agent_key(self, i: int) -> Optional[int]:
+        agent = getattr(self.tasks[i], "agent", None)
+        return id(agent) if agent is not None else None
+
+    def _get_sink_indexes(self) -> List[int]:
+        """他のタスクから依存されていないタスクのindex"""
+        dependency_indexes = {j for depends_on in self.dependencies for j in depends_on}
+        return [i for i in range(len(self.tasks)) if i not in dependency_indexes]
+
+    def _get_context(self, i: int, outputs: Dict[int, TaskOutput]) -> str:
+        return CONTEXT_DIVIDER.join(outputs[j].raw for j in self.dependencies[i])
+
+    def _execute_task(self, i: int, context: str) -> TaskOutput:
+        return self.tasks[i].execute_sync(context=context)
+
+    def _create_crew_output(self, outputs: Dict[int, TaskOutput]) -> CrewOutput:
+        tasks_output = [outputs[i] for i in range(len(self.tasks))]
+        if not tasks_output:
+            return CrewOutput(raw="", tasks_output=[])
+        sink_outputs = [outputs[i] for i in self._get_sink_indexes()]
+        if len(sink_outputs) == 1:
+            final_output = sink_outputs[0]
+            return CrewOutput(
+                raw=final_output.raw,
+                pydantic=final_output.pydantic,
+                json_dict=final_output.json_dict,
+                tasks_output=tasks_output,
+            )
+        # 独立した最終タスクが複数ある(例: 実装とテストケース作成)ので全ての出力を連結する
+        return CrewOutput(raw=CONTEXT_DIVIDER.join(output.raw for output in sink_outputs), tasks_output=tasks_output)
+
+
+def test():
+    plans = [
+        CodeInterpreterPlan(agent_name="design", task_description="", expected_output=""),
+        CodeInterpreterPlan(agent_name="unknown", task_description="", expected_output="", depends_on=[0]),
+        CodeInterpreterPlan(agent_name="test_case", task_description="", expected_output="", depends_on=[]),
+        CodeInterpreterPlan(agent_name="code", task_description="", expected_output="", depends_on=[1, 2, 5]),
+        CodeInterpreterPlan(agent_name="review", task_description="", expected_output=""),
+    ]
+    dependencies = CrewTaskGraph.resolve_dependencies(plans, [0, None, 1, 2, 3])
+    print("dependencies=", dependencies)
+    assert dependencies == [[], [], [0, 1], [2]]
+
+    class DummyTask:
+        def __init__(self, name: str):
+            self.name = name
+
+        def execute_sync(self, context: str) -> TaskOutput:
+            return TaskOutput(description=self.name, raw=f"{self.name}({context})", agent=self.name)
+
+    def task_iter():
+        task_graph.add_plan(plans[0], True)
+        yield DummyTask("design"), []
+        yield DummyTask("code"), task_graph.add_plan(plans[2], True)
+
+    task_graph = CrewTaskGraph()
+    crew_output = task_graph.run_stream(task_iter())
+    print("crew_output.raw=", crew_output.raw)
+
+    # planの生成中(次のplanを待っている間)でも依存するタスクが終わったタスクは開始される
+    code_started = threading.Event()
+
+    class EventTask(DummyTask):
+        def execute_sync(self, context: str) -> TaskOutput:
+            code_started.set()
+            return super().execute_sync(context)
+
+    def slow_task_iter():
+        yield DummyTask("design"), []
+        yield EventTask("code"), [0]
+        assert code_started.wait(5)
+        yield DummyTask("review"), [1]
+
+    crew_output = CrewTaskGraph().run_stream(slow_task_iter())
+    print("crew_output.raw=", crew_output.raw)
+
+    # 依存されていないタスク(code, test_case)の出力は両方rawに入る
+    agent = object()
+    task_graph = CrewTaskGraph([DummyTask("design"), DummyTask("code"), DummyTask("test_case")], [[], [0], [0]])
+    task_graph.tasks[1].agent = agent
+    task_graph.tasks[2].agent = agent
+    assert task_graph._get_ready_indexes({0: None}, []) == [1]
+    crew_output = asyncio.run(task_graph.arun())
+    print("crew_output.raw=", crew_output.raw)
+    assert crew_output.raw == "code(design())" + CONTEXT_DIVIDER + "test_case(design())"
+
+
+if __name__ == "__main__":
+    test()
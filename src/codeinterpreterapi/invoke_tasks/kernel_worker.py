@@ -0,0 +1,154 @@
+"""
+PythonToolsから利用する常駐型のPythonワーカー(kernel)
+
+標準入力から1行1リクエストのJSONを受け取り、同じ名前空間でコードを実行して
+結果を1行1レスポンスのJSONで返す。変数やimport済みモジュールは実行間で保持される。
+ユーザのコードやサブプロセスからはstdinは/dev/nullに見える(リクエストを読んでしまわないように)。
+
+request:  {"code": "...", "filename": "...", "cwd": "..."} または {"path": "/abs/path/main.py", "cwd": "..."}
+response: {"exitcode": 0, "stdout": "...", "stderr": "..."}
+
+`python main.py`と同じく、実行するファイルのディレクトリをsys.pathの先頭に置く(隣のモジュールをimportできる)。
+サブプロセスやC拡張がfd=1/2に直接書き込んだ出力もリクエスト毎に一時ファイルで受け取ってレスポンスに含める。
+"""
+
+import contextlib
+import ctypes
+import io
+import json
+import os
+import sys
+import tempfile
+import traceback
+
+# 前のリクエストでsys.pathの先頭に追加したディレクトリ
+script_dir = None
+
+
+def open_protocol_stream():
+    # ユーザコードやサブプロセスがfd=1に書き込んでもプロトコルが壊れないように
+    # 元のstdoutを複製してプロトコル専用にし、fd=1はstderrに付け替える
+    protocol_stream = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return protocol_stream
+
+
+def open_request_stream():
+    # ユーザコードのinput()やサブプロセスが次のリクエストを読んでしまわないように
+    # 元のstdinを複製してプロトコル専用にし、fd=0は/dev/nullに付け替える
+    request_stream = os.fdopen(os.dup(sys.stdin.fileno()), "r", encoding="utf-8")
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, sys.stdin.fileno())
+    os.close(devnull)
+    return request_stream
+
+
+def set_script_dir(filename):
+    global script_dir
+    if script_dir is not None and sys.path and sys.path[0] == script_dir:
+        del sys.path[0]
+    script_dir = None
+    if os.path.isfile(filename):
+        script_dir = os.path.dirname(os.path.abspath(filename))
+        sys.path.insert(0, script_dir)
+
+
+def flush_c_stdio():
+    # C拡張がprintfしたバッファを一時ファイルに書き出す
+    try:
+        ctypes.CDLL(None).fflush(None)
+    except (OSError, AttributeError):
+        pass
+
+
+@contextlib.contextmanager
+def capture_fds(fd_stdout, fd_stderr):
+    """
+    fd=1/2を一時ファイルに付け替えて、サブプロセスやC拡張の出力を受け取る
+    """
+    saved_fds = [os.dup(1), os.dup(2)]
+    try:
+        os.dup2(fd_stdout.fileno(), 1)
+        os.dup2(fd_stderr.fileno(), 2)
+        yield
+    finally:
+        flush_c_stdio()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        for fd in saved_fds:
+            os.close(fd)
+
+
+def read_captured(f):
+    f.seek(0)
+    return f.read().decode("utf-8", errors="replace")
+
+
+def execute(request, namespace):
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    exitcode = 0
+    if "path" in request:
+        filename = request["path"]
+        with open(filename, "r", encoding="utf-8") as f:
+            code = f.read()
+    else:
+        filename = request.get("filename") or "<kernel>"
+        code = request["code"]
+
+    cwd = request.get("cwd")
+    if cwd and os.path.isdir(cwd):
+        os.chdir(cwd)
+    set_script_dir(filename)
+    namespace["__file__"] = filename
+    with tempfile.TemporaryFile() as fd_stdout, tempfile.TemporaryFile() as fd_stderr:
+        with capture_fds(fd_stdout, fd_stderr):
+            exitcode = run_code(code, filename, namespace, stdout, stderr)
+        # fdに直接書かれた出力はPythonのprintの後ろに付ける
+        return {
+            "exitcode": exitcode,
+            "stdout": stdout.getvalue() + read_captured(fd_stdout),
+            "stderr": stderr.getvalue() + read_captured(fd_stderr),
+        }
+
+
+def run_code(code, filename, namespace, stdout, stderr):
+    exitcode = 0
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            exec(compile(code, filename, "exec"), namespace)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                exitcode = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                exitcode = 1
+        except BaseException:
+            # ワーカー自身のフレームはユーザに見せない
+            etype, value, tb = sys.exc_info()
+            traceback.print_exception(etype, value, tb.tb_next)
+            exitcode = 1
+    return exitcode
+
+
+def main():
+    # sys.path[0]はこのファイルのディレクトリ(invoke_tasks)なので、ユーザのコードから見えないように外す
+    if sys.path and sys.path[0] == os.path.dirname(os.path.abspath(__file__)):
+        del sys.path[0]
+    protocol_stream = open_protocol_stream()
+    request_stream = open_request_stream()
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+
+    for line in request_stream:
+        if not line.strip():
+            continue
+        try:
+            response = execute(json.loads(line), namespace)
+        except Exception:
+            response = {"exitcode": 1, "stdout": "", "stderr": traceback.format_exc()}
+        protocol_stream.write(json.dumps(response) + "\n")
+        protocol_stream.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+
+def create_cache_key(prompt: str, llm_string: str) -> str:
+    # インデントや改行の違いでコードの意味が変わるので、前後の空白以外はそのまま使う
+    normalized_prompt = prompt.strip()
+    return hashlib.sha256(f"{normalized_prompt}\0{llm_string}".encode("utf-8")).hexdigest()
+
+
+class LlmCacheMetrics:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+        self.lock = threading.Lock()
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            hit_rate = self.hits / total if total else 0.0
+            return {"hits": self.hits, "misses": self.misses, "updates": self.updates, "hit_rate": hit_rate}
+
+
+class LruCacheBackend:
+    """
+    メモリ上のLRUキャッシュ(max_size件を超えたら古いものから捨てる、ttl秒で失効)
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self.items: "OrderedDict[str, Tuple[float, Sequence[Any]]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Sequence[Any]]:
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            created_at, value = item
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                del self.items[key]
+                self.evictions += 1
+                return None
+            self.items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Sequence[Any]) -> None:
+        with self.lock:
+            self.items[key] = (time.time(), value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class SqliteCacheBackend:
+    """
+    sqliteによるディスクキャッシュ(プロセスをまたいで再利用できる)
+
+    generationsはlangchain_core.load.dumpsでjsonにして保存する。
+    """
+
+    def __init__(self, path: str, max_size: int = 1000, ttl: Optional[float] = None):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self.lock = threading.Lock()
+        dirname = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirname, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+        self.conn.commit()
+
+    def get(self, key: str) -> Optional[Sequence[Any]]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl is not None and now - created_at > self.ttl:
+                self.conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self.conn.commit()
+                self.evictions += 1
+                return None
+            self.conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        try:
+            return loads(value)
+        except Exception as e:
+            print("SqliteCacheBackend loads error=", e)
+            return None
+
+    def set(self, key: str, value: Sequence[Any]) -> None:
+        now = time.time()
+        value_str = dumps(list(value))
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value_str, now, now),
+            )
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            if count > self.max_size:
+                self.conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY accessed_at ASC LIMIT ?)",
+                    (count - self.max_size,),
+                )
+                self.evictions += count - self.max_size
+            self.conn.commit()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.conn.execute("DELETE FROM llm_cache")
+            self.conn.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            (count,) = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        return count
+
+
+class CodeInterpreterLlmCache(BaseCache):
+    """
+    chat modelのcacheに設定するlangchainのBaseCache実装
+
+    backendは呼び出し箇所(call_site)間で共有し、hit/missは呼び出し箇所ごとに数える。
+    """
+
+    def __init__(self, backend: Any, call_site: str = ""):
+        self.backend = backend
+        self.call_site = call_site
+        self.metrics = LlmCacheMetrics()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        value = self.backend.get(create_cache_key(prompt, llm_string))
+        self.metrics.count("hits" if value is not None else "misses")
+        return value
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        self.backend.set(create_cache_key(prompt, llm_string), return_val)
+        self.metrics.count("updates")
+
+    def clear(self, **kwargs: Any) -> None:
+        self.backend.clear()
+
+
+def test():
+    backend = LruCacheBackend(max_size=2, ttl=60)
+    cache = CodeInterpreterLlmCache(backend, call_site="test")
+    assert cache.lookup("prompt  a", "llm") is None
+    cache.update("prompt a", "llm", ["generation a"])
+    cache.update("prompt b", "llm", ["generation b"])
+    cache.update("prompt c", "llm", ["generation c"])
+    assert cache.lookup("prompt  a", "llm") is None  # evicted
+    assert cache.lookup("prompt c\n", "llm") == ["generation c"]
+    print("metrics=", cache.metrics.to_dict(), "evictions=", backend.evictions)
+    assert backend.evictions == 1
+    # インデントだけが違うコードは別のpromptとして扱う
+    cache.update("if x:\n    y()\nz()", "llm", ["generation d"])
+    assert cache.lookup("if x:\n    y()\n    z()", "llm") is None
+
+
+if __name__ == "__main__":
+    test()
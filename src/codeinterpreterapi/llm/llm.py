@@ -1,3 +1,4 @@
+import threading
 from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 from dotenv import load_dotenv
@@ -8,7 +9,7 @@ from google.generativeai.types.content_types import ToolDict  # type: ignore[imp
 from google.generativeai.types.safety_types import HarmBlockThreshold, HarmCategory
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import BaseMessage
-from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables import Runnable, RunnableBinding, RunnableConfig, RunnableWithFallbacks
 from langchain_google_genai import ChatGoogleGenerativeAI  # type: ignore
 from langchain_google_genai._common import SafetySettingDict
 from langchain_google_genai._function_utils import _ToolConfigDict
@@ -16,6 +17,7 @@ from langchain_google_genai._function_utils import _ToolConfigDict
 from codeinterpreterapi.callbacks.markdown.callbacks import MarkdownFileCallbackHandler
 from codeinterpreterapi.callbacks.stdout.callbacks import FullOutCallbackHandler
 from codeinterpreterapi.config import settings
+from codeinterpreterapi.llm.cache import CodeInterpreterLlmCache, LruCacheBackend, SqliteCacheBackend
 
 
 class ChatGoogleGenerativeAIWrapper(ChatGoogleGenerativeAI):
@@ -44,20 +46,130 @@ class ChatGoogleGenerativeAIWrapper(ChatGoogleGenerativeAI):
 
 
 class CodeInterpreterLlm:
+    # プロセス全体で共有するLLMクライアント
+    # key: (provider, model, temperature, max_tokens, streaming)
+    _llm_registry: Dict[Tuple[str, str, float, int, bool], BaseChatModel] = {}
+    _llm_registry_lock = threading.Lock()
+    _openai_http_client: Optional[Any] = None
+    # レスポンスキャッシュ(backendは共有、call_siteごとにhit/missを数える)
+    _cache_backend: Optional[Any] = None
+    _caches: Dict[str, CodeInterpreterLlmCache] = {}
+
+    MAX_OUTPUT_TOKENS = 1024 * 4
+
     @classmethod
-    def get_llm(cls, model: str = settings.MODEL) -> BaseChatModel:
-        max_output_tokens = 1024 * 4
-        max_retries = 0
+    def get_llm(cls, model: str = settings.MODEL, streaming: bool = False) -> BaseChatModel:
+        """
+        streaming=Trueならinvoke()中もon_llm_new_tokenが発火する(OpenAI/Azure/Anthropicのみ)
+
+        同じ(provider, model, temperature, max_tokens, streaming)のクライアントはプロセス内で共有する。
+        """
+        provider = cls.get_provider(model)
+        temperature = 0.03 if provider == "azure" else settings.TEMPERATURE
+        if not settings.LLM_REGISTRY_ENABLED:
+            return cls._create_llm(provider, model, temperature, streaming)
+
+        key = (provider, model, temperature, cls.MAX_OUTPUT_TOKENS, streaming)
+        with cls._llm_registry_lock:
+            llm = cls._llm_registry.get(key)
+            if llm is None:
+                print("CodeInterpreterLlm create llm key=", key)
+                llm = cls._create_llm(provider, model, temperature, streaming)
+                cls._llm_registry[key] = llm
+            return llm
+
+    @classmethod
+    def clear_registry(cls) -> None:
+        with cls._llm_registry_lock:
+            cls._llm_registry.clear()
+
+    @classmethod
+    def with_cache(cls, llm: Runnable, call_site: str) -> Runnable:
+        """
+        call_siteがsettings.LLM_CACHE_CALL_SITESに含まれていればレスポンスキャッシュ付きのllmを返す
+
+        llmは共有されているのでコピーにcacheを設定する(with_fallbacks/with_configにも対応)。
+        """
+        if call_site not in settings.LLM_CACHE_CALL_SITES:
+            return llm
+        return cls._set_cache(llm, cls.get_cache(call_site))
+
+    @classmethod
+    def _set_cache(cls, llm: Runnable, cache: CodeInterpreterLlmCache) -> Runnable:
+        if isinstance(llm, BaseChatModel):
+            return llm.model_copy(update={"cache": cache})
+        if isinstance(llm, RunnableWithFallbacks):
+            return llm.model_copy(
+                update={
+                    "runnable": cls._set_cache(llm.runnable, cache),
+                    "fallbacks": [cls._set_cache(fallback, cache) for fallback in llm.fallbacks],
+                }
+            )
+        if isinstance(llm, RunnableBinding):
+            return llm.model_copy(update={"bound": cls._set_cache(llm.bound, cache)})
+        print("CodeInterpreterLlm with_cache unsupported type(llm)=", type(llm))
+        return llm
+
+    @classmethod
+    def get_cache(cls, call_site: str) -> CodeInterpreterLlmCache:
+        with cls._llm_registry_lock:
+            if cls._cache_backend is None:
+                if settings.LLM_CACHE_BACKEND == "sqlite":
+                    cls._cache_backend = SqliteCacheBackend(
+                        settings.LLM_CACHE_PATH, max_size=settings.LLM_CACHE_MAX_SIZE, ttl=settings.LLM_CACHE_TTL
+                    )
+                else:
+                    cls._cache_backend = LruCacheBackend(
+                        max_size=settings.LLM_CACHE_MAX_SIZE, ttl=settings.LLM_CACHE_TTL
+                    )
+            if call_site not in cls._caches:
+                cls._caches[call_site] = CodeInterpreterLlmCache(cls._cache_backend, call_site=call_site)
+            return cls._caches[call_site]
+
+    @classmethod
+    def get_cache_metrics(cls) -> Dict[str, Dict[str, Any]]:
+        with cls._llm_registry_lock:
+            metrics = {call_site: cache.metrics.to_dict() for call_site, cache in cls._caches.items()}
+            if cls._cache_backend is not None:
+                metrics["backend"] = {"size": len(cls._cache_backend), "evictions": cls._cache_backend.evictions}
+        return metrics
+
+    @staticmethod
+    def get_provider(model: str) -> str:
         if (
             settings.AZURE_OPENAI_API_KEY
             and settings.AZURE_API_BASE
             and settings.AZURE_API_VERSION
             and settings.AZURE_DEPLOYMENT_NAME
         ):
+            return "azure"
+        if settings.OPENAI_API_KEY:
+            return "openai"
+        if settings.GEMINI_API_KEY and "gemini" in model:
+            return "gemini"
+        if settings.ANTHROPIC_API_KEY and "claude" in model:
+            return "anthropic"
+        raise ValueError("Please set the API key for model=", model)
+
+    @classmethod
+    def _get_openai_http_client(cls) -> Any:
+        # OpenAI/Azureのクライアント間でコネクションプールを共有する(同期用のみ)
+        # httpxの非同期クライアントはevent loopをまたいで共有できないので各クライアントに任せる
+        if cls._openai_http_client is None:
+            from openai import DefaultHttpxClient
+
+            cls._openai_http_client = DefaultHttpxClient()
+        return cls._openai_http_client
+
+    @classmethod
+    def _create_llm(cls, provider: str, model: str, temperature: float, streaming: bool) -> BaseChatModel:
+        max_output_tokens = cls.MAX_OUTPUT_TOKENS
+        max_retries = 0
+        if provider == "azure":
             from langchain_openai import AzureChatOpenAI
 
             return AzureChatOpenAI(
-                temperature=0.03,
+                temperature=temperature,
                 base_url=settings.AZURE_API_BASE,
                 api_version=settings.AZURE_API_VERSION,
                 azure_deployment=settings.AZURE_DEPLOYMENT_NAME,
@@ -65,23 +177,25 @@ class CodeInterpreterLlm:
                 max_retries=settings.MAX_RETRY,
                 timeout=settings.REQUEST_TIMEOUT,
                 max_tokens=max_output_tokens,
+                streaming=streaming,
+                http_client=cls._get_openai_http_client(),
                 # max_retries=max_retries,
             )  # type: ignore
-        if settings.OPENAI_API_KEY:
+        if provider == "openai":
             from langchain_openai import ChatOpenAI
 
             return ChatOpenAI(
                 model=model,
                 api_key=settings.OPENAI_API_KEY,
                 timeout=settings.REQUEST_TIMEOUT,
-                temperature=settings.TEMPERATURE,
+                temperature=temperature,
                 max_retries=settings.MAX_RETRY,
                 max_tokens=max_output_tokens,
+                streaming=streaming,
+                http_client=cls._get_openai_http_client(),
                 # max_retries=max_retries,
             )  # type: ignore
-        if settings.GEMINI_API_KEY and "gemini" in model:
-            if "gemini" not in model:
-                print("Please set the gemini model in the settings.")
+        if provider == "gemini":
             # https://cloud.google.com/vertex-ai/generative-ai/docs/multimodal/configure-safety-attributes
             safety_settings = {
                 HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
@@ -91,57 +205,55 @@ class CodeInterpreterLlm:
             }
             return ChatGoogleGenerativeAIWrapper(
                 model=model,
-                temperature=settings.TEMPERATURE,
+                temperature=temperature,
                 google_api_key=settings.GEMINI_API_KEY,
                 max_output_tokens=max_output_tokens,
                 max_retries=max_retries,
                 safety_settings=safety_settings,
             )
-        if settings.ANTHROPIC_API_KEY and "claude" in model:
-            from langchain_anthropic import ChatAnthropic  # type: ignore
-
-            if "claude" not in model:
-                print("Please set the claude model in the settings.")
-            return ChatAnthropic(
-                model_name=model,
-                temperature=settings.TEMPERATURE,
-                anthropic_api_key=settings.ANTHROPIC_API_KEY,
-                max_tokens=max_output_tokens,
-                max_retries=max_retries,
-            )
-        raise ValueError("Please set the API key for model=", model)
+        # provider == "anthropic"
+        from langchain_anthropic import ChatAnthropic  # type: ignore
+
+        return ChatAnthropic(
+            model_name=model,
+            temperature=temperature,
+            anthropic_api_key=settings.ANTHROPIC_API_KEY,
+            max_tokens=max_output_tokens,
+            max_retries=max_retries,
+            streaming=streaming,
+        )
 
     @classmethod
-    def get_llm_lite(cls, model: str = settings.MODEL_LITE) -> BaseChatModel:
+    def get_llm_lite(cls, model: str = settings.MODEL_LITE, streaming: bool = False) -> BaseChatModel:
         print("get_llm_lite=", model)
-        return cls.get_llm(model=model)
+        return cls.get_llm(model=model, streaming=streaming)
 
     @classmethod
-    def get_llm_fast(cls, model: str = settings.MODEL_FAST) -> BaseChatModel:
+    def get_llm_fast(cls, model: str = settings.MODEL_FAST, streaming: bool = False) -> BaseChatModel:
         print("get_llm_fast=", model)
-        return cls.get_llm(model=model)
+        return cls.get_llm(model=model, streaming=streaming)
 
     @classmethod
-    def get_llm_smart(cls, model: str = settings.MODEL_SMART) -> BaseChatModel:
+    def get_llm_smart(cls, model: str = settings.MODEL_SMART, streaming: bool = False) -> BaseChatModel:
         print("get_llm_smart=", model)
-        return cls.get_llm(model=model)
+        return cls.get_llm(model=model, streaming=streaming)
 
     @classmethod
-    def get_llm_local(cls, model: str = settings.MODEL_LOCAL) -> BaseChatModel:
+    def get_llm_local(cls, model: str = settings.MODEL_LOCAL, streaming: bool = False) -> BaseChatModel:
         print("get_llm_local=", model)
-        return cls.get_llm(model=model)
+        return cls.get_llm(model=model, streaming=streaming)
 
     @classmethod
-    def get_llm_switcher(cls, model: str = settings.MODEL_LOCAL) -> Runnable:
-        llms = cls.get_llms(model)
+    def get_llm_switcher(cls, model: str = settings.MODEL_LOCAL, streaming: bool = False) -> Runnable:
+        llms = cls.get_llms(model, streaming=streaming)
         llm_switcher = llms[0]
         fallback_llms = llms[1:]
         llm_switcher = llm_switcher.with_fallbacks(fallback_llms)
         return llm_switcher
 
     @classmethod
-    def get_llm_switcher_tools(cls, model: str = settings.MODEL_LOCAL) -> Runnable:
-        llms = cls.get_llms(model)
+    def get_llm_switcher_tools(cls, model: str = settings.MODEL_LOCAL, streaming: bool = False) -> Runnable:
+        llms = cls.get_llms(model, streaming=streaming)
         llms_tools = []
         for llm in llms:
             if hasattr(llm, "bind_tools"):
@@ -153,11 +265,11 @@ class CodeInterpreterLlm:
         return llm_tools
 
     @classmethod
-    def get_llms(cls, model: str = settings.MODEL_LOCAL) -> List[BaseChatModel]:
+    def get_llms(cls, model: str = settings.MODEL_LOCAL, streaming: bool = False) -> List[BaseChatModel]:
         llms = []
-        llms.append(cls.get_llm(model))
-        llms.append(cls.get_llm_fast())
-        llms.append(cls.get_llm_smart())
+        llms.append(cls.get_llm(model, streaming=streaming))
+        llms.append(cls.get_llm_fast(streaming=streaming))
+        llms.append(cls.get_llm_smart(streaming=streaming))
         return llms
 
 
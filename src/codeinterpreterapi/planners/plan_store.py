@@ -0,0 +1,258 @@
+import difflib
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from codeinterpreterapi.config import settings
+from codeinterpreterapi.schema import CodeInterpreterPlanList
+
+
+class PlanStore:
+    """
+    成功した計画(CodeInterpreterPlanList)を依頼文ごとに保存して、同じような依頼でplannerを呼ばずに再利用する
+
+    - key: 正規化した依頼文とnamespace(作業ディレクトリと利用可能なagent名)のハッシュ。まず完全一致で探す
+    - matcherが"difflib"か"spacy"なら、完全一致が無い時に同じnamespaceの依頼文との類似度で探す
+    - reliabilityがmin_reliability未満の計画は保存しない
+    - min_chars未満の短い依頼(「続けて」など会話の文脈に依存するもの)は保存も再利用もしない
+    - 再利用した計画の実行に失敗したらremoveで削除する
+    再利用した計画の各タスクには新しい依頼文が最終的なゴールとして渡されるので、類似した依頼にもそのまま適用できる。
+    pathを指定するとjsonlに追記して、次回以降の実行(別プロセス)でも再利用する。
+    別の会話の計画を使い回すことになるので、PLAN_STORE_ENABLEDで明示的に有効にした時だけ使う。
+    """
+
+    _default: Optional["PlanStore"] = None
+    _default_lock = threading.Lock()
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_size: Optional[int] = None,
+        matcher: Optional[str] = None,
+        similarity_threshold: Optional[float] = None,
+        min_reliability: Optional[int] = None,
+        min_chars: Optional[int] = None,
+    ):
+        self.path = path
+        self.max_size = max_size or settings.PLAN_STORE_MAX_SIZE
+        self.matcher = matcher or settings.PLAN_STORE_MATCHER
+        self.similarity_threshold = (
+            settings.PLAN_STORE_SIMILARITY_THRESHOLD if similarity_threshold is None else similarity_threshold
+        )
+        self.min_reliability = settings.PLAN_STORE_MIN_RELIABILITY if min_reliability is None else min_reliability
+        self.min_chars = settings.PLAN_STORE_MIN_CHARS if min_chars is None else min_chars
+        # key => {"namespace", "text", "plan_list"}
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # key => spaCyのベクトル(matcher="spacy"の時だけ)
+        self.vectors: Dict[str, Any] = {}
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.skips = 0
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    @classmethod
+    def get_default(cls) -> "PlanStore":
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = PlanStore(path=settings.PLAN_STORE_PATH)
+            return cls._default
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """
+        全角半角、大文字小文字、空白、末尾の句読点の違いを吸収する
+        """
+        text = unicodedata.normalize("NFKC", text).lower()
+        text = re.sub(r"\s+", " ", text).strip()
+        return text.rstrip("。.!?！？ ")
+
+    @staticmethod
+    def create_namespace(agent_names: List[str], work_dir: str = "") -> str:
+        # 計画はagent名と作業ディレクトリのファイルを参照するので、どちらかが違えば別の計画として扱う
+        return json.dumps([work_dir, sorted(agent_names)], ensure_ascii=False)
+
+    @classmethod
+    def create_key(cls, text: str, namespace: str = "") -> str:
+        data = json.dumps([namespace, cls.normalize(text)], ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def is_storable(self, text: str) -> bool:
+        return len(self.normalize(text)) >= self.min_chars
+
+    def lookup(self, text: str, namespace: str = "") -> Optional[CodeInterpreterPlanList]:
+        if not self.is_storable(text):
+            return None
+        key = self.create_key(text, namespace)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return entry["plan_list"].model_copy(deep=True)
+        if self.matcher in ("difflib", "spacy"):
+            similar_key, similarity = self.find_similar(text, namespace)
+            if similar_key is not None and similarity >= self.similarity_threshold:
+                with self.lock:
+                    entry = self.entries.get(similar_key)
+                    if entry is not None:
+                        self.similar_hits += 1
+                        self.entries.move_to_end(similar_key)
+                        return entry["plan_list"].model_copy(deep=True)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def find_similar(self, text: str, namespace: str = "") -> Tuple[Optional[str], float]:
+        normalized_text = self.normalize(text)
+        with self.lock:
+            candidates = [
+                (key, entry["text"]) for key, entry in self.entries.items() if entry["namespace"] == namespace
+            ]
+        if not candidates:
+            return None, 0.0
+        if self.matcher == "spacy":
+            similarities = self.get_similarities_spacy(normalized_text, candidates)
+        else:
+            similarities = self.get_similarities_difflib(normalized_text, [text for _, text in candidates])
+        best_index = max(range(len(candidates)), key=lambda i: similarities[i])
+        return candidates[best_index][0], similarities[best_index]
+
+    @staticmethod
+    def get_similarities_difflib(text: str, candidates: List[str]) -> List[float]:
+        similarities = []
+        for candidate in candidates:
+            matcher = difflib.SequenceMatcher(None, text, candidate)
+            # quick_ratioは上限値なので、閾値に届かない候補はratioを計算しない
+            similarities.append(matcher.ratio() if matcher.quick_ratio() >= 0.5 else 0.0)
+        return similarities
+
+    def get_similarities_spacy(self, text: str, candidates: List[Tuple[str, str]]) -> List[float]:
+        # spaCyのモデルは大きいのでmatcher="spacy"の時だけ読み込む
+        from codeinterpreterapi.thoughts.checker import load_spacy_nlp
+
+        nlp = load_spacy_nlp()
+        actual = nlp(text)
+        similarities = []
+        for key, candidate in candidates:
+            with self.lock:
+                vector = self.vectors.get(key)
+            if vector is None:
+                # nlp()は遅いのでlockの外で計算する
+                vector = nlp(candidate)
+                with self.lock:
+                    # 計算中にremoveされたkeyのベクトルは残さない
+                    if key in self.entries:
+                        self.vectors[key] = vector
+            similarities.append(actual.similarity(vector))
+        return similarities
+
+    def put(self, text: str, plan_list: CodeInterpreterPlanList, namespace: str = "") -> bool:
+        """
+        計画を保存する。reliabilityが低い計画や空の計画は保存しない
+        """
+        if not self.is_storable(text) or not plan_list.agent_task_list or plan_list.reliability < self.min_reliability:
+            with self.lock:
+                self.skips += 1
+            return False
+        key = self.create_key(text, namespace)
+        entry = {"namespace": namespace, "text": self.normalize(text), "plan_list": plan_list.model_copy(deep=True)}
+        with self.lock:
+            self._set(key, entry)
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        item = {**entry, "key": key, "plan_list": plan_list.model_dump()}
+                        f.write(json.dumps(item, ensure_ascii=False) + "\n")
+                except OSError as e:
+                    print("PlanStore save error=", e)
+        return True
+
+    def remove(self, text: str, namespace: str = "") -> None:
+        """
+        完全一致の計画を削除する(類似で再利用した計画の失敗は元の依頼の計画を削除しない)
+        """
+        key = self.create_key(text, namespace)
+        with self.lock:
+            if self.entries.pop(key, None) is None:
+                return
+            self.vectors.pop(key, None)
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps({"key": key, "removed": True}) + "\n")
+                except OSError as e:
+                    print("PlanStore save error=", e)
+
+    def _set(self, key: str, entry: Dict[str, Any]) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self.vectors.pop(key, None)
+        while len(self.entries) > self.max_size:
+            removed_key, _ = self.entries.popitem(last=False)
+            self.vectors.pop(removed_key, None)
+
+    def load(self) -> None:
+        if not os.path.isfile(self.path):
+            return
+        with self.lock:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                        if item.get("removed"):
+                            self.entries.pop(item["key"], None)
+                            continue
+                        plan_list = CodeInterpreterPlanList.model_validate(item["plan_list"])
+                        entry = {"namespace": item["namespace"], "text": item["text"], "plan_list": plan_list}
+                        self._set(item["key"], entry)
+                    except (ValueError, KeyError):
+                        # 書き込み途中の行などは無視する
+                        continue
+
+    def metrics(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "skips": self.skips,
+            }
+
+
+def test():
+    from codeinterpreterapi.schema import CodeInterpreterPlan
+
+    plan = CodeInterpreterPlan(agent_name="code_write_agent", task_description="csvを集計する", expected_output="py")
+    plan_list = CodeInterpreterPlanList(reliability=80, agent_task_list=[plan])
+    namespace = PlanStore.create_namespace(["code_write_agent", "design_write_agent"], "/tmp")
+
+    store = PlanStore(matcher="exact", min_reliability=50, min_chars=5)
+    assert store.put("CSVを集計するプログラムを書いて。", plan_list, namespace)
+    assert store.lookup("  csvを集計するプログラムを書いて\n", namespace) is not None
+    assert store.lookup("csvを集計するプログラムを書いて", "other_agent") is None
+    other_work_dir = PlanStore.create_namespace(["code_write_agent", "design_write_agent"], "/app/work")
+    assert store.lookup("csvを集計するプログラムを書いて", other_work_dir) is None
+    assert store.lookup("csvの列をグラフにするプログラムを書いて", namespace) is None
+    assert not store.put("計画が不確かな依頼", CodeInterpreterPlanList(reliability=10, agent_task_list=[plan]))
+    assert not store.put("続けて", plan_list, namespace)
+    assert store.metrics()["skips"] == 2
+
+    store.matcher = "difflib"
+    store.similarity_threshold = 0.8
+    assert store.lookup("CSVを集計するプログラムを書いてください", namespace) is not None
+    store.remove("csvを集計するプログラムを書いて", namespace)
+    assert store.lookup("csvを集計するプログラムを書いて", namespace) is None
+    print("metrics=", store.metrics())
+
+
+if __name__ == "__main__":
+    test()
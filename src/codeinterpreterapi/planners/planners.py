@@ -14,8 +14,12 @@ from pydantic import BaseModel, Field
 from codeinterpreterapi.agents.agents import CodeInterpreterAgent
 from codeinterpreterapi.brain.params import CodeInterpreterParams
 from codeinterpreterapi.crew.crew_agent import CodeInterpreterCrew
-from codeinterpreterapi.llm.llm import prepare_test_llm
-from codeinterpreterapi.planners.prompts import create_planner_agent_chat_prompt, create_planner_agent_prompt
+from codeinterpreterapi.llm.llm import CodeInterpreterLlm, prepare_test_llm
+from codeinterpreterapi.planners.prompts import (
+    create_planner_agent_chat_prompt,
+    create_planner_agent_prompt,
+    create_planner_agent_stream_prompt,
+)
 from codeinterpreterapi.schema import CodeInterpreterPlan, CodeInterpreterPlanList
 from codeinterpreterapi.test_prompts.test_prompt import TestPrompt
 from codeinterpreterapi.utils.prompt import PromptUpdater
@@ -78,7 +82,8 @@ class CodeInterpreterPlanner:
 
         # structured_llm
         # structured_llm = ci_params.llm.bind_tools(tools=[CodeInterpreterPlanList]) # なぜか空のAgentPlanが生成される
-        structured_llm = ci_params.llm.with_structured_output(schema=CodeInterpreterPlanList, include_raw=False)
+        llm = CodeInterpreterLlm.with_cache(ci_params.llm, "planner")
+        structured_llm = llm.with_structured_output(schema=CodeInterpreterPlanList, include_raw=False)
 
         # parser(with_structured_outputのinclude_raw=Falseなら不要)
         # parser = CustomPydanticOutputParser(pydantic_object=CodeInterpreterPlanList)
@@ -93,7 +98,7 @@ class CodeInterpreterPlanner:
 
         # config
         if ci_params.runnable_config:
-            runnable = assign_runnable_history(runnable, ci_params.runnable_config)
+            runnable = assign_runnable_history(runnable, ci_params.runnable_config, ci_params.llm)
 
         # agent
         agent = RunnableAgent(runnable=runnable, input_keys=list(prompt.input_variables))
@@ -110,6 +115,21 @@ class CodeInterpreterPlanner:
         else:
             return runnable
 
+    @staticmethod
+    def choose_streaming_planner(ci_params: CodeInterpreterParams) -> Runnable:
+        """
+        計画(CodeInterpreterPlanList)のjsonをテキストでstreamするplannerを作る
+
+        with_structured_outputは出力が全て揃うまで結果を返さないので使わない。
+        出力はStreamingPlanParserでCodeInterpreterPlan毎に取り出す。
+        """
+        prompt = create_planner_agent_stream_prompt(ci_params.is_ja)
+        prompt = PromptUpdater.update_prompt(prompt, ci_params)
+        runnable = prompt | ci_params.llm
+        if ci_params.runnable_config:
+            runnable = runnable.with_config(ci_params.runnable_config)
+        return runnable
+
 
 def test():
     llm, llm_tools, runnable_config = prepare_test_llm()
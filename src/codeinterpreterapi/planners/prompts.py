@@ -14,6 +14,7 @@ SYSTEM_MESSAGE_TEMPLATE = '''
     - If the required agent for execution does not exist, answer with agent_name=None and answer about the required agent in the task_description.
     - Once sufficient information is obtained to complete the task, the final work plan should be output.
     - The last step should be agent_name=<END_OF_PLAN>.
+    - Set depends_on of each step to the indices (0-based) of the earlier steps whose results it uses. Use an empty list for steps that do not depend on earlier steps, so that they can run in parallel.
 '''
 
 SYSTEM_MESSAGE_TEMPLATE_JA = '''
@@ -36,6 +37,7 @@ SYSTEM_MESSAGE_TEMPLATE_JA = '''
     - 作業として何を求められているか正しく理解する。
     - AI agentの機能を正確に理解してから回答する。
     - 各ステップの入力と出力を明確にする。
+    - 各ステップが結果を利用する前のステップの番号(0始まり)をdepends_onに指定する。前のステップに依存しないステップは空のリストにする(並列に実行される)。
     - agent_infoに示されたagent_name以外のagentを利用しない。
     - 次の場合は計画を作成せずに長さ0のリストを返す。
       -- 利用可能なagentが不足している
@@ -78,3 +80,29 @@ def create_planner_agent_chat_prompt(is_ja: bool = True) -> ChatPromptTemplate:
             ]
         )
     return prompt
+
+
+STREAM_OUTPUT_FORMAT = """
+Output format:
+Output only one JSON object in the following format, without any other text.
+Output the steps in the order of execution.
+{{"reliability": <0-100>, "agent_task_list": [{{"agent_name": "...", "task_description": "...", "expected_output": "...", "depends_on": [...]}}, ...]}}
+"""
+
+STREAM_OUTPUT_FORMAT_JA = """
+# 出力形式
+次の形式のJSONオブジェクトを1つだけ出力してください。JSON以外の文章は出力しないでください。
+ステップは実行する順番に出力してください。
+{{"reliability": <0-100>, "agent_task_list": [{{"agent_name": "...", "task_description": "...", "expected_output": "...", "depends_on": [...]}}, ...]}}
+"""
+
+
+def create_planner_agent_stream_prompt(is_ja: bool = True) -> PromptTemplate:
+    """
+    計画をstreamで生成するためのprompt(with_structured_outputを使わずにjsonを直接出力させる)
+    """
+    if is_ja:
+        template = SYSTEM_MESSAGE_TEMPLATE_JA + "\n{input}\n" + STREAM_OUTPUT_FORMAT_JA
+    else:
+        template = SYSTEM_MESSAGE_TEMPLATE + "\n{input}\n" + STREAM_OUTPUT_FORMAT
+    return PromptTemplate(input_variables=["input", "agent_scratchpad", "agent_info"], template=template)
@@ -0,0 +1,181 @@
+import json
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from pydantic import ValidationError
+
+from codeinterpreterapi.schema import CodeInterpreterPlan, CodeInterpreterPlanList
+
+# 検証に失敗したplanのagent_name(どのagentとも一致しないのでタスクは作られない)
+INVALID_PLAN_AGENT_NAME = "<INVALID_PLAN>"
+
+
+class StreamingPlanParser:
+    """
+    plannerが生成中のjson(CodeInterpreterPlanList)から、CodeInterpreterPlanを完成した順に取り出す
+
+    {"reliability": 80, "agent_task_list": [{...}, {...}]} の形式で、
+    トップレベルのobject内の配列の要素のobjectが閉じた時点でCodeInterpreterPlanとしてパースする。
+    jsonの前後の文章やコードブロックの```は無視する。
+    """
+
+    def __init__(self):
+        self.buffer: List[str] = []
+        self.position = 0
+        self.started = False
+        self.finished = False
+        # トップレベルのobjectの範囲
+        self.json_start: Optional[int] = None
+        self.json_end: Optional[int] = None
+        # 開いているobject/配列の種類('{' or '[')
+        self.stack: List[str] = []
+        self.in_string = False
+        self.escape = False
+        self.plan_start: Optional[int] = None
+        self.plans: List[CodeInterpreterPlan] = []
+
+    def feed(self, text: str) -> List[CodeInterpreterPlan]:
+        """
+        textを追加して、新しく完成したplanを返す
+        """
+        new_plans = []
+        for c in text:
+            self.buffer.append(c)
+            plan = self._consume(c)
+            if plan is not None:
+                new_plans.append(plan)
+            self.position += 1
+        return new_plans
+
+    def _consume(self, c: str) -> Optional[CodeInterpreterPlan]:
+        if self.finished:
+            return None
+        if not self.started:
+            if c != "{":
+                return None
+            self.started = True
+            self.json_start = self.position
+        if self.in_string:
+            if self.escape:
+                self.escape = False
+            elif c == "\\":
+                self.escape = True
+            elif c == '"':
+                self.in_string = False
+            return None
+        if c == '"':
+            self.in_string = True
+        elif c in "{[":
+            if c == "{" and self.stack == ["{", "["]:
+                self.plan_start = self.position
+            self.stack.append(c)
+        elif c in "}]":
+            if self.stack:
+                self.stack.pop()
+            if not self.stack:
+                self.finished = True
+                self.json_end = self.position + 1
+            elif c == "}" and self.stack == ["{", "["] and self.plan_start is not None:
+                plan_json = "".join(self.buffer[self.plan_start : self.position + 1])
+                self.plan_start = None
+                return self._parse_plan(plan_json)
+        return None
+
+    def _parse_plan(self, plan_json: str) -> CodeInterpreterPlan:
+        try:
+            plan = CodeInterpreterPlan.model_validate_json(plan_json)
+        except ValidationError as e:
+            # depends_onはagent_task_listのindexなので、捨てずにagentが見つからないplanとして残す
+            print("StreamingPlanParser invalid plan error=", e)
+            plan = CodeInterpreterPlan(
+                agent_name=INVALID_PLAN_AGENT_NAME, task_description=plan_json, expected_output="", depends_on=[]
+            )
+        self.plans.append(plan)
+        return plan
+
+    def get_plan_list(self) -> CodeInterpreterPlanList:
+        """
+        全体のjsonからCodeInterpreterPlanListを作る(reliabilityが取れなければ0)
+        """
+        reliability = 0
+        if self.finished:
+            try:
+                plan_list_json = "".join(self.buffer[self.json_start : self.json_end])
+                reliability = int(json.loads(plan_list_json).get("reliability", 0))
+            except (ValueError, TypeError, AttributeError):
+                pass
+        return CodeInterpreterPlanList(reliability=reliability, agent_task_list=list(self.plans))
+
+    @staticmethod
+    def get_chunk_text(chunk: Any) -> str:
+        """
+        llmのstreamのchunk(AIMessageChunkやstr)からテキストを取り出す
+        """
+        if isinstance(chunk, str):
+            return chunk
+        content = getattr(chunk, "content", "")
+        if isinstance(content, str):
+            text = content
+        else:
+            # anthropicなどのcontent block形式
+            text = ""
+            for block in content:
+                if isinstance(block, str):
+                    text += block
+                elif isinstance(block, dict):
+                    text += block.get("text", "") or block.get("partial_json", "")
+        for tool_call_chunk in getattr(chunk, "tool_call_chunks", None) or []:
+            text += tool_call_chunk.get("args") or ""
+        return text
+
+    @classmethod
+    def iter_plans(
+        cls, chunks: Iterator[Any], parser: Optional["StreamingPlanParser"] = None
+    ) -> Iterator[CodeInterpreterPlan]:
+        parser = parser or cls()
+        for chunk in chunks:
+            yield from parser.feed(cls.get_chunk_text(chunk))
+
+    @classmethod
+    async def aiter_plans(
+        cls, chunks: AsyncIterator[Any], parser: Optional["StreamingPlanParser"] = None
+    ) -> AsyncIterator[CodeInterpreterPlan]:
+        parser = parser or cls()
+        async for chunk in chunks:
+            for plan in parser.feed(cls.get_chunk_text(chunk)):
+                yield plan
+
+
+def test():
+    plan_list_json = json.dumps(
+        {
+            "reliability": 80,
+            "agent_task_list": [
+                {"agent_name": "design_write_agent", "task_description": "設計 {x: [1]}", "expected_output": "md"},
+                {"agent_name": "broken_agent"},
+                {
+                    "agent_name": "code_write_agent",
+                    "task_description": "実装",
+                    "expected_output": "py",
+                    "depends_on": [0, 1],
+                },
+            ],
+        },
+        ensure_ascii=False,
+    )
+    text = "計画です。\n```json\n" + plan_list_json + "\n```"
+    parser = StreamingPlanParser()
+    plans = []
+    for i in range(0, len(text), 7):
+        new_plans = parser.feed(text[i : i + 7])
+        if new_plans:
+            print("position=", parser.position, "new_plans=", [plan.agent_name for plan in new_plans])
+        plans.extend(new_plans)
+    assert [plan.agent_name for plan in plans] == ["design_write_agent", INVALID_PLAN_AGENT_NAME, "code_write_agent"]
+    assert plans[2].depends_on == [0, 1]
+    plan_list = parser.get_plan_list()
+    assert plan_list.reliability == 80
+    assert len(plan_list.agent_task_list) == 3
+
+
+if __name__ == "__main__":
+    test()
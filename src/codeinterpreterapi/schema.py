@@ -213,6 +213,10 @@ class CodeInterpreterPlan(BaseModel):
     expected_output: str = Field(
         description="タスクの最終的な出力形式を明確に定義します。例えばjson/csvというフォーマットや、カラム名やサイズ情報です。"
     )
+    depends_on: Optional[List[int]] = Field(
+        default=None,
+        description="このタスクが結果を利用する前のタスクの番号(agent_task_listの0始まりのindex)のリストです。前のタスクに依存しない場合は空のリストにします(並列に実行されます)。省略すると直前のタスクに依存します。",
+    )
 
     def __str__(self) -> str:
         return self.__repr__()
@@ -222,6 +226,8 @@ class CodeInterpreterPlan(BaseModel):
         ret_str += f"<agent_name={self.agent_name}>\n"
         ret_str += f"<task_description={self.task_description}>\n"
         ret_str += f"<expected_output={self.expected_output}>\n"
+        if self.depends_on is not None:
+            ret_str += f"<depends_on={self.depends_on}>\n"
         return ret_str
 
 
@@ -1,9 +1,11 @@
+import asyncio
+import os
 import re
+import threading
 import traceback
 from types import TracebackType
-from typing import Any, AsyncGenerator, Dict, Iterator, List, Optional, Type
-from uuid import UUID
-import time
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Iterator, List, Optional, Type
+from uuid import UUID, uuid4
 
 
 from codeboxapi import CodeBox  # type: ignore
@@ -18,17 +20,22 @@ from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.chat_history import BaseChatMessageHistory
 from langchain_core.language_models import BaseLanguageModel
 from langchain_core.messages.base import BaseMessage
+from langchain_core.outputs import LLMResult
 from langchain_core.runnables import Runnable, RunnableConfig
 from langchain_core.tools import BaseTool
 
 from codeinterpreterapi.brain.brain import CodeInterpreterBrain
 from codeinterpreterapi.brain.params import CodeInterpreterParams
 from codeinterpreterapi.callbacks.markdown.callbacks import MarkdownFileCallbackHandler
+from codeinterpreterapi.callbacks.stream.channel import StreamChannel
+from codeinterpreterapi.callbacks.stream.events import StreamEvent, StreamEventType
+from codeinterpreterapi.callbacks.trace.callbacks import JsonlTraceCallbackHandler
 from codeinterpreterapi.chains import aremove_download_link
 from codeinterpreterapi.chat_history import CodeBoxChatMessageHistory
 from codeinterpreterapi.config import settings
 from codeinterpreterapi.llm.llm import CodeInterpreterLlm
 from codeinterpreterapi.schema import CodeInterpreterResponse, File, SessionStatus, UserRequest
+from codeinterpreterapi.tools.python_kernel import PythonKernelPool
 from codeinterpreterapi.utils.multi_converter import MultiConverter
 
 
@@ -44,19 +51,49 @@ def _handle_deprecated_kwargs(kwargs: dict) -> None:
 class AgentCallbackHandler(BaseCallbackHandler):
     """Base callback handler that can be used to handle callbacks from langchain."""
 
-    def __init__(self):
-        self.messages = []  # チェーン内の応答を格納
+    def __init__(self, stream_tokens: bool = False):
+        self.channel: Optional[StreamChannel] = None  # チェーン内の応答(StreamEvent)を格納
         self.complete = False  # チェーン終了フラグ
+        self.stream_tokens = stream_tokens  # Trueならトークン単位で流す(チェーン出力は流さない)
+        self.token_run_ids = set()  # トークンを流し始めたLLMのrun_id
 
-    def stream_responses(self):
+    def open_stream(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> StreamChannel:
         """
-        ポーリング的に応答をストリームするジェネレータ関数
+        新しいストリームを開始する。loopを指定した場合はastream_responses()で受け取る。
         """
-        while not self.complete or len(self.messages) > 0:
-            if self.messages:
-                yield self.messages.pop(0)  # メッセージを逐次取得
-            else:
-                time.sleep(0.5)  # メッセージがない場合の待機
+        self.channel = StreamChannel(loop=loop)
+        self.complete = False
+        self.token_run_ids.clear()
+        return self.channel
+
+    def close_stream(self) -> None:
+        """
+        ストリームを終了してconsumerを抜けさせる。brainの処理が全て終わった時に呼ぶ。
+        """
+        self.complete = True
+        if self.channel:
+            self.channel.close()
+
+    def _put(self, event: StreamEvent) -> None:
+        if self.channel:
+            self.channel.put(event)
+
+    def stream_responses(self) -> Iterator[StreamEvent]:
+        """
+        応答が届いたら即座にyieldするジェネレータ関数(close_stream()で終了)
+        """
+        if self.channel is None:
+            self.open_stream()
+        yield from self.channel
+
+    async def astream_responses(self) -> AsyncIterator[StreamEvent]:
+        """
+        stream_responses()の非同期版。open_stream(loop)で開いたストリームを読む。
+        """
+        if self.channel is None:
+            self.open_stream(loop=asyncio.get_running_loop())
+        async for item in self.channel:
+            yield item
 
     ### on_chain callbacks ###
     def on_chain_start(
@@ -82,7 +119,6 @@ class AgentCallbackHandler(BaseCallbackHandler):
             kwargs (Any): Additional keyword arguments.
         """
         print("AgentCallbackHandler on_chain_start run_id=", run_id)
-        self.complete = False
 
     def on_chain_end(
         self,
@@ -100,8 +136,8 @@ class AgentCallbackHandler(BaseCallbackHandler):
             parent_run_id (UUID): The parent run ID. This is the ID of the parent run.
             kwargs (Any): Additional keyword arguments."""
         print("AgentCallbackHandler on_chain_end run_id=", run_id, ", type(outputs)=", type(outputs))
-        self.messages.append(outputs)  # 最終応答を格納
-        self.complete = True  # 終了フラグを設定
+        if not self.stream_tokens:
+            self._put(StreamEvent(type=StreamEventType.CHAIN_END, content=outputs))  # 応答を格納
 
     def on_chain_error(
         self,
@@ -119,8 +155,7 @@ class AgentCallbackHandler(BaseCallbackHandler):
             parent_run_id (UUID): The parent run ID. This is the ID of the parent run.
             kwargs (Any): Additional keyword arguments."""
         print("AgentCallbackHandler on_chain_error")
-        self.messages.append(str(error))  # エラーを格納
-        self.complete = True  # 終了フラグを設定
+        self._put(StreamEvent(type=StreamEventType.ERROR, content=str(error)))  # エラーを格納
 
     ### on_chat callbacks ###
     def on_chat_model_start(
@@ -147,6 +182,44 @@ class AgentCallbackHandler(BaseCallbackHandler):
         """
         print("AgentCallbackHandler on_chat_model_start")
 
+    def on_llm_new_token(
+        self,
+        token: str,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """Run on new LLM token. Only available when streaming is enabled.
+
+        Args:
+            token (str): The new token.
+            run_id (UUID): The run ID. This is the ID of the current run.
+            parent_run_id (UUID): The parent run ID. This is the ID of the parent run.
+            kwargs (Any): Additional keyword arguments."""
+        if not self.stream_tokens or not token:
+            return
+        start = run_id not in self.token_run_ids
+        self.token_run_ids.add(run_id)
+        self._put(StreamEvent(type=StreamEventType.TOKEN, content=token, start=start))
+
+    def on_llm_end(
+        self,
+        response: LLMResult,
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> Any:
+        """Run when LLM ends running.
+
+        Args:
+            response (LLMResult): The response which was generated.
+            run_id (UUID): The run ID. This is the ID of the current run.
+            parent_run_id (UUID): The parent run ID. This is the ID of the parent run.
+            kwargs (Any): Additional keyword arguments."""
+        self.token_run_ids.discard(run_id)
+
     ### on_agent callbacks ###
 
     def on_agent_action(
@@ -209,6 +282,8 @@ class AgentCallbackHandler(BaseCallbackHandler):
             kwargs (Any): Additional keyword arguments.
         """
         print("AgentCallbackHandler on_tool_start")
+        name = serialized.get("name", "") if serialized else ""
+        self._put(StreamEvent(type=StreamEventType.TOOL_START, content=input_str, name=name, start=True))
 
     def on_tool_end(
         self,
@@ -226,6 +301,7 @@ class AgentCallbackHandler(BaseCallbackHandler):
             parent_run_id (UUID): The parent run ID. This is the ID of the parent run.
             kwargs (Any): Additional keyword arguments."""
         print("AgentCallbackHandler on_tool_end")
+        self._put(StreamEvent(type=StreamEventType.TOOL_END, content=output, name=kwargs.get("name", "")))
 
     def on_tool_error(
         self,
@@ -258,21 +334,32 @@ class CodeInterpreterSession:
             additional_tools = []
         _handle_deprecated_kwargs(kwargs)
         self.verbose = kwargs.get("verbose", settings.DEBUG)
-        self.agent_callback_handler = AgentCallbackHandler()
-        llm_lite: BaseLanguageModel = CodeInterpreterLlm.get_llm_lite()
-        llm_fast: BaseLanguageModel = CodeInterpreterLlm.get_llm_fast()
-        llm_smart: BaseLanguageModel = CodeInterpreterLlm.get_llm_smart()
-        llm_local: BaseLanguageModel = CodeInterpreterLlm.get_llm_local()
-        llm: Runnable = CodeInterpreterLlm.get_llm_switcher()
-        llm_tools: Runnable = CodeInterpreterLlm.get_llm_switcher_tools()
+        stream_tokens = kwargs.get("stream_tokens", settings.STREAM_TOKENS)
+        self.agent_callback_handler = AgentCallbackHandler(stream_tokens=stream_tokens)
+        llm_lite: BaseLanguageModel = CodeInterpreterLlm.get_llm_lite(streaming=stream_tokens)
+        llm_fast: BaseLanguageModel = CodeInterpreterLlm.get_llm_fast(streaming=stream_tokens)
+        llm_smart: BaseLanguageModel = CodeInterpreterLlm.get_llm_smart(streaming=stream_tokens)
+        llm_local: BaseLanguageModel = CodeInterpreterLlm.get_llm_local(streaming=stream_tokens)
+        llm: Runnable = CodeInterpreterLlm.get_llm_switcher(streaming=stream_tokens)
+        llm_tools: Runnable = CodeInterpreterLlm.get_llm_switcher_tools(streaming=stream_tokens)
+
+        # セッション毎にトレースを分ける(同じプロセスで複数セッションを動かしてもログが混ざらない)
+        init_session_id: UUID = kwargs.get("session_id") or uuid4()
+        self.log_callback_handlers: list[BaseCallbackHandler] = []
+        if settings.TRACE_ENABLED:
+            self.log_callback_handlers.append(JsonlTraceCallbackHandler(str(init_session_id)))
+        if settings.MARKDOWN_LOG_ENABLED:
+            os.makedirs(settings.TRACE_DIR, exist_ok=True)
+            markdown_path = os.path.join(settings.TRACE_DIR, f"{init_session_id}.md")
+            self.log_callback_handlers.append(MarkdownFileCallbackHandler(markdown_path))
+        # _history_backend()で作ったhistory(stop時に書き込み待ちのメッセージをflushする)
+        self.chat_histories: list[BaseChatMessageHistory] = []
 
         # runnable_config
-        init_session_id = "12345678-1234-1234-1234-123456789abc"
-        configurable = {"session_id": init_session_id}  # TODO: set session_id
+        configurable = {"session_id": str(init_session_id)}
         runnable_config = RunnableConfig(
             configurable=configurable,
-            # callbacks=[],
-            callbacks=[self.agent_callback_handler, MarkdownFileCallbackHandler("langchain_log.md")],
+            callbacks=[self.agent_callback_handler, *self.log_callback_handlers],
         )
 
         # ci_params = {}
@@ -290,7 +377,7 @@ class CodeInterpreterSession:
             is_ja=is_ja,
             runnable_config=runnable_config,
         )
-        self.ci_params.session_id = UUID(init_session_id)
+        self.ci_params.session_id = init_session_id
         self.brain = CodeInterpreterBrain(self.ci_params)
         self.log("llm=" + str(llm))
 
@@ -300,9 +387,8 @@ class CodeInterpreterSession:
 
     @classmethod
     def from_id(cls, session_id: UUID, **kwargs: Any) -> "CodeInterpreterSession":
-        session = cls(**kwargs)
+        session = cls(session_id=session_id, **kwargs)
         session.ci_params.codebox = CodeBox.from_id(session_id)
-        session.ci_params.session_id = session_id
         return session
 
     @property
@@ -317,7 +403,6 @@ class CodeInterpreterSession:
             self.ci_params.codebox.run(
                 f"!pip install -q {' '.join(settings.CUSTOM_PACKAGES)}",
             )
-        self.brain.initialize()
         return SessionStatus.from_codebox_status(codebox_status)
 
     async def astart(self) -> SessionStatus:
@@ -328,13 +413,11 @@ class CodeInterpreterSession:
             self.ci_params.codebox.arun(
                 f"!pip install -q {' '.join(settings.CUSTOM_PACKAGES)}",
             )
-        self.brain.initialize()
         return SessionStatus.from_codebox_status(codebox_status)
 
     def start_local(self) -> SessionStatus:
         # TODO: delete it and use start()
         print("start_local")
-        self.brain.initialize()
         status = SessionStatus(status="started")
         return status
 
@@ -342,11 +425,10 @@ class CodeInterpreterSession:
         # TODO: delete it and use astart()
         print("astart_local")
         status = self.start_local()
-        self.brain.initialize()
         return status
 
     def _history_backend(self) -> BaseChatMessageHistory:
-        return (
+        history = (
             CodeBoxChatMessageHistory(codebox=self.ci_params.codebox)
             if settings.HISTORY_BACKEND == "codebox"
             else (
@@ -365,6 +447,18 @@ class CodeInterpreterSession:
                 )
             )
         )
+        self.chat_histories.append(history)
+        return history
+
+    def flush_chat_histories(self) -> None:
+        for history in self.chat_histories:
+            if isinstance(history, CodeBoxChatMessageHistory):
+                history.flush()
+
+    async def aflush_chat_histories(self) -> None:
+        for history in self.chat_histories:
+            if isinstance(history, CodeBoxChatMessageHistory):
+                await history.aflush()
 
     def _input_message_prepare(self, request: UserRequest) -> None:
         # set return input_message
@@ -507,6 +601,24 @@ class CodeInterpreterSession:
         response = CodeInterpreterResponse(content=final_response, files=output_files, code_log=code_log)
         return response
 
+    def _stream_event_to_response(self, event: StreamEvent) -> Optional[CodeInterpreterResponse]:
+        """
+        トークン/ツールのイベントをCodeInterpreterResponseのチャンクに変換する。
+        チェーン出力とエラーはNoneを返すので呼び出し側で_output_handlerに通す。
+        """
+        agent_name = self.brain.current_agent
+        if event.type == StreamEventType.TOKEN:
+            return CodeInterpreterResponse(content=event.content, start=event.start, agent_name=agent_name)
+        if event.type == StreamEventType.TOOL_START:
+            return CodeInterpreterResponse(
+                content="", start=True, agent_name=agent_name, thought=f"{event.name}: {event.content}"
+            )
+        if event.type == StreamEventType.TOOL_END:
+            return CodeInterpreterResponse(
+                content=MultiConverter.to_str(event.content), agent_name=agent_name, thought=event.name
+            )
+        return None
+
     def generate_response_sync(
         self,
         user_msg: BaseMessageContent,
@@ -593,27 +705,36 @@ class CodeInterpreterSession:
         user_request = UserRequest(content=user_msg, files=files)
         try:
             input_message = self._input_handler(user_request)
-            # ======= ↓↓↓↓ LLM invoke ↓↓↓↓ #=======
-            response_stream = self.brain.stream(input=input_message)
-            # ======= ↑↑↑↑ LLM invoke ↑↑↑↑ #=======
-            print("generate_response_stream type(response_stream)=", type(response_stream))
+            self.agent_callback_handler.open_stream()
+            brain_result = {}
+
+            def run_brain() -> None:
+                try:
+                    # ======= ↓↓↓↓ LLM invoke ↓↓↓↓ #=======
+                    brain_result["output"] = self.brain.invoke(input=input_message)
+                    # ======= ↑↑↑↑ LLM invoke ↑↑↑↑ #=======
+                except Exception as e:
+                    brain_result["error"] = e
+                finally:
+                    self.agent_callback_handler.close_stream()
+
+            brain_thread = threading.Thread(target=run_brain, daemon=True)
+            brain_thread.start()
 
             # wait for the stream_responses from agent
-            for stream_response in self.agent_callback_handler.stream_responses():
-                ci_response = self._output_handler(stream_response)
-                print("generate_response_stream ci_response(agent)=", type(stream_response))
+            for stream_event in self.agent_callback_handler.stream_responses():
+                ci_response = self._stream_event_to_response(stream_event)
+                if ci_response is None:
+                    print("generate_response_stream ci_response(agent)=", type(stream_event.content))
+                    ci_response = self._output_handler(stream_event.content)
                 yield ci_response
 
             # wait for the final response
-            for chunk in response_stream:
-                if isinstance(chunk, dict) and "output" in chunk:
-                    output = chunk["output"]
-                else:
-                    output = str(chunk)
-
-                print("generate_response_stream ci_response(output)=", type(chunk))
-                ci_response = self._output_handler(output)
-                yield ci_response
+            brain_thread.join()
+            if "error" in brain_result:
+                raise brain_result["error"]
+            print("generate_response_stream ci_response(output)=", type(brain_result["output"]))
+            yield self._output_handler(brain_result["output"])
 
         except Exception as e:
             if self.verbose:
@@ -639,16 +760,30 @@ class CodeInterpreterSession:
             files = []
         user_request = UserRequest(content=user_msg, files=files)
         try:
-            await self._ainput_handler(user_request)
+            input_message = await self._ainput_handler(user_request)
+            self.agent_callback_handler.open_stream(loop=asyncio.get_running_loop())
 
-            # ======= ↓↓↓↓ LLM invoke ↓↓↓↓ #=======
-            response = self.brain.astream(input=user_request.content)
-            # ======= ↑↑↑↑ LLM invoke ↑↑↑↑ #=======
+            async def arun_brain() -> Any:
+                try:
+                    # ======= ↓↓↓↓ LLM invoke ↓↓↓↓ #=======
+                    return await self.brain.ainvoke(input=input_message)
+                    # ======= ↑↑↑↑ LLM invoke ↑↑↑↑ #=======
+                finally:
+                    self.agent_callback_handler.close_stream()
+
+            brain_task = asyncio.create_task(arun_brain())
 
-            async for chunk in response:
-                print("agenerate_response_stream brain.astream chunk=", chunk)
-                ci_response: CodeInterpreterResponse = await self._aoutput_handler(chunk)
+            # wait for the stream_responses from agent
+            async for stream_event in self.agent_callback_handler.astream_responses():
+                ci_response = self._stream_event_to_response(stream_event)
+                if ci_response is None:
+                    print("agenerate_response_stream stream_response=", type(stream_event.content))
+                    ci_response = await self._aoutput_handler(stream_event.content)
                 yield ci_response
+
+            # wait for the final response
+            response = await brain_task
+            yield await self._aoutput_handler(response)
         except Exception as e:
             if self.verbose:
                 traceback.print_exc()
@@ -672,13 +807,38 @@ class CodeInterpreterSession:
         if self.verbose:
             print(msg)
 
+    def flush_logs(self) -> None:
+        for handler in self.log_callback_handlers:
+            handler.flush()
+
+    def close_logs(self) -> None:
+        """
+        書き込み待ちのログを書き込んでからファイルとwriterのスレッドを閉じる(2回目以降は何もしない)
+        """
+        handlers = self.log_callback_handlers
+        self.log_callback_handlers = []
+        for handler in handlers:
+            handler.flush()
+            handler.close()
+
+    def release_python_kernels(self) -> None:
+        # このセッションのPythonToolsが使っていたワーカーを終了する(次のセッションに変数などを引き継がない)
+        if self.ci_params.session_id:
+            PythonKernelPool.release_session(str(self.ci_params.session_id))
+
     def stop(self) -> SessionStatus:
+        self.flush_chat_histories()
+        self.close_logs()
+        self.release_python_kernels()
         codebox_status = CodeBoxStatus(status="unknown")
         if self.ci_params.codebox:
             codebox_status = self.ci_params.codebox.stop()
         return SessionStatus.from_codebox_status(codebox_status)
 
     async def astop(self) -> SessionStatus:
+        await self.aflush_chat_histories()
+        await asyncio.to_thread(self.close_logs)
+        await asyncio.to_thread(self.release_python_kernels)
         codebox_status = CodeBoxStatus(status="unknown")
         if self.ci_params.codebox:
             codebox_status = await self.ci_params.codebox.astop()
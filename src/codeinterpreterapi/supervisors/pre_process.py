@@ -0,0 +1,155 @@
+import hashlib
+import re
+import subprocess
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables.utils import Input
+
+from codeinterpreterapi.brain.params import CodeInterpreterParams
+from codeinterpreterapi.config import settings
+from codeinterpreterapi.tools.zoltraak import ZoltraakTools
+
+# 見出し、箇条書き、番号付きリスト、コードブロック、json/yamlのような構造化済みの入力
+STRUCTURED_PATTERN = re.compile(r"^\s*(#{1,6}\s|[-*+]\s|\d+[.)]\s|```|[{\[]|[\w-]+:\s)", re.MULTILINE)
+STRUCTURED_LINE_RATIO = 0.3
+
+
+class ZoltraakPreProcessor:
+    """
+    supervisorのplannerの前に行うzoltraakによる前処理
+
+    zoltraakは外部CLIを起動するので数秒以上かかる。次の場合は実行しない。
+    - settings.ZOLTRAAK_PRE_PROCESSが"never"
+    - "auto"で、入力が短い(ZOLTRAAK_PRE_PROCESS_MIN_CHARS未満)か既に構造化されている
+    結果は入力のハッシュでキャッシュする(プロセス内で共有)。
+    zoltraakの実行に失敗した場合は元の入力をそのまま使う。
+    """
+
+    _lock = threading.Lock()
+    # sha256(text) => 前処理結果
+    _cache: "OrderedDict[str, str]" = OrderedDict()
+    _executor: Optional[ThreadPoolExecutor] = None
+
+    def __init__(self, ci_params: CodeInterpreterParams):
+        self.ci_params = ci_params
+        self.prompt_template = PromptTemplate(
+            template="zoltraakによる前処理でinputを一般的な汎用言語表現に翻訳してください。: {input}",
+            input_variables=["input"],
+        )
+
+    @staticmethod
+    def get_text(input: Input) -> str:
+        if isinstance(input, dict):
+            for key in ("input", "content"):
+                if key in input:
+                    return str(input[key])
+        return str(input)
+
+    @staticmethod
+    def is_structured(text: str) -> bool:
+        lines = [line for line in text.splitlines() if line.strip()]
+        if not lines:
+            return False
+        structured_lines = sum(1 for line in lines if STRUCTURED_PATTERN.match(line))
+        return structured_lines / len(lines) >= STRUCTURED_LINE_RATIO
+
+    @classmethod
+    def should_pre_process(cls, text: str) -> bool:
+        mode = settings.ZOLTRAAK_PRE_PROCESS
+        if mode == "never":
+            return False
+        if mode == "always":
+            return True
+        if len(text) < settings.ZOLTRAAK_PRE_PROCESS_MIN_CHARS:
+            return False
+        return not cls.is_structured(text)
+
+    @staticmethod
+    def create_key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def get_cached(cls, text: str) -> Optional[str]:
+        key = cls.create_key(text)
+        with cls._lock:
+            result = cls._cache.get(key)
+            if result is not None:
+                cls._cache.move_to_end(key)
+            return result
+
+    @classmethod
+    def put_cached(cls, text: str, result: str) -> None:
+        with cls._lock:
+            cls._cache[cls.create_key(text)] = result
+            while len(cls._cache) > settings.ZOLTRAAK_PRE_PROCESS_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+
+    @classmethod
+    def get_executor(cls) -> ThreadPoolExecutor:
+        # 先読み(speculative)の前処理を実行するスレッド。呼び出し元がタイムアウトしても実行を続けて結果をキャッシュする
+        with cls._lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ZoltraakPreProcessor")
+            return cls._executor
+
+    def pre_process(self, text: str) -> str:
+        """
+        zoltraakで前処理したテキストを返す。失敗した場合は元のテキストを返す
+        """
+        cached_result = self.get_cached(text)
+        if cached_result is not None:
+            print("zoltraak_pre_process cache hit")
+            return cached_result
+
+        zoltraak_tools_instance = ZoltraakTools(ci_params=self.ci_params)
+        zoltraak_pre_process_input = self.prompt_template.format(input=text)
+        # 同時に実行される前処理(先読みや別のリクエスト)とmdファイルが衝突しないように呼び出し毎に名前を分ける
+        name = f"zoltraak_pre_process_{uuid.uuid4().hex}"
+        try:
+            zoltraak_pre_process_result = zoltraak_tools_instance.run_prompt(
+                zoltraak_pre_process_input, name, raise_on_error=True
+            )
+        except (subprocess.CalledProcessError, OSError) as e:
+            print("zoltraak_pre_process error=", e)
+            return text
+        finally:
+            ZoltraakTools.remove_md_files(name)
+        print("zoltraak_pre_process pre_processed_input=", zoltraak_pre_process_input)
+        print("zoltraak_pre_process_result pre_processed_input=", zoltraak_pre_process_result)
+        self.put_cached(text, zoltraak_pre_process_result)
+        return zoltraak_pre_process_result
+
+    @staticmethod
+    def replace_text(input: Input, text: str) -> Any:
+        """
+        前処理した結果で入力のテキストを置き換える(dictの場合は他のkeyを残す)
+        """
+        if isinstance(input, dict):
+            for key in ("input", "content"):
+                if key in input:
+                    return {**input, key: text}
+        return text
+
+
+def test():
+    assert not ZoltraakPreProcessor.should_pre_process("こんにちは")
+    structured_text = "# 要件\n- pythonでwebサーバを作る\n- ポートは8080\n" * 10
+    assert ZoltraakPreProcessor.is_structured(structured_text)
+    assert not ZoltraakPreProcessor.should_pre_process(structured_text)
+    plain_text = "シンプルなpythonのサンプルプログラムを書いてください。" * 10
+    assert ZoltraakPreProcessor.should_pre_process(plain_text)
+    ZoltraakPreProcessor.put_cached(plain_text, "result")
+    assert ZoltraakPreProcessor.get_cached(plain_text) == "result"
+    assert ZoltraakPreProcessor.replace_text({"input": "a", "agent_scratchpad": ""}, "b") == {
+        "input": "b",
+        "agent_scratchpad": "",
+    }
+
+
+if __name__ == "__main__":
+    test()
@@ -1,25 +1,32 @@
+import asyncio
 import getpass
+import itertools
 import os
 import platform
-from typing import Any, Dict
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
 
 from langchain.agents import AgentExecutor
 from pydantic import BaseModel, Field
 from langchain_core.runnables import Runnable
 from langchain_core.runnables.utils import Input
-from langchain_core.prompts import PromptTemplate
 
 from codeinterpreterapi.agents.agents import CodeInterpreterAgent
 from codeinterpreterapi.brain.params import CodeInterpreterParams
+from codeinterpreterapi.config import settings
 from codeinterpreterapi.crew.crew_agent import CodeInterpreterCrew
-from codeinterpreterapi.llm.llm import prepare_test_llm
+from codeinterpreterapi.llm.llm import CodeInterpreterLlm, prepare_test_llm
 from codeinterpreterapi.planners.planners import CodeInterpreterPlanner
-from codeinterpreterapi.schema import CodeInterpreterIntermediateResult, CodeInterpreterPlanList
+from codeinterpreterapi.planners.plan_store import PlanStore
+from codeinterpreterapi.planners.stream_parser import StreamingPlanParser
+from codeinterpreterapi.schema import CodeInterpreterIntermediateResult, CodeInterpreterPlan, CodeInterpreterPlanList
+from codeinterpreterapi.supervisors.pre_process import ZoltraakPreProcessor
 from codeinterpreterapi.supervisors.prompts import create_supervisor_agent_prompt
 from codeinterpreterapi.test_prompts.test_prompt import TestPrompt
 from codeinterpreterapi.utils.multi_converter import MultiConverter
 
-from codeinterpreterapi.tools.zoltraak import ZoltraakTools
+# agent、ツール、crewが失敗した時に結果の文字列に入るメッセージ
+ERROR_MARKERS = ("An error occurred", "Error in ", "Traceback (most recent call last)")
 
 
 class CodeInterpreterSupervisor:
@@ -28,6 +35,14 @@ class CodeInterpreterSupervisor:
         self.ci_params: CodeInterpreterParams = ci_params
         self.supervisor_chain = None
         self.supervisor_chain_no_agent = None
+        self.pre_processor = ZoltraakPreProcessor(ci_params)
+        self.streaming_planner = None
+        if settings.SUPERVISOR_STREAMING_PLAN:
+            self.streaming_planner = CodeInterpreterPlanner.choose_streaming_planner(ci_params)
+        self.plan_store = PlanStore.get_default() if settings.PLAN_STORE_ENABLED else None
+        self.plan_namespace = PlanStore.create_namespace(
+            [agent_def.agent_name for agent_def in ci_params.agent_def_list], settings.WORK_DIR
+        )
         self.initialize()
 
     def initialize(self) -> None:
@@ -59,7 +74,8 @@ class CodeInterpreterSupervisor:
         # agent
         # TODO: use RouteSchema to determine use crew or agent or agent executor
         # llm_with_structured_output = self.ci_params.llm.with_structured_output(RouteSchema)
-        runnable = prompt | self.ci_params.llm
+        llm = CodeInterpreterLlm.with_cache(self.ci_params.llm, "supervisor")
+        runnable = prompt | llm
 
         # config
         if self.ci_params.runnable_config:
@@ -71,7 +87,7 @@ class CodeInterpreterSupervisor:
         self.ci_params.supervisor_agent = runnable
 
         # supervisor_chain_no_agent
-        self.supervisor_chain_no_agent = self.ci_params.llm
+        self.supervisor_chain_no_agent = llm
 
     def get_executor(self) -> AgentExecutor:
         # TODO: use own executor(not crewai)
@@ -85,29 +101,194 @@ class CodeInterpreterSupervisor:
         # TODO: impl
         return self.supervisor_chain
 
-    def zoltraak_pre_process(self, input: Input) -> str:
-        prompt_template = PromptTemplate(
-            template="zoltraakによる前処理でinputを一般的な汎用言語表現に翻訳してください。: {input}",
-            input_variables=["input"],
+    def zoltraak_pre_process(self, input: Input) -> Input:
+        """
+        zoltraakで前処理したplannerへの入力を返す(前処理が不要な場合はinputをそのまま返す)
+        """
+        text = ZoltraakPreProcessor.get_text(input)
+        if not ZoltraakPreProcessor.should_pre_process(text):
+            print("zoltraak_pre_process skip")
+            return input
+        pre_processed_text = self.pre_processor.pre_process(text)
+        return ZoltraakPreProcessor.replace_text(input, pre_processed_text)
+
+    def _is_speculative(self, input: Input) -> bool:
+        # キャッシュ済みなら前処理はすぐ終わるので先読みしない
+        text = ZoltraakPreProcessor.get_text(input)
+        return (
+            settings.ZOLTRAAK_PRE_PROCESS_SPECULATIVE
+            and ZoltraakPreProcessor.should_pre_process(text)
+            and ZoltraakPreProcessor.get_cached(text) is None
         )
-        zoltraak_tools_instance = ZoltraakTools(ci_params=self.ci_params)
-        zoltraak_pre_process_input = prompt_template.format(input=str(input))
-        zoltraak_pre_process_result = zoltraak_tools_instance.run_prompt(
-            zoltraak_pre_process_input, "zoltraak_pre_process"
+
+    def plan(self, input: Input) -> Any:
+        """
+        前処理してからplannerを実行する
+
+        ZOLTRAAK_PRE_PROCESS_SPECULATIVEの場合は、元の入力でのplanと前処理後の入力でのplanを並列に実行する。
+        元の入力のplanが終わってからZOLTRAAK_PRE_PROCESS_WAIT秒以内に前処理後のplanが終われば前処理後の方を使う。
+        """
+        config = self.ci_params.runnable_config
+        if not self._is_speculative(input):
+            return self.planner.invoke(self.zoltraak_pre_process(input), config=config)
+
+        executor = ZoltraakPreProcessor.get_executor()
+        pre_processed_future = executor.submit(
+            lambda: self.planner.invoke(self.zoltraak_pre_process(input), config=config)
         )
-        print("zoltraak_pre_process pre_processed_input=", zoltraak_pre_process_input)
-        print("zoltraak_pre_process_result pre_processed_input=", zoltraak_pre_process_result)
-        return zoltraak_pre_process_result
+        planner_result = self.planner.invoke(input, config=config)
+        try:
+            return pre_processed_future.result(timeout=settings.ZOLTRAAK_PRE_PROCESS_WAIT)
+        except FuturesTimeoutError:
+            print("supervisor.plan use plan without zoltraak_pre_process (timeout)")
+        except Exception as e:
+            print("supervisor.plan use plan without zoltraak_pre_process error=", e)
+        return planner_result
 
-    def invoke(self, input: Input) -> CodeInterpreterIntermediateResult:
+    async def aplan(self, input: Input) -> Any:
+        config = self.ci_params.runnable_config
+        if not self._is_speculative(input):
+            # zoltraakは外部CLIを同期subprocessで実行するのでスレッドで待つ
+            pre_processed_input = await asyncio.to_thread(self.zoltraak_pre_process, input)
+            return await self.planner.ainvoke(pre_processed_input, config=config)
+
+        async def pre_processed_plan() -> Any:
+            pre_processed_input = await asyncio.to_thread(self.zoltraak_pre_process, input)
+            return await self.planner.ainvoke(pre_processed_input, config=config)
+
+        pre_processed_task = asyncio.ensure_future(pre_processed_plan())
+        # 待たずに返した場合も前処理結果はキャッシュされる。例外は回収だけしておく
+        pre_processed_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        planner_result = await self.planner.ainvoke(input, config=config)
+        try:
+            return await asyncio.wait_for(asyncio.shield(pre_processed_task), settings.ZOLTRAAK_PRE_PROCESS_WAIT)
+        except asyncio.TimeoutError:
+            print("supervisor.aplan use plan without zoltraak_pre_process (timeout)")
+        except Exception as e:
+            print("supervisor.aplan use plan without zoltraak_pre_process error=", e)
+        return planner_result
+
+    def lookup_plan(self, input: Input) -> Optional[CodeInterpreterPlanList]:
+        """
+        過去に成功した同じ(matcherによっては類似の)依頼の計画を返す
+        """
+        if self.plan_store is None:
+            return None
+        return self.plan_store.lookup(ZoltraakPreProcessor.get_text(input), self.plan_namespace)
+
+    @staticmethod
+    def is_error_result(result: CodeInterpreterIntermediateResult) -> bool:
+        """
+        agentやツールの失敗は例外ではなくエラーメッセージの文字列として返ってくるので、その文言で判定する
+        """
+        return any(marker in (result.context or "") for marker in ERROR_MARKERS)
+
+    def store_plan(
+        self, input: Input, plan_list: CodeInterpreterPlanList, result: CodeInterpreterIntermediateResult
+    ) -> None:
+        # crewの実行が成功した計画だけを保存する(前処理前の入力をkeyにするのでzoltraakも省略できる)
+        if self.plan_store is None:
+            return
+        if self.is_error_result(result):
+            print("supervisor.store_plan skip error result")
+            return
+        self.plan_store.put(ZoltraakPreProcessor.get_text(input), plan_list, self.plan_namespace)
+
+    def remove_plan_on_error(self, input: Input, result: CodeInterpreterIntermediateResult) -> None:
+        if self.is_error_result(result):
+            self.plan_store.remove(ZoltraakPreProcessor.get_text(input), self.plan_namespace)
+
+    def run_stored_plan(self, input: Input, plan_list: CodeInterpreterPlanList) -> CodeInterpreterIntermediateResult:
+        print("supervisor.run_stored_plan use crew_agent plan_list=", plan_list)
+        try:
+            result = self.ci_params.crew_agent.run(input, plan_list)
+        except Exception:
+            self.plan_store.remove(ZoltraakPreProcessor.get_text(input), self.plan_namespace)
+            raise
+        self.remove_plan_on_error(input, result)
+        return result
+
+    async def arun_stored_plan(
+        self, input: Input, plan_list: CodeInterpreterPlanList
+    ) -> CodeInterpreterIntermediateResult:
+        print("supervisor.arun_stored_plan use crew_agent plan_list=", plan_list)
+        try:
+            result = await self.ci_params.crew_agent.arun(input, plan_list)
+        except Exception:
+            self.plan_store.remove(ZoltraakPreProcessor.get_text(input), self.plan_namespace)
+            raise
+        self.remove_plan_on_error(input, result)
+        return result
+
+    def stream_plans(self, input: Input, parser: StreamingPlanParser) -> Iterator[CodeInterpreterPlan]:
+        """
+        前処理してからstreaming_plannerを実行して、完成したplanから順に返す
+        """
         pre_processed_input = self.zoltraak_pre_process(input)
-        planner_result = self.planner.invoke(pre_processed_input, config=self.ci_params.runnable_config)
+        return StreamingPlanParser.iter_plans(self.streaming_planner.stream(pre_processed_input), parser)
+
+    async def astream_plans(self, input: Input, parser: StreamingPlanParser) -> AsyncIterator[CodeInterpreterPlan]:
+        pre_processed_input = await asyncio.to_thread(self.zoltraak_pre_process, input)
+        async for plan in StreamingPlanParser.aiter_plans(self.streaming_planner.astream(pre_processed_input), parser):
+            yield plan
+
+    def invoke_streaming(self, input: Input) -> CodeInterpreterIntermediateResult:
+        """
+        plannerの出力を待たずに、最初のplanが届いた時点からcrewのタスクを実行する
+        """
+        parser = StreamingPlanParser()
+        plans = self.stream_plans(input, parser)
+        first_plan = next(plans, None)
+        if first_plan is None:
+            print("supervisor.invoke_streaming no_agent empty plan")
+            return self.invoke_no_agent(input)
+        print("supervisor.invoke_streaming use crew_agent first_plan=", first_plan)
+        result = self.ci_params.crew_agent.run_stream(input, itertools.chain([first_plan], plans))
+        self.store_plan(input, parser.get_plan_list(), result)
+        return result
+
+    async def ainvoke_streaming(self, input: Input) -> CodeInterpreterIntermediateResult:
+        parser = StreamingPlanParser()
+        plans = self.astream_plans(input, parser)
+        first_plan = await anext(plans, None)
+        if first_plan is None:
+            print("supervisor.ainvoke_streaming no_agent empty plan")
+            return await self.ainvoke_no_agent(input)
+
+        async def all_plans() -> AsyncIterator[CodeInterpreterPlan]:
+            yield first_plan
+            async for plan in plans:
+                yield plan
+
+        print("supervisor.ainvoke_streaming use crew_agent first_plan=", first_plan)
+        result = await self.ci_params.crew_agent.arun_stream(input, all_plans())
+        self.store_plan(input, parser.get_plan_list(), result)
+        return result
+
+    def invoke_no_agent(self, input: Input) -> CodeInterpreterIntermediateResult:
+        result_dict = self.supervisor_chain_no_agent.invoke(input)
+        result_str = MultiConverter.to_str(result_dict)
+        return CodeInterpreterIntermediateResult(context=result_str)
+
+    async def ainvoke_no_agent(self, input: Input) -> CodeInterpreterIntermediateResult:
+        result_dict = await self.supervisor_chain_no_agent.ainvoke(input)
+        result_str = MultiConverter.to_str(result_dict)
+        return CodeInterpreterIntermediateResult(context=result_str)
+
+    def invoke(self, input: Input) -> CodeInterpreterIntermediateResult:
+        stored_plan_list = self.lookup_plan(input)
+        if stored_plan_list is not None:
+            return self.run_stored_plan(input, stored_plan_list)
+        if self.streaming_planner is not None:
+            return self.invoke_streaming(input)
+        planner_result = self.plan(input)
         print("supervisor.invoke type(planner_result)=", type(planner_result))
         if isinstance(planner_result, CodeInterpreterPlanList):
             plan_list: CodeInterpreterPlanList = planner_result
             if len(plan_list.agent_task_list) > 0:
                 print("supervisor.invoke use crew_agent plan_list=", plan_list)
                 result: CodeInterpreterIntermediateResult = self.ci_params.crew_agent.run(input, plan_list)
+                self.store_plan(input, plan_list, result)
             else:
                 print("supervisor.invoke empty plan_list")
                 result_dict = self.supervisor_chain_no_agent.invoke(input)
@@ -120,6 +301,26 @@ class CodeInterpreterSupervisor:
             result = CodeInterpreterIntermediateResult(context=result_str)
         return result
 
+    async def ainvoke(self, input: Input) -> CodeInterpreterIntermediateResult:
+        stored_plan_list = self.lookup_plan(input)
+        if stored_plan_list is not None:
+            return await self.arun_stored_plan(input, stored_plan_list)
+        if self.streaming_planner is not None:
+            return await self.ainvoke_streaming(input)
+        planner_result = await self.aplan(input)
+        print("supervisor.ainvoke type(planner_result)=", type(planner_result))
+        if isinstance(planner_result, CodeInterpreterPlanList) and len(planner_result.agent_task_list) > 0:
+            plan_list: CodeInterpreterPlanList = planner_result
+            print("supervisor.ainvoke use crew_agent plan_list=", plan_list)
+            result: CodeInterpreterIntermediateResult = await self.ci_params.crew_agent.arun(input, plan_list)
+            self.store_plan(input, plan_list, result)
+        else:
+            print("supervisor.ainvoke no_agent")
+            result_dict = await self.supervisor_chain_no_agent.ainvoke(input)
+            result_str = MultiConverter.to_str(result_dict)
+            result = CodeInterpreterIntermediateResult(context=result_str)
+        return result
+
     # NOT USED
     def execute_plan(self, plan_list: CodeInterpreterPlanList) -> Dict[str, Any]:
         print("supervisor.execute_plan type(plan_list)=", type(plan_list))
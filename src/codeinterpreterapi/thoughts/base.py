@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import indent
-from typing import Any, Dict, List, Optional, Type
+from typing import Any, Dict, List, Optional, Tuple, Type
 
 from langchain_core.language_models import BaseLanguageModel
 from langchain_core.callbacks.manager import AsyncCallbackManagerForChainRun, CallbackManagerForChainRun
@@ -33,6 +35,8 @@ class MyToTChain(ToTChain):
     tot_strategy_class: Type[BaseThoughtGenerationStrategy] = ProposePromptStrategy
     verbose_llm: bool = False
     thought_generator: Optional[BaseThoughtGenerationStrategy] = None
+    max_concurrency: int = 1
+    """The number of children generated/checked concurrently. 1 keeps the sequential search."""
 
     class Config:
         """Configuration for this pydantic object."""
@@ -97,6 +101,9 @@ class MyToTChain(ToTChain):
         if self.thought_generator is None:
             self.initialize_thought_generator()
 
+        if self.max_concurrency > 1:
+            return self._call_parallel(inputs, run_manager)
+
         problem_description = inputs["problem_description"]
         checker_inputs = {"problem_description": problem_description}
         thoughts_path: tuple[str, ...] = ()
@@ -125,7 +132,187 @@ class MyToTChain(ToTChain):
         inputs: Dict[str, Any],
         run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
     ) -> Dict[str, str]:
-        raise NotImplementedError("Async not implemented yet")
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        if run_manager:
+            await run_manager.on_text(text="Starting the ToT solve procedure.\n")
+
+        if self.thought_generator is None:
+            self.initialize_thought_generator()
+
+        problem_description = inputs["problem_description"]
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+        # 並列実行でも他の実行と混ざらないようにmemoryは実行ごとに作る
+        tot_memory = ToTDFSMemory()
+        pending: Dict[Tuple[str, ...], List[Thought]] = {}
+        thoughts_path: Tuple[str, ...] = ()
+
+        for step in range(self.k):
+            level = tot_memory.level
+            if not pending.get(thoughts_path):
+                callbacks = _run_manager.get_child()
+
+                async def acheck(thought_text: str) -> Thought:
+                    async with semaphore:
+                        return await self._acheck_thought(problem_description, thoughts_path, thought_text, callbacks)
+
+                thought_texts = await self._agenerate_children(problem_description, thoughts_path, callbacks, semaphore)
+                thoughts = list(await asyncio.gather(*(acheck(thought_text) for thought_text in thought_texts)))
+                for thought in thoughts:
+                    if run_manager:
+                        self.log_thought(thought, level, step, run_manager.get_sync())
+                final_thought = self._store_children(tot_memory, pending, thoughts_path, thoughts)
+                if final_thought:
+                    return {self.output_key: final_thought.text}
+            else:
+                tot_memory.store(pending[thoughts_path].pop(0))
+            thoughts_path = self.tot_controller(tot_memory)
+
+        return {self.output_key: "No solution found"}
+
+    def _call_parallel(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, str]:
+        """
+        ノードのc個の子thoughtをまとめて生成し、max_concurrency並列でチェックする(beam的な展開)
+
+        有効な兄弟thoughtはpendingに残しておき、バックトラック時にLLMを呼ばずに再利用する。
+        """
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        problem_description = inputs["problem_description"]
+        # 並列実行でも他の実行と混ざらないようにmemoryは実行ごとに作る
+        tot_memory = ToTDFSMemory()
+        pending: Dict[Tuple[str, ...], List[Thought]] = {}
+        thoughts_path: Tuple[str, ...] = ()
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            for step in range(self.k):
+                level = tot_memory.level
+                if not pending.get(thoughts_path):
+                    callbacks = _run_manager.get_child()
+                    thought_texts = self._generate_children(problem_description, thoughts_path, callbacks, executor)
+                    thoughts = list(
+                        executor.map(
+                            lambda thought_text: self._check_thought(
+                                problem_description, thoughts_path, thought_text, callbacks
+                            ),
+                            thought_texts,
+                        )
+                    )
+                    for thought in thoughts:
+                        self.log_thought(thought, level, step, run_manager)
+                    final_thought = self._store_children(tot_memory, pending, thoughts_path, thoughts)
+                    if final_thought:
+                        return {self.output_key: final_thought.text}
+                else:
+                    tot_memory.store(pending[thoughts_path].pop(0))
+                thoughts_path = self.tot_controller(tot_memory)
+
+        return {self.output_key: "No solution found"}
+
+    def _store_children(
+        self,
+        tot_memory: ToTDFSMemory,
+        pending: Dict[Tuple[str, ...], List[Thought]],
+        thoughts_path: Tuple[str, ...],
+        thoughts: List[Thought],
+    ) -> Optional[Thought]:
+        """VALID_FINALがあれば返す。なければ最初の有効なthoughtに進み、残りはpendingに入れる"""
+        for thought in thoughts:
+            if thought.validity == ThoughtValidity.VALID_FINAL:
+                return thought
+        valid_thoughts = [thought for thought in thoughts if thought.validity == ThoughtValidity.VALID_INTERMEDIATE]
+        invalid_thoughts = [thought for thought in thoughts if thought.validity == ThoughtValidity.INVALID]
+        # 全て無効な場合だけ、無効な子も探索済みとして親のchildrenに数える(controllerは子がc個になると親からもバックトラックする)
+        # 有効な子がある時に数えると、これから探索する有効な子ごと親からバックトラックしてしまう
+        # 最後の1つは下のstoreで追加される
+        parent_thought = tot_memory.top()
+        if parent_thought is not None and not valid_thoughts:
+            parent_thought.children.update(invalid_thoughts[:-1])
+        if valid_thoughts:
+            tot_memory.store(valid_thoughts[0])
+            pending[thoughts_path] = valid_thoughts[1:]
+        elif thoughts:
+            # 全て無効ならINVALIDを積んでcontrollerにバックトラックさせる
+            tot_memory.store(thoughts[-1])
+        return None
+
+    def _uses_propose_prompt(self) -> bool:
+        # propose系は1回のLLM呼び出しでc個の候補を返す
+        return "tot_memory" in type(self.thought_generator).model_fields
+
+    def _generate_children(
+        self,
+        problem_description: str,
+        thoughts_path: Tuple[str, ...],
+        callbacks: Any,
+        executor: ThreadPoolExecutor,
+    ) -> List[str]:
+        if self._uses_propose_prompt():
+            new_thoughts = self.thought_generator.predict_and_parse(
+                problem_description=problem_description, thoughts=thoughts_path, n=self.c, callbacks=callbacks
+            )
+        else:
+            new_thoughts = list(
+                executor.map(
+                    lambda _: self.thought_generator.next_thought(
+                        problem_description, thoughts_path, callbacks=callbacks
+                    ),
+                    range(self.c),
+                )
+            )
+        return self._normalize_children(new_thoughts)
+
+    async def _agenerate_children(
+        self,
+        problem_description: str,
+        thoughts_path: Tuple[str, ...],
+        callbacks: Any,
+        semaphore: asyncio.Semaphore,
+    ) -> List[str]:
+        if self._uses_propose_prompt():
+            async with semaphore:
+                new_thoughts = await self.thought_generator.apredict_and_parse(
+                    problem_description=problem_description, thoughts=thoughts_path, n=self.c, callbacks=callbacks
+                )
+        else:
+
+            async def anext_thought() -> str:
+                async with semaphore:
+                    return await self.thought_generator.apredict_and_parse(
+                        problem_description=problem_description, thoughts=thoughts_path, callbacks=callbacks
+                    )
+
+            new_thoughts = await asyncio.gather(*(anext_thought() for _ in range(self.c)))
+        return self._normalize_children(new_thoughts)
+
+    @staticmethod
+    def _normalize_children(new_thoughts: Any) -> List[str]:
+        if not new_thoughts:
+            return []
+        if not isinstance(new_thoughts, list):
+            new_thoughts = [new_thoughts]
+        # 重複した候補は1回だけチェックする
+        thought_texts = []
+        for thought_text in new_thoughts:
+            if isinstance(thought_text, str) and thought_text and thought_text not in thought_texts:
+                thought_texts.append(thought_text)
+        return thought_texts
+
+    def _check_thought(
+        self, problem_description: str, thoughts_path: Tuple[str, ...], thought_text: str, callbacks: Any
+    ) -> Thought:
+        checker_inputs = {"problem_description": problem_description, "thoughts": thoughts_path + (thought_text,)}
+        thought_validity = self.checker(checker_inputs, callbacks=callbacks)["validity"]
+        return Thought(text=thought_text, validity=thought_validity)
+
+    async def _acheck_thought(
+        self, problem_description: str, thoughts_path: Tuple[str, ...], thought_text: str, callbacks: Any
+    ) -> Thought:
+        checker_inputs = {"problem_description": problem_description, "thoughts": thoughts_path + (thought_text,)}
+        thought_validity = (await self.checker.acall(checker_inputs, callbacks=callbacks))["validity"]
+        return Thought(text=thought_text, validity=thought_validity)
 
     @property
     def _chain_type(self) -> str:
@@ -1,14 +1,18 @@
+import difflib
+import re
+import threading
+from functools import lru_cache
 from json import JSONDecodeError
-from typing import Optional, Tuple
+from typing import Any, ClassVar, Dict, List, Optional, Tuple
 
-import spacy
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
 from langchain_core.runnables import Runnable
 from langchain_experimental.tot.checker import ToTChecker
 from langchain_experimental.tot.thought import ThoughtValidity
-from spacy import Language
+from pydantic import PrivateAttr
 
+from codeinterpreterapi.config import settings
 from codeinterpreterapi.llm.llm import prepare_test_llm
 from codeinterpreterapi.thoughts.base import MyToTChain
 from codeinterpreterapi.thoughts.thought_generation import (
@@ -17,6 +21,7 @@ from codeinterpreterapi.thoughts.thought_generation import (
     MySampleCoTStrategy,
     MySampleCoTStrategyJa,
 )
+from codeinterpreterapi.thoughts.verdict_cache import ThoughtVerdictCache
 
 sudoku_puzzle_sample = "3,x,x,x|1,x,3,x|x,1,x,3|4,x,x,1"
 sudoku_puzzle = "3,x,x,x|1,x,3,x|x,1,x,3|4,x,x,1"
@@ -161,8 +166,70 @@ checker_support_prompt_ja = """
 
         """
 
+# 思考に依存しない判断基準(問題ごとに1回だけ生成して使い回す)
+checker_support_problem_prompt_ja = """
+        ## Order
+        あなたはThree-of-Thought (ToT) 戦略の正誤チェッカーのサポートツールです。
+
+        問題から、回答LLMの思考を正誤判断するための明確な判断基準を最大10個の箇条書きで整理してください。
+        判断基準は「～であること。」や「～でないこと。」というOK/NGを明示する形式で書いてください。
+        「～を確認する」や「～を判断する」という形式では書かないでください。
+
+        ## Problem Description
+        {problem_description}
+
+        ## Output
+        以下に判断基準を示します。
+
+        """
+
+# 判断基準の整理と正誤判断を1回のLLM呼び出しで行う
+checker_single_prompt_ja = """
+        ## Order
+        あなたはThree-of-Thought (ToT) 戦略の正誤チェッカーです。
+        まず問題から正誤判断のための明確な判断基準を整理し、その基準に従って最新の思考(1つ)について正誤判断をしてください。
+
+        ## Problem Description
+        {problem_description}
+
+        ## Solution Attempt
+        以下は、回答LLMが生成したThoughts(思考列)です。
+
+        ### IMPORTANT! please check this section ###
+        {thoughts}
+        ### IMPORTANT! please check this section ###
+
+        ## Output
+        この解答が正しいかどうかを評価し、以下のフォーマットで出力してください。
+
+```json
+{{
+  "criteria": "判断基準(「～であること。」形式の箇条書き、最大10個)"
+  "judgement": "VALID_FINAL|VALID_INTERMEDIATE|INVALID"
+  "explanation": judgementを選択した理由
+}}
+```
+
+        judgementの選択基準を以下に示します。
+        - VALID_FINAL: 思考が完全に正しい場合、現時点で必要な思考がなされた場合。
+        - VALID_INTERMEDIATE: 思考は部分的に正しいが、まだ完全ではない場合。
+        - INVALID: 思考がルールに違反しているか、明らかな誤りがある場合。ループが発生した場合。
+
+        judgementを選択した理由は特に、INVALIDの場合に具体的にどのルールに違反しているか、どこに誤りがあるかを指摘してください。
+        解答の評価を行う際は、Problem Descriptionで示されたルールに厳密に従ってください。
+        """
+
+
+@lru_cache(maxsize=1)
+def load_spacy_nlp() -> Any:
+    # spaCyのモデルは大きいのでjudge_matcher="spacy"の時だけ読み込む(要 pip install spacy en_core_web_md)
+    import spacy
+
+    return spacy.load("en_core_web_md")
+
 
 class MyToTChecker(ToTChecker):
+    MAX_SUPPORT_RESULTS: ClassVar[int] = 32
     llm: Optional[Runnable] = None
     prompt: PromptTemplate = PromptTemplate(
         input_variables=["problem_description", "thoughts", "support_result"],
@@ -172,14 +239,68 @@ class MyToTChecker(ToTChecker):
         input_variables=["problem_description", "thoughts"],
         template=checker_support_prompt_ja,
     )
-    nlp: Language = spacy.load("en_core_web_md")
+    prompt_support_problem: PromptTemplate = PromptTemplate(
+        input_variables=["problem_description"],
+        template=checker_support_problem_prompt_ja,
+    )
+    prompt_single: PromptTemplate = PromptTemplate(
+        input_variables=["problem_description", "thoughts"],
+        template=checker_single_prompt_ja,
+    )
+    evaluation_mode: str = "memoized"
+    """two_step: 思考ごとに判断基準を作る, memoized: 判断基準は問題ごとに1回, single: 1回のLLM呼び出しで判断"""
+    judge_matcher: str = "difflib"
+    """judgementが3つのラベルのどれでもない場合の推定方法(difflib or spacy)"""
+    verdict_cache: Optional[ThoughtVerdictCache] = None
+    """同じ(problem_description, thoughts)の判定結果を再利用するキャッシュ"""
+    _support_results: Dict[str, str] = PrivateAttr(default_factory=dict)
+    _support_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def get_support_result(self, problem_description: str, thoughts: str) -> str:
+        if self.evaluation_mode == "two_step":
+            support_result = self.prompt_support | self.llm | StrOutputParser()
+            return support_result.invoke({"problem_description": problem_description, "thoughts": thoughts})
+
+        # 判断基準は問題文だけから作って、同じ問題の全thoughtで使い回す
+        support_result = self._support_results.get(problem_description)
+        if support_result is not None:
+            return support_result
+        with self._support_lock:
+            if problem_description not in self._support_results:
+                if len(self._support_results) >= self.MAX_SUPPORT_RESULTS:
+                    self._support_results.clear()
+                support_chain = self.prompt_support_problem | self.llm | StrOutputParser()
+                self._support_results[problem_description] = support_chain.invoke(
+                    {"problem_description": problem_description}
+                )
+            return self._support_results[problem_description]
 
     def evaluate(self, problem_description: str, thoughts: Tuple[str, ...] = ()) -> ThoughtValidity:
+        if self.verdict_cache is None:
+            return self._evaluate(problem_description, thoughts)
+
+        key = ThoughtVerdictCache.create_key(problem_description, tuple(thoughts), self.evaluation_mode)
+        validity = self.verdict_cache.get(key)
+        if validity is not None:
+            print("MyToTChecker verdict cache hit=", validity)
+            return validity
+        validity = self._evaluate(problem_description, thoughts)
+        self.verdict_cache.put(key, validity)
+        return validity
+
+    def _evaluate(self, problem_description: str, thoughts: Tuple[str, ...] = ()) -> ThoughtValidity:
         thoughts = self.pre_evaluate(thoughts)
         # print("MyToTChecker thoughts=", thoughts)
 
-        support_result = self.prompt_support | self.llm | StrOutputParser()
-        support_result = support_result.invoke({"problem_description": problem_description, "thoughts": thoughts})
+        if self.evaluation_mode == "single":
+            evaluation = self.prompt_single | self.llm | JsonOutputParser()
+            evaluation_output = evaluation.invoke({"problem_description": problem_description, "thoughts": thoughts})
+            print("MyToTChecker evaluation_output=", evaluation_output)
+            final_judge = self.judge_llm_output(evaluation_output)
+            print("MyToTChecker final_judge=", final_judge)
+            return final_judge
+
+        support_result = self.get_support_result(problem_description, thoughts)
         # print("MyToTChecker support_result=", support_result)
 
         evaluation = self.prompt | self.llm | JsonOutputParser()
@@ -207,20 +328,22 @@ class MyToTChecker(ToTChecker):
 
     def judge_llm_output(self, llm_output) -> ThoughtValidity:
         llm_output_judgement = str(llm_output)
+        thought_validity_candidates = ["VALID_FINAL", "VALID_INTERMEDIATE", "INVALID"]
         try:
-            llm_output_judgement = llm_output["judgement"]
+            llm_output_judgement = str(llm_output["judgement"])
             # llm_output_explanation = llm_output["explanation"]
-            thought_validity_candidates = ["VALID_FINAL", "VALID_INTERMEDIATE", "INVALID"]
             for thought_validity in thought_validity_candidates:
                 if thought_validity in llm_output_judgement:
                     return self.get_thought_validity(thought_validity)
-        except JSONDecodeError:
+        except (JSONDecodeError, KeyError, TypeError):
             pass
 
-        # nlp judge
-        actual = self.nlp(llm_output_judgement)
-        options_nlp = ["FINAL", "INTERMEDIATE", "INVALID"]
-        similarities = [actual.similarity(self.nlp(option)) for option in options_nlp]
+        # 類似度で推定する
+        options = ["FINAL", "INTERMEDIATE", "INVALID"]
+        if self.judge_matcher == "spacy":
+            similarities = self.get_similarities_spacy(llm_output_judgement, options)
+        else:
+            similarities = self.get_similarities_difflib(llm_output_judgement, options)
         print("MyToTChecker similarities=", similarities)
         best_match_index = similarities.index(max(similarities))
         best_match = thought_validity_candidates[best_match_index]
@@ -228,6 +351,25 @@ class MyToTChecker(ToTChecker):
         print(f"MyToTChecker Best match: {best_match} with similarity {similarities[best_match_index]}")
         return self.get_thought_validity(best_match)
 
+    @staticmethod
+    def get_similarities_difflib(text: str, options: List[str]) -> List[float]:
+        # 各ラベルについて、テキスト中のトークンとの編集距離ベースの類似度の最大値を使う
+        tokens = [token for token in re.split(r"[^A-Z]+", text.upper()) if token]
+        similarities = []
+        for option in options:
+            if option in tokens:
+                similarities.append(1.0)
+                continue
+            ratios = [difflib.SequenceMatcher(None, token, option).ratio() for token in tokens]
+            similarities.append(max(ratios, default=0.0))
+        return similarities
+
+    @staticmethod
+    def get_similarities_spacy(text: str, options: List[str]) -> List[float]:
+        nlp = load_spacy_nlp()
+        actual = nlp(text)
+        return [actual.similarity(nlp(option)) for option in options]
+
     def get_thought_validity(self, thought_validity) -> ThoughtValidity:
         if thought_validity == "VALID_FINAL":
             return ThoughtValidity.VALID_FINAL
@@ -267,7 +409,14 @@ def test_checker():
 
 
 def create_tot_chain_from_llm(llm=None, is_ja=True, is_simple=False):
-    checker = MyToTChecker()
+    verdict_cache = None
+    if settings.TOT_VERDICT_CACHE_ENABLED:
+        verdict_cache = ThoughtVerdictCache(path=settings.TOT_VERDICT_CACHE_PATH)
+    checker = MyToTChecker(
+        evaluation_mode=settings.TOT_CHECKER_MODE,
+        judge_matcher=settings.TOT_JUDGE_MATCHER,
+        verdict_cache=verdict_cache,
+    )
     if llm is None:
         llm = prepare_test_llm()
     checker.llm = llm
@@ -290,6 +439,7 @@ def create_tot_chain_from_llm(llm=None, is_ja=True, is_simple=False):
         verbose=True,
         tot_strategy_class=tot_strategy_class,
         verbose_llm=False,
+        max_concurrency=settings.TOT_MAX_CONCURRENCY,
     )
     return tot_chain
 
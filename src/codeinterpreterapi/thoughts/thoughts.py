@@ -1,3 +1,4 @@
+import asyncio
 from typing import Any, Dict, List, Optional, Union
 
 from langchain_core.runnables import RunnableSerializable
@@ -21,6 +22,10 @@ class CodeInterpreterToT(RunnableSerializable):
         problem_description = input["input"]
         return self.tot_chain.run(problem_description=problem_description)
 
+    async def arun(self, input: Input) -> Output:
+        problem_description = input["input"]
+        return await self.tot_chain.arun(problem_description=problem_description)
+
     def __call__(self, input: Input) -> Dict[str, str]:
         return self.run(input)
 
@@ -31,7 +36,7 @@ class CodeInterpreterToT(RunnableSerializable):
         return [self.run(input_item) for input_item in inputs]
 
     async def ainvoke(self, input: Input, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Output:
-        raise NotImplementedError("Async not implemented yet")
+        return await self.arun(input)
 
     async def abatch(
         self,
@@ -41,7 +46,9 @@ class CodeInterpreterToT(RunnableSerializable):
         return_exceptions: bool = False,
         **kwargs: Optional[Any],
     ) -> List[Output]:
-        raise NotImplementedError("Async not implemented yet")
+        return await asyncio.gather(
+            *(self.arun(input_item) for input_item in inputs), return_exceptions=return_exceptions
+        )
 
     @classmethod
     def get_runnable_tot_chain(cls, ci_params: CodeInterpreterParams, is_simple: bool = False) -> RunnableSerializable:
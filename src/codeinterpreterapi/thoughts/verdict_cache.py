@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from langchain_experimental.tot.thought import ThoughtValidity
+
+
+class ThoughtVerdictCache:
+    """
+    ToTのthought判定結果(ThoughtValidity)のキャッシュ
+
+    key: (problem_description, thoughts)のハッシュ。同じ思考列が別の経路で生成されてもLLMで再判定しない。
+    pathを指定するとjsonlに追記して、次回以降の実行(別プロセス)でも再利用する。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_size: int = 10000):
+        self.path = path
+        self.max_size = max_size
+        self.verdicts: "OrderedDict[str, ThoughtValidity]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if path:
+            self.load()
+
+    @staticmethod
+    def create_key(problem_description: str, thoughts: Tuple[str, ...], namespace: str = "") -> str:
+        data = json.dumps([namespace, problem_description, list(thoughts)], ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[ThoughtValidity]:
+        with self.lock:
+            validity = self.verdicts.get(key)
+            if validity is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.verdicts.move_to_end(key)
+            return validity
+
+    def put(self, key: str, validity: ThoughtValidity) -> None:
+        with self.lock:
+            self._set(key, validity)
+            if self.path:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps({"key": key, "validity": validity.name}) + "\n")
+                except OSError as e:
+                    print("ThoughtVerdictCache save error=", e)
+
+    def _set(self, key: str, validity: ThoughtValidity) -> None:
+        self.verdicts[key] = validity
+        self.verdicts.move_to_end(key)
+        while len(self.verdicts) > self.max_size:
+            self.verdicts.popitem(last=False)
+
+    def load(self) -> None:
+        if not os.path.isfile(self.path):
+            return
+        with self.lock:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                        self._set(item["key"], ThoughtValidity[item["validity"]])
+                    except (ValueError, KeyError):
+                        # 書き込み途中の行などは無視する
+                        continue
+
+
+def test():
+    cache = ThoughtVerdictCache(max_size=2)
+    key = ThoughtVerdictCache.create_key("problem", ("a", "b"))
+    assert cache.get(key) is None
+    cache.put(key, ThoughtValidity.VALID_INTERMEDIATE)
+    assert cache.get(ThoughtVerdictCache.create_key("problem", ("a", "b"))) == ThoughtValidity.VALID_INTERMEDIATE
+    assert cache.get(ThoughtVerdictCache.create_key("problem", ("ab",))) is None
+    print("hits=", cache.hits, "misses=", cache.misses)
+
+
+if __name__ == "__main__":
+    test()
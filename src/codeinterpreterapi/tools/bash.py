@@ -1,3 +1,4 @@
+import asyncio
 import os
 import shlex
 import subprocess
@@ -8,6 +9,7 @@ from codeinterpreterapi.brain.params import CodeInterpreterParams
 from codeinterpreterapi.config import settings
 from codeinterpreterapi.llm.llm import prepare_test_llm
 from codeinterpreterapi.schema import BashCommand
+from codeinterpreterapi.utils.subprocess_runner import arun_subprocess
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 INVOKE_TASKS_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "../invoke_tasks"))
@@ -43,7 +45,7 @@ class BashTools:
         return self._run(command)
 
     async def arun(self, command: str) -> str:
-        return self._arun(command)
+        return await self._arun_local(command)
 
     def _run(self, command: str):
         try:
@@ -66,9 +68,15 @@ class BashTools:
         try:
             # シェルインジェクションを防ぐためにshlexを使用
             args = shlex.split(command)
-            output_content = await subprocess.check_output(
-                args, stderr=subprocess.STDOUT, universal_newlines=True, cwd=INVOKE_TASKS_DIR
+            exitcode, output_content, _ = await arun_subprocess(
+                args,
+                cwd=INVOKE_TASKS_DIR,
+                timeout=settings.BASH_TIMEOUT,
+                merge_stderr=True,
+                on_stdout=self._show_output,
             )
+            if exitcode != 0:
+                raise subprocess.CalledProcessError(exitcode, args, output=output_content)
             print("_arun_local output_content=", output_content)
             self.command_log.append((command, output_content))
             return output_content
@@ -77,6 +85,15 @@ class BashTools:
             print(error_message)
             self.command_log.append((command, error_message))
             return error_message
+        except asyncio.TimeoutError:
+            error_message = f"An error occurred: timed out after {settings.BASH_TIMEOUT} seconds"
+            print(error_message)
+            self.command_log.append((command, error_message))
+            return error_message
+
+    def _show_output(self, output: str) -> None:
+        if self.ci_params.verbose:
+            print(output, end="")
 
 
 def test():
@@ -88,6 +105,9 @@ def test():
     result = tools_instance.run(test_code)
     print("result=", result)
     assert "test output" in result
+    result = asyncio.run(tools_instance.arun(test_code))
+    print("result(async)=", result)
+    assert "test output" in result
 
 
 if __name__ == "__main__":
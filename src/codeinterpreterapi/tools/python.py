@@ -1,8 +1,11 @@
+import asyncio
 import base64
 import os
 import re
 import shlex
 import subprocess
+import sys
+import weakref
 from io import BytesIO
 from uuid import uuid4
 
@@ -13,7 +16,9 @@ from codeinterpreterapi.brain.params import CodeInterpreterParams
 from codeinterpreterapi.config import settings
 from codeinterpreterapi.llm.llm import prepare_test_llm
 from codeinterpreterapi.schema import CodeInput, File, FileInput
+from codeinterpreterapi.tools.python_kernel import PythonKernelPool
 from codeinterpreterapi.utils.file_util import FileUtil
+from codeinterpreterapi.utils.subprocess_runner import arun_subprocess
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 INVOKE_TASKS_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "../invoke_tasks"))
@@ -25,6 +30,11 @@ class PythonTools:
         self.code_log = []
         self.input_files = []
         self.output_files = []
+        # PythonKernelPool内でこのインスタンス(=セッション)が使うワーカーのkey
+        session_id = str(ci_params.session_id) if ci_params.session_id else None
+        self.kernel_key = PythonKernelPool.create_key(session_id)
+        # セッションのstop()で解放されなかった場合も、このインスタンスが破棄されたらワーカーを終了する
+        weakref.finalize(self, PythonKernelPool.release_key, self.kernel_key)
 
     @classmethod
     def get_tools_python(cls, ci_params: CodeInterpreterParams) -> None:
@@ -71,19 +81,46 @@ class PythonTools:
         return self._run_local(filename="", code=code)
 
     async def arun_by_file(self, filename: str) -> str:
-        return self._arun_local(filename)
+        return await self._arun_local(filename)
 
     async def arun_by_code(self, code: str) -> str:
-        return self._arun_local(filename="", code=code)
+        return await self._arun_local(filename="", code=code)
 
-    def _get_command_local(self, filename: str, code: str = "") -> str:
+    def _get_python_file_path(self, filename: str, code: str = "") -> str:
         python_file_path = FileUtil.get_python_file_path(filename=filename)
         if code:
             python_file_path = FileUtil.write_python_file(filename, code)
+        return python_file_path
+
+    def _get_command_local(self, filename: str, code: str = "") -> str:
+        python_file_path = self._get_python_file_path(filename, code)
         command = f"invoke -c python run-code-file '{python_file_path}'"
         return command
 
+    def _run_kernel(self, filename: str, code: str = "") -> str:
+        python_file_path = self._get_python_file_path(filename, code)
+        try:
+            output_content = PythonKernelPool.get_instance().run(self.kernel_key, path=python_file_path)
+        except (TimeoutError, RuntimeError) as e:
+            output_content = f"An error occurred: {e}"
+        print("_run_kernel output_content=", output_content)
+        self.code_log.append((code, output_content))
+        return output_content
+
+    async def _arun_kernel(self, filename: str, code: str = "") -> str:
+        python_file_path = self._get_python_file_path(filename, code)
+        try:
+            # キャンセルされた場合はkernelが実行中のコードごと終了する
+            output_content = await PythonKernelPool.get_instance().arun(self.kernel_key, path=python_file_path)
+        except (TimeoutError, RuntimeError) as e:
+            output_content = f"An error occurred: {e}"
+        print("_arun_kernel output_content=", output_content)
+        self.code_log.append((code, output_content))
+        return output_content
+
     def _run_local(self, filename: str, code: str = ""):
+        if settings.PYTHON_KERNEL_ENABLED:
+            return self._run_kernel(filename, code)
         command = self._get_command_local(filename, code)
         try:
             # シェルインジェクションを防ぐためにshlexを使用
@@ -103,21 +140,24 @@ class PythonTools:
 
     async def _arun_local(self, filename: str, code: str = "") -> str:
         print(f"_arun_handler_local filename={filename}, code={code}")
-        command = self._get_command_local(filename, code)
+        if settings.PYTHON_KERNEL_ENABLED:
+            return await self._arun_kernel(filename, code)
+
+        python_file_path = self._get_python_file_path(filename, code)
         try:
-            # シェルインジェクションを防ぐためにshlexを使用
-            args = shlex.split(command)
-            output_content = await subprocess.check_output(
-                args, stderr=subprocess.STDOUT, universal_newlines=True, cwd=INVOKE_TASKS_DIR
+            exitcode, stdout, stderr = await arun_subprocess(
+                [sys.executable, python_file_path],
+                cwd=INVOKE_TASKS_DIR,
+                timeout=settings.PYTHON_KERNEL_TIMEOUT,
+                on_stdout=self._show_output,
+                on_stderr=self._show_output,
             )
-            print("_arun_local output_content=", output_content)
-            self.code_log.append((code, output_content))
-            return output_content
-        except subprocess.CalledProcessError as e:
-            error_message = f"An error occurred: {e}\nOutput: {e.output}"
-            print(error_message)
-            self.code_log.append((code, error_message))
-            return error_message
+            output_content = PythonKernelPool.format_output(exitcode, stdout, stderr)
+        except asyncio.TimeoutError:
+            output_content = f"An error occurred: timed out after {settings.PYTHON_KERNEL_TIMEOUT} seconds"
+        print("_arun_local output_content=", output_content)
+        self.code_log.append((code, output_content))
+        return output_content
 
     def _run_handler(self, filename: str, code: str) -> str:
         """Run code in container and send the output to the user"""
@@ -167,7 +207,7 @@ class PythonTools:
         """Run code in container and send the output to the user"""
         await self.ashow_code(code)
         if self.ci_params.codebox is None:
-            return self._arun_local(code)
+            return await self._arun_local(filename, code)
         output: CodeBoxOutput = await self.ci_params.codebox.arun(code)
         self.code_log.append((code, output.content))
 
@@ -208,6 +248,10 @@ class PythonTools:
 
         return output.content
 
+    def _show_output(self, output: str) -> None:
+        if self.ci_params.verbose:
+            print(output, end="")
+
     def show_code(self, code: str) -> None:
         if self.ci_params.verbose:
             print(code)
@@ -228,6 +272,9 @@ def test():
     result = tools_instance.run_by_file("main.py")
     print("result=", result)
     assert "test output" in result
+    result = asyncio.run(tools_instance.arun_by_code(test_code))
+    print("result(async)=", result)
+    assert "test output" in result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,372 @@
+import asyncio
+import atexit
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from uuid import uuid4
+
+from codeinterpreterapi.config import settings
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+INVOKE_TASKS_DIR = os.path.abspath(os.path.join(CURRENT_DIR, "../invoke_tasks"))
+KERNEL_WORKER_PATH = os.path.join(INVOKE_TASKS_DIR, "kernel_worker.py")
+
+
+def get_work_dir() -> str:
+    # WORK_DIRが無い環境(ローカル開発など)では従来通りinvoke_tasksで実行する
+    if os.path.isdir(settings.WORK_DIR):
+        return settings.WORK_DIR
+    return INVOKE_TASKS_DIR
+
+
+class PythonKernel:
+    """
+    常駐するPythonワーカープロセス1つ分のハンドル
+
+    invoke_tasks/kernel_worker.pyをサブプロセスとして起動し、パイプ経由でコードを渡す。
+    ワーカー内の名前空間は実行間で保持される。
+    """
+
+    def __init__(self, cwd: Optional[str] = None):
+        self.cwd = cwd or get_work_dir()
+        # 実行中の出力はリクエスト毎にワーカーが受け取る。ワーカー自体のエラーは親のstderrに出す
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", KERNEL_WORKER_PATH],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.cwd,
+            text=True,
+            encoding="utf-8",
+        )
+        self.execution_count = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+        # プールから払い出されてrunが終わるまでの数(PythonKernelPool.lockの中で増減する)
+        self.in_use = 0
+        self._responses: queue.Queue = queue.Queue()
+        # arunが待っている間は、応答を(イベントループ, future)に直接渡す
+        self._waiter: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = None
+        self._waiter_lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+    def _read_responses(self) -> None:
+        for line in self.process.stdout:
+            self._put_response(line)
+        # EOF: ワーカーが終了した
+        self._put_response(None)
+
+    def _put_response(self, line: Optional[str]) -> None:
+        with self._waiter_lock:
+            waiter = self._waiter
+            self._waiter = None
+        if waiter is None:
+            self._responses.put(line)
+            return
+        loop, future = waiter
+
+        def set_result() -> None:
+            if not future.done():
+                future.set_result(line)
+
+        try:
+            loop.call_soon_threadsafe(set_result)
+        except RuntimeError:
+            # イベントループが閉じている
+            pass
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def is_busy(self) -> bool:
+        return self.in_use > 0 or self.lock.locked()
+
+    def run(self, code: str = "", path: str = "", timeout: Optional[float] = None) -> Tuple[int, str, str]:
+        with self.lock:
+            self._send(code, path)
+            try:
+                line = self._responses.get(timeout=timeout)
+            except queue.Empty:
+                # 実行中のコードは中断できないのでワーカーごと破棄する
+                self.kill()
+                raise TimeoutError(f"python kernel timed out after {timeout} seconds")
+            return self._parse_response(line)
+
+    async def arun(self, code: str = "", path: str = "", timeout: Optional[float] = None) -> Tuple[int, str, str]:
+        """
+        runのasync版。スレッドを使わずに応答を待つ
+
+        キャンセルされた場合は実行中のコードを止めるためにワーカーをkillする(名前空間は失われる)。
+        """
+        await self._aacquire_lock()
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            # 応答がwaiterの登録より先に届かないように、送信前に登録する
+            with self._waiter_lock:
+                self._waiter = (loop, future)
+            self._send(code, path)
+            try:
+                line = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self.kill()
+                raise TimeoutError(f"python kernel timed out after {timeout} seconds")
+            except asyncio.CancelledError:
+                print("PythonKernel cancelled, kill worker")
+                self.kill()
+                raise
+            return self._parse_response(line)
+        finally:
+            with self._waiter_lock:
+                self._waiter = None
+            self.lock.release()
+
+    async def _aacquire_lock(self) -> None:
+        if self.lock.acquire(blocking=False):
+            return
+        # 同じkernelを別の呼び出しが使っている(同じセッションからの同時実行)時だけスレッドで待つ
+        loop = asyncio.get_running_loop()
+        acquire_future = loop.run_in_executor(None, self.lock.acquire)
+        try:
+            await asyncio.shield(acquire_future)
+        except asyncio.CancelledError:
+            # スレッドはキャンセルできずにいずれlockを取るので、取った時点で解放する
+            acquire_future.add_done_callback(
+                lambda future: self.lock.release() if not future.cancelled() and future.result() else None
+            )
+            raise
+
+    def _send(self, code: str, path: str) -> None:
+        request = {"path": path} if path else {"code": code}
+        # ユーザのコードがchdirしても毎回作業ディレクトリから実行する
+        request["cwd"] = self.cwd
+        try:
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise RuntimeError(f"python kernel is not running: {e}") from e
+
+    def _parse_response(self, line: Optional[str]) -> Tuple[int, str, str]:
+        if line is None:
+            raise RuntimeError("python kernel exited unexpectedly")
+        self.execution_count += 1
+        self.last_used = time.monotonic()
+        response = json.loads(line)
+        return response["exitcode"], response["stdout"], response["stderr"]
+
+    def kill(self) -> None:
+        if self.is_alive():
+            self.process.kill()
+            self.process.wait()
+
+    def close(self) -> None:
+        if not self.is_alive():
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=1)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+class PythonKernelPool:
+    """
+    セッション(key)ごとにPythonKernelを割り当てるプール
+
+    - max_size: 同時に保持するワーカー数の上限(超えたら最も古いものを破棄)
+    - idle_timeout: この秒数使われなかったワーカーは破棄
+    - max_executions: この回数実行したワーカーは作り直す(メモリリーク対策)
+    """
+
+    _instance: Optional["PythonKernelPool"] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_size: int = 8, idle_timeout: float = 10 * 60, max_executions: int = 100):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_executions = max_executions
+        self.kernels: "OrderedDict[str, PythonKernel]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls) -> "PythonKernelPool":
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(
+                    max_size=settings.PYTHON_KERNEL_POOL_SIZE,
+                    idle_timeout=settings.PYTHON_KERNEL_IDLE_TIMEOUT,
+                    max_executions=settings.PYTHON_KERNEL_MAX_EXECUTIONS,
+                )
+                atexit.register(cls._instance.shutdown)
+            return cls._instance
+
+    def acquire(self, key: str) -> PythonKernel:
+        with self.lock:
+            self._evict_idle()
+            kernel = self.kernels.pop(key, None)
+            if kernel is not None and (not kernel.is_alive() or kernel.execution_count >= self.max_executions):
+                print("PythonKernelPool recycle kernel key=", key)
+                kernel.close()
+                kernel = None
+            if kernel is None:
+                self._evict_lru()
+                kernel = PythonKernel()
+            # 末尾が最近使われたもの
+            self.kernels[key] = kernel
+            # kernel.runがkernel.lockを取るまでの間に_evict_lruで閉じられないようにする
+            kernel.in_use += 1
+            return kernel
+
+    def run(self, key: str, code: str = "", path: str = "", timeout: Optional[float] = None) -> str:
+        if timeout is None:
+            timeout = settings.PYTHON_KERNEL_TIMEOUT
+        kernel = self.acquire(key)
+        try:
+            exitcode, stdout, stderr = kernel.run(code=code, path=path, timeout=timeout)
+        finally:
+            self.unlock(kernel)
+        return self.format_output(exitcode, stdout, stderr)
+
+    async def arun(self, key: str, code: str = "", path: str = "", timeout: Optional[float] = None) -> str:
+        if timeout is None:
+            timeout = settings.PYTHON_KERNEL_TIMEOUT
+        kernel = self.acquire(key)
+        try:
+            exitcode, stdout, stderr = await kernel.arun(code=code, path=path, timeout=timeout)
+        finally:
+            self.unlock(kernel)
+        return self.format_output(exitcode, stdout, stderr)
+
+    def unlock(self, kernel: PythonKernel) -> None:
+        with self.lock:
+            kernel.in_use -= 1
+
+    def release(self, key: str) -> None:
+        with self.lock:
+            kernel = self.kernels.pop(key, None)
+        if kernel is not None:
+            kernel.close()
+
+    def release_prefix(self, prefix: str) -> None:
+        with self.lock:
+            keys = [key for key in self.kernels if key.startswith(prefix)]
+            kernels = [self.kernels.pop(key) for key in keys]
+        for kernel in kernels:
+            kernel.close()
+
+    @staticmethod
+    def create_key(session_id: Optional[str] = None) -> str:
+        """
+        PythonToolsのインスタンス毎のkey。セッションが終わった時にrelease_sessionでまとめて解放できるようにsession_idを前に付ける
+        """
+        key = str(uuid4())
+        return f"{session_id}/{key}" if session_id else key
+
+    @classmethod
+    def release_session(cls, session_id: str) -> None:
+        # プールをまだ使っていなければ何もしない(ワーカーを起動しない)
+        if cls._instance is not None:
+            cls._instance.release_prefix(f"{session_id}/")
+
+    @classmethod
+    def release_key(cls, key: str) -> None:
+        if cls._instance is not None:
+            cls._instance.release(key)
+
+    def shutdown(self) -> None:
+        with self.lock:
+            kernels = list(self.kernels.values())
+            self.kernels.clear()
+        for kernel in kernels:
+            kernel.close()
+
+    def _evict_idle(self) -> None:
+        now = time.monotonic()
+        for key, kernel in list(self.kernels.items()):
+            if kernel.is_busy():
+                continue
+            if not kernel.is_alive() or now - kernel.last_used > self.idle_timeout:
+                print("PythonKernelPool evict idle kernel key=", key)
+                del self.kernels[key]
+                kernel.close()
+
+    def _evict_lru(self) -> None:
+        for key, kernel in list(self.kernels.items()):
+            if len(self.kernels) < self.max_size:
+                return
+            if kernel.is_busy():
+                continue
+            print("PythonKernelPool evict lru kernel key=", key)
+            del self.kernels[key]
+            kernel.close()
+
+    @staticmethod
+    def format_output(exitcode: int, stdout: str, stderr: str) -> str:
+        # invoke_tasks/python.pyのrun_code_fileと同じ形式
+        ret = ""
+        ret += f"Exit Code: {exitcode}\n"
+        ret += f"Output: \n{stdout}\n"
+        if stderr:
+            ret += f"Error: \n{stderr}\n"
+        return ret
+
+
+def test():
+    pool = PythonKernelPool(max_size=2, idle_timeout=60, max_executions=3)
+    result = pool.run("test", code="x = 40")
+    result = pool.run("test", code="print(x + 2)")
+    print("result=", result)
+    assert "42" in result
+    result = pool.run("test", code="import os\nos.system('echo from_subprocess')")
+    assert "from_subprocess" in result
+
+    async def cancel_test():
+        task = asyncio.ensure_future(pool.arun("test", code="import time\ntime.sleep(60)"))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert not pool.kernels["test"].is_alive()
+        # 次の実行では新しいkernelが使われる
+        return await pool.arun("test", code="print(1 + 1)")
+
+    result = asyncio.run(cancel_test())
+    assert "2" in result
+
+    # ユーザコードのinput()はリクエストを読まずにEOFErrorになる
+    result = pool.run("test", code="try:\n    input()\nexcept EOFError:\n    print('eof')")
+    assert "eof" in result
+    assert "4" in pool.run("test", code="print(2 + 2)")
+
+    async def cancel_waiting_test():
+        # lockを待っている間にキャンセルされても、後でlockを取ったスレッドの分を解放する
+        kernel = pool.acquire("test")
+        kernel.lock.acquire()
+        task = asyncio.ensure_future(kernel.arun(code="print(1)"))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.sleep(0.1)
+        kernel.lock.release()
+        await asyncio.sleep(0.2)
+        pool.unlock(kernel)
+        assert not kernel.lock.locked()
+
+    asyncio.run(cancel_waiting_test())
+
+    pool.run("session/a", code="x = 1")
+    pool.release_prefix("session/")
+    assert "session/a" not in pool.kernels
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    test()
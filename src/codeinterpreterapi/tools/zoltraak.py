@@ -71,13 +71,24 @@ class ZoltraakTools:
     async def arun_design(self, prompt: str, name: str) -> str:
         return self._common_run(prompt, name, ZoltraakCompilerEnum.DESIGN.value)
 
-    def run_prompt(self, prompt: str, name: str) -> str:
-        return self._common_run(prompt, name, ZoltraakCompilerEnum.PROMPT.value)
+    def run_prompt(self, prompt: str, name: str, raise_on_error: bool = False) -> str:
+        return self._common_run(prompt, name, ZoltraakCompilerEnum.PROMPT.value, raise_on_error)
 
     async def arun_prompt(self, prompt: str, name: str) -> str:
         return self._common_run(prompt, name, ZoltraakCompilerEnum.PROMPT.value)
 
-    def _common_run(self, prompt: str, name: str, compiler: str):
+    @staticmethod
+    def remove_md_files(name: str, compiler: str = ZoltraakCompilerEnum.PROMPT.value) -> None:
+        """
+        _common_runが作ったpromptと出力のmdファイルを削除する
+        """
+        input_md_filename = f"{name}_{compiler}.md"
+        for md_filename in (f"pre_{input_md_filename}", f"prompt_{input_md_filename}"):
+            md_path = os.path.abspath(md_filename)
+            if os.path.isfile(md_path):
+                os.remove(md_path)
+
+    def _common_run(self, prompt: str, name: str, compiler: str, raise_on_error: bool = False):
         # inputのmdファイル名と生成される場所
         input_md_filename = f"{name}_{compiler}.md"
         output_md_path = os.path.abspath(f"pre_{input_md_filename}")
@@ -129,6 +140,8 @@ class ZoltraakTools:
             error_message = f"An error occurred: {e}\nOutput: {e.output}"
             print(error_message)
             self.command_log.append((args, error_message))
+            if raise_on_error:
+                raise
             return error_message
 
 
@@ -0,0 +1,216 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import Runnable
+
+from codeinterpreterapi.config import settings
+
+SUMMARY_PROMPT = """以下はユーザーとAIの会話の古い部分です。
+以降の会話で必要になる事実、決定事項、ファイル名、未解決の課題を漏らさずに日本語で簡潔に要約してください。
+
+{previous_summary}
+{conversation}
+要約:"""
+
+SUMMARY_PREFIX = "これまでの会話の要約:\n"
+
+
+def get_num_tokens_function(llm: Optional[Runnable]) -> Optional[Callable[[str], int]]:
+    """
+    llm(switcherやbind_tools済みのRunnableも可)からget_num_tokensを探す
+    """
+    for _ in range(8):
+        if llm is None:
+            return None
+        if hasattr(llm, "get_num_tokens"):
+            return llm.get_num_tokens
+        # RunnableWithFallbacks.runnable, RunnableBinding.bound
+        llm = getattr(llm, "runnable", None) or getattr(llm, "bound", None)
+    return None
+
+
+class HistoryWindow:
+    """
+    履歴メッセージをトークン数の予算(max_tokens)内に収める
+
+    - 新しいメッセージから数えて予算に入るところまでを残す(ユーザー発言の位置で区切る)
+    - トークン数はllmのtokenizerで数えて、メッセージ(type, content)毎にキャッシュする
+    - summarize=Trueなら、はみ出した古いメッセージをllmで要約して先頭にSystemMessageとして付ける
+      要約は前回の要約に差分だけを足して作り直すので、毎ターン全体を要約し直すことはない
+    """
+
+    MAX_TOKEN_CACHE_SIZE = 10000
+    MAX_SUMMARY_CACHE_SIZE = 32
+
+    def __init__(
+        self,
+        llm: Optional[Runnable] = None,
+        max_tokens: Optional[int] = None,
+        summarize: Optional[bool] = None,
+    ):
+        self.llm = llm
+        self.max_tokens = settings.HISTORY_TOKEN_BUDGET if max_tokens is None else max_tokens
+        self.summarize = settings.HISTORY_SUMMARIZE if summarize is None else summarize
+        self.num_tokens_function = get_num_tokens_function(llm)
+        self.token_cache: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        # 要約済みのメッセージのキー列 => 要約
+        self.summary_cache: "OrderedDict[Tuple[Tuple[str, str], ...], str]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def count_tokens(self, message: BaseMessage) -> int:
+        key = self._get_key(message)
+        with self.lock:
+            num_tokens = self.token_cache.get(key)
+            if num_tokens is not None:
+                self.token_cache.move_to_end(key)
+                return num_tokens
+        num_tokens = self._count_text_tokens(key[1])
+        with self.lock:
+            self.token_cache[key] = num_tokens
+            while len(self.token_cache) > self.MAX_TOKEN_CACHE_SIZE:
+                self.token_cache.popitem(last=False)
+        return num_tokens
+
+    def split(self, messages: List[BaseMessage]) -> Tuple[List[BaseMessage], List[BaseMessage]]:
+        """
+        messagesを(はみ出した古いメッセージ, 予算内の新しいメッセージ)に分ける
+        """
+        if self.max_tokens <= 0:
+            return [], messages
+        total_tokens = 0
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            total_tokens += self.count_tokens(messages[i])
+            if total_tokens > self.max_tokens:
+                break
+            start = i
+        if start == 0:
+            return [], messages
+        # 会話のターンの途中から始まらないようにユーザー発言まで進める
+        turn_start = start
+        while turn_start < len(messages) and not isinstance(messages[turn_start], HumanMessage):
+            turn_start += 1
+        if turn_start < len(messages):
+            start = turn_start
+        return messages[:start], messages[start:]
+
+    def trim(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        old_messages, recent_messages = self.split(messages)
+        if not old_messages or not self.summarize or self.llm is None:
+            return recent_messages
+        previous_summary, prompt = self._prepare_summary(old_messages)
+        if prompt is None:
+            return self._add_summary(previous_summary, recent_messages)
+        try:
+            summary = self._to_text(self.llm.invoke(prompt))
+        except Exception as e:
+            # 要約に失敗しても古い文脈を黙って捨てないように、前回までの要約があればそれを使う
+            print("HistoryWindow summarize error=", e)
+            return self._add_summary(previous_summary, recent_messages)
+        self._put_summary(old_messages, summary)
+        return self._add_summary(summary, recent_messages)
+
+    async def atrim(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        old_messages, recent_messages = self.split(messages)
+        if not old_messages or not self.summarize or self.llm is None:
+            return recent_messages
+        previous_summary, prompt = self._prepare_summary(old_messages)
+        if prompt is None:
+            return self._add_summary(previous_summary, recent_messages)
+        try:
+            summary = self._to_text(await self.llm.ainvoke(prompt))
+        except Exception as e:
+            # 要約に失敗しても古い文脈を黙って捨てないように、前回までの要約があればそれを使う
+            print("HistoryWindow summarize error=", e)
+            return self._add_summary(previous_summary, recent_messages)
+        self._put_summary(old_messages, summary)
+        return self._add_summary(summary, recent_messages)
+
+    @staticmethod
+    def _add_summary(summary: str, recent_messages: List[BaseMessage]) -> List[BaseMessage]:
+        if not summary:
+            return recent_messages
+        return [SystemMessage(content=SUMMARY_PREFIX + summary)] + recent_messages
+
+    def _prepare_summary(self, old_messages: List[BaseMessage]) -> Tuple[str, Optional[str]]:
+        """
+        キャッシュ済みの要約のうち最も長く一致するものを探し、残りのメッセージを要約するpromptを作る
+        全て要約済みならpromptはNone
+        """
+        keys = tuple(self._get_key(message) for message in old_messages)
+        previous_summary = ""
+        summarized_count = 0
+        with self.lock:
+            for cached_keys, summary in self.summary_cache.items():
+                if len(cached_keys) > summarized_count and keys[: len(cached_keys)] == cached_keys:
+                    previous_summary = summary
+                    summarized_count = len(cached_keys)
+        if summarized_count == len(keys):
+            return previous_summary, None
+        conversation = "\n".join(f"{key[0]}: {key[1]}" for key in keys[summarized_count:])
+        prompt = SUMMARY_PROMPT.format(
+            previous_summary=f"これまでの要約:\n{previous_summary}\n" if previous_summary else "",
+            conversation=f"会話:\n{conversation}\n",
+        )
+        return previous_summary, prompt
+
+    def _put_summary(self, old_messages: List[BaseMessage], summary: str) -> None:
+        keys = tuple(self._get_key(message) for message in old_messages)
+        with self.lock:
+            self.summary_cache[keys] = summary
+            while len(self.summary_cache) > self.MAX_SUMMARY_CACHE_SIZE:
+                self.summary_cache.popitem(last=False)
+
+    def _count_text_tokens(self, text: str) -> int:
+        if self.num_tokens_function is not None:
+            try:
+                return self.num_tokens_function(text)
+            except Exception as e:
+                # tokenizerが使えないモデル(APIが必要など)は以降は概算にする
+                print("HistoryWindow get_num_tokens error=", e)
+                self.num_tokens_function = None
+        # 概算: 1トークン≒4文字(日本語は1文字≒1トークンなので多めに見積もる)
+        ascii_count = sum(1 for c in text if ord(c) < 128)
+        return ascii_count // 4 + (len(text) - ascii_count) + 1
+
+    @staticmethod
+    def _get_key(message: BaseMessage) -> Tuple[str, str]:
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        return message.type, content
+
+    @staticmethod
+    def _to_text(output: Any) -> str:
+        return output.content if hasattr(output, "content") else str(output)
+
+
+def test():
+    from langchain_core.messages import AIMessage
+
+    messages = []
+    for i in range(10):
+        messages.append(HumanMessage(content=f"question {i} " + "x" * 40))
+        messages.append(AIMessage(content=f"answer {i} " + "y" * 40))
+    window = HistoryWindow(max_tokens=60, summarize=False)
+    trimmed = window.trim(messages)
+    print("trimmed=", [message.content[:10] for message in trimmed])
+    assert isinstance(trimmed[0], HumanMessage)
+    assert trimmed[-1] is messages[-1]
+    assert len(trimmed) < len(messages)
+    assert len(window.token_cache) == len(trimmed) + 1
+
+    # 要約に失敗したら前回の要約を使う
+    class FailingLlm:
+        def invoke(self, prompt: str) -> str:
+            raise RuntimeError("summarize failed")
+
+    window = HistoryWindow(llm=FailingLlm(), max_tokens=60, summarize=True)
+    old_messages, _ = window.split(messages)
+    window._put_summary(old_messages[:2], "previous summary")
+    trimmed = window.trim(messages)
+    assert trimmed[0].content == SUMMARY_PREFIX + "previous summary"
+
+
+if __name__ == "__main__":
+    test()
@@ -1,5 +1,8 @@
+import ast
+import json
+import re
 from dataclasses import fields, is_dataclass
-from typing import Any, Dict, List, Protocol, Union
+from typing import Any, Dict, List, Protocol, Tuple, Union
 
 from crewai.crews.crew_output import CrewOutput, TaskOutput
 from langchain_core.messages import AIMessageChunk
@@ -13,6 +16,32 @@ class DataclassProtocol(Protocol):
     __dataclass_fields__: dict
 
 
+# ```python\n...\n``` 形式のコードブロック
+CODE_BLOCK_PATTERN = re.compile(r"```[ \t]*([\w+#.-]*)[ \t]*\n(.*?)```", re.DOTALL)
+# PythonTools/BashToolsなどの実行結果
+LOG_PATTERN = re.compile(r"(Exit Code: *-?\d+.*)", re.DOTALL)
+LOG_LANGUAGES = {"log", "text", "txt", "output", "console", "stdout", "stderr"}
+LANGUAGE_ALIASES = {"py": "python", "python3": "python", "sh": "bash", "shell": "bash", "js": "javascript"}
+LANGUAGE_HINTS = [
+    ("python", re.compile(r"^\s*(def |import |from \S+ import |class \w+.*:|print\()", re.MULTILINE)),
+    ("bash", re.compile(r"^\s*(#!/bin/(ba)?sh|pip install |apt(-get)? |cd |ls |echo )", re.MULTILINE)),
+    ("javascript", re.compile(r"^\s*(const |let |function |console\.log\()", re.MULTILINE)),
+    ("java", re.compile(r"^\s*(public (static )?class |System\.out\.println\()", re.MULTILINE)),
+]
+# dictのキー => CodeInterpreterIntermediateResultのメンバ名
+FIELD_ALIASES = {
+    "output": "context",
+    "content": "context",
+    "answer": "context",
+    "result": "context",
+    "thought": "thoughts",
+    "source_code": "code",
+    "tool_input": "code",
+    "stdout": "log",
+    "lang": "language",
+}
+
+
 class MultiConverter:
     @staticmethod
     def to_str(input_obj: Any) -> str:
@@ -120,3 +149,149 @@ class MultiConverter:
             # default
             attributes = ["content", "thought", "code", "agent_name"]
         return attributes
+
+    @staticmethod
+    def to_CodeInterpreterIntermediateResult_with_confidence(
+        input_obj: Any,
+    ) -> Tuple[CodeInterpreterIntermediateResult, float]:
+        """
+        LLMを使わずにCodeInterpreterIntermediateResultへ変換する
+
+        Returns:
+            (output, confidence) confidenceは変換の確からしさ[0.0～1.0]
+            低い場合は呼び出し側でLLMによる変換にフォールバックする
+        """
+        if isinstance(input_obj, CodeInterpreterIntermediateResult):
+            return input_obj, 1.0
+
+        input_dict = MultiConverter._to_dict(input_obj)
+        if input_dict is not None:
+            output, confidence = MultiConverter._map_dict(input_dict)
+        else:
+            text = MultiConverter.to_str(input_obj)
+            output = CodeInterpreterIntermediateResult(context=text)
+            confidence = 0.8 if text.strip() else 0.0
+
+        if output.context and not output.code:
+            MultiConverter._extract_code_and_log(output)
+        if output.code and not output.language:
+            output.language = MultiConverter.guess_language(output.code)
+        return output, confidence
+
+    @staticmethod
+    def _to_dict(input_obj: Any) -> Union[Dict, None]:
+        if isinstance(input_obj, Dict):
+            return input_obj
+        if isinstance(input_obj, CrewOutput):
+            last_task_output: TaskOutput = input_obj.tasks_output[-1] if input_obj.tasks_output else None
+            if last_task_output and last_task_output.json_dict:
+                return last_task_output.json_dict
+            if last_task_output and isinstance(last_task_output.pydantic, BaseModel):
+                return last_task_output.pydantic.model_dump()
+            thoughts = [f"{task_output.agent}: {task_output.summary}" for task_output in input_obj.tasks_output]
+            return {"context": input_obj.raw, "thoughts": thoughts}
+        if isinstance(input_obj, str):
+            # dictやjsonのstrが渡されるケース
+            text = input_obj.strip()
+            if text.startswith("{") and text.endswith("}"):
+                for loads in (json.loads, ast.literal_eval):
+                    try:
+                        value = loads(text)
+                    except (ValueError, SyntaxError):
+                        continue
+                    if isinstance(value, Dict):
+                        return value
+        return None
+
+    @staticmethod
+    def _map_dict(input_dict: Dict) -> Tuple[CodeInterpreterIntermediateResult, float]:
+        output = CodeInterpreterIntermediateResult(context="")
+        field_names = CodeInterpreterIntermediateResult.model_fields.keys()
+        mapped = 0
+        aliased = 0
+        for key, value in input_dict.items():
+            if key in field_names:
+                field_name = key
+                mapped += 1
+            elif key in FIELD_ALIASES and FIELD_ALIASES[key] not in input_dict:
+                field_name = FIELD_ALIASES[key]
+                aliased += 1
+            else:
+                continue
+            if value is None:
+                continue
+            if field_name == "thoughts":
+                value = value if isinstance(value, (str, list)) else str(value)
+            elif field_name in ("confidence", "target_confidence"):
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+            elif field_name in ("iteration_count", "max_iterations"):
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    continue
+            elif not isinstance(value, str):
+                value = MultiConverter.to_str(value)
+            setattr(output, field_name, value)
+
+        if mapped == 0 and aliased == 0:
+            # 既知のキーが無い場合はstrとして扱う(情報が落ちている可能性があるので低めにする)
+            output.context = MultiConverter.to_str(input_dict)
+            return output, 0.3
+        if not (output.context or output.code or output.log):
+            return output, 0.2
+        return output, 1.0 if mapped > 0 else 0.9
+
+    @staticmethod
+    def _extract_code_and_log(output: CodeInterpreterIntermediateResult) -> None:
+        codes = []
+        logs = []
+        for language, body in CODE_BLOCK_PATTERN.findall(output.context):
+            language = language.lower()
+            if language in LOG_LANGUAGES:
+                logs.append(body.strip())
+                continue
+            codes.append(body.strip())
+            if language and not output.language:
+                output.language = LANGUAGE_ALIASES.get(language, language)
+        if codes:
+            output.code = codes[-1]
+        if not output.log:
+            if logs:
+                output.log = "\n".join(logs)
+            else:
+                match = LOG_PATTERN.search(output.context)
+                if match:
+                    output.log = match.group(1).strip()
+
+    @staticmethod
+    def guess_language(code: str) -> str:
+        for language, pattern in LANGUAGE_HINTS:
+            if pattern.search(code):
+                return language
+        return ""
+
+
+def test():
+    result, confidence = MultiConverter.to_CodeInterpreterIntermediateResult_with_confidence(
+        {"input": "print 42", "output": "done\n```python\nprint(42)\n```\n```output\n42\n```"}
+    )
+    print("result=", result, "confidence=", confidence)
+    assert confidence >= 0.9
+    assert result.code == "print(42)"
+    assert result.language == "python"
+    assert result.log == "42"
+
+    result, confidence = MultiConverter.to_CodeInterpreterIntermediateResult_with_confidence(
+        "Exit Code: 0\nOutput: \nok"
+    )
+    assert result.log.startswith("Exit Code: 0")
+
+    _, confidence = MultiConverter.to_CodeInterpreterIntermediateResult_with_confidence({"unknown": 1})
+    assert confidence < 0.5
+
+
+if __name__ == "__main__":
+    test()
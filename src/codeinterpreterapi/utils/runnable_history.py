@@ -1,6 +1,9 @@
 import re
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Callable, List, Union, Dict, Any
+from typing import Callable, List, Optional, Union, Dict, Any
 
 from langchain_community.chat_message_histories import FileChatMessageHistory
 from langchain_core.chat_history import BaseChatMessageHistory
@@ -9,35 +12,155 @@ from pydantic import BaseModel, Field
 from langchain_core.runnables import Runnable, RunnableConfig
 from langchain_core.runnables.history import RunnableWithMessageHistory
 
-store = {}
+from codeinterpreterapi.config import settings
+from codeinterpreterapi.utils.history_window import HistoryWindow
 
 
 class InMemoryHistory(BaseChatMessageHistory, BaseModel):
-    """In memory implementation of chat message history."""
+    """In memory implementation of chat message history.
+
+    max_messages: 0より大きければ古いメッセージから捨ててこの件数に抑える
+    """
 
     messages: List[BaseMessage] = Field(default_factory=list)
+    max_messages: int = 0
 
     def add_messages(self, messages: List[BaseMessage]) -> None:
         """Add a list of messages to the store"""
         self.messages.extend(messages)
+        if self.max_messages > 0 and len(self.messages) > self.max_messages:
+            del self.messages[: len(self.messages) - self.max_messages]
 
     def clear(self) -> None:
         self.messages = []
 
 
-def assign_runnable_history(runnable: Runnable, runnable_config: RunnableConfig) -> RunnableWithMessageHistory:
-    runnable = get_runnable_history(runnable)
+class SessionHistoryStore:
+    """
+    session_idごとのInMemoryHistoryを保持するストア
+
+    - max_sessionsを超えたら最も使われていないセッションから追い出す(LRU)
+    - ttl秒アクセスのないセッションは追い出す
+    - spill_dirを指定すると、追い出したセッションをcreate_session_factory()のファイルに退避して、
+      次にアクセスされた時に読み戻す
+    """
+
+    SPILL_USER_ID = "spill"
+
+    def __init__(
+        self,
+        max_sessions: int = 1000,
+        ttl: Optional[float] = None,
+        max_messages: int = 0,
+        spill_dir: Optional[Union[str, Path]] = None,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.spill_factory = create_session_factory(spill_dir) if spill_dir else None
+        # session_id => (最終アクセス時刻, history)
+        self.sessions: "OrderedDict[str, tuple[float, InMemoryHistory]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.restored = 0
+
+    def get(self, session_id: str) -> InMemoryHistory:
+        with self.lock:
+            now = time.time()
+            item = self.sessions.get(session_id)
+            if item is not None:
+                self.hits += 1
+                history = item[1]
+            else:
+                self.misses += 1
+                history = InMemoryHistory(max_messages=self.max_messages)
+                restored_messages = self._restore(session_id)
+                if restored_messages:
+                    history.add_messages(restored_messages)
+                    self.restored += 1
+            self.sessions[session_id] = (now, history)
+            self.sessions.move_to_end(session_id)
+            self._evict(now)
+            return history
+
+    def clear(self) -> None:
+        with self.lock:
+            self.sessions.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self.lock:
+            histories = [history for _, history in self.sessions.values()]
+        messages = sum(len(history.messages) for history in histories)
+        content_chars = sum(len(str(message.content)) for history in histories for message in history.messages)
+        return {
+            "sessions": len(histories),
+            "messages": messages,
+            "content_chars": content_chars,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "restored": self.restored,
+        }
+
+    def _evict(self, now: float) -> None:
+        while self.sessions:
+            session_id, (accessed_at, history) = next(iter(self.sessions.items()))
+            expired = self.ttl is not None and now - accessed_at > self.ttl
+            if not expired and len(self.sessions) <= self.max_sessions:
+                break
+            del self.sessions[session_id]
+            self.evictions += 1
+            self._spill(session_id, history)
+
+    def _spill(self, session_id: str, history: InMemoryHistory) -> None:
+        if self.spill_factory is None or not history.messages or not _is_valid_identifier(session_id):
+            return
+        try:
+            file_history = self.spill_factory(self.SPILL_USER_ID, session_id)
+            file_history.clear()
+            file_history.add_messages(history.messages)
+        except OSError as e:
+            print("SessionHistoryStore spill error=", e)
+
+    def _restore(self, session_id: str) -> List[BaseMessage]:
+        if self.spill_factory is None or not _is_valid_identifier(session_id):
+            return []
+        try:
+            file_history = self.spill_factory(self.SPILL_USER_ID, session_id)
+            messages = file_history.messages
+            if messages:
+                file_history.clear()
+            return messages
+        except (OSError, ValueError) as e:
+            print("SessionHistoryStore restore error=", e)
+            return []
+
+
+def assign_runnable_history(
+    runnable: Runnable, runnable_config: RunnableConfig, llm: Optional[Runnable] = None
+) -> RunnableWithMessageHistory:
+    runnable = get_runnable_history(runnable, llm)
     runnable = runnable.with_config(runnable_config)
     return runnable
 
 
-def get_runnable_history(runnable: Runnable) -> RunnableWithMessageHistory:
+def get_runnable_history(runnable: Runnable, llm: Optional[Runnable] = None) -> RunnableWithMessageHistory:
     """
     メッセージ履歴を管理するRunnableを生成する。
     異なる入力形式に対応できるよう拡張している。
+    promptに入れる履歴はHistoryWindowでトークン数の予算内に収める(llmはtokenizerと要約に使う)。
     """
+    history_window = HistoryWindow(llm)
 
     class AdaptiveMessageHistory(RunnableWithMessageHistory):
+        def _enter_history(self, input: Any, config: RunnableConfig) -> List[BaseMessage]:
+            return history_window.trim(super()._enter_history(input, config))
+
+        async def _aenter_history(self, input: Dict[str, Any], config: RunnableConfig) -> List[BaseMessage]:
+            return await history_window.atrim(await super()._aenter_history(input, config))
+
         def _get_input_messages(self, input_val: Dict[str, Any]) -> str:
             """
             異なる入力形式に対応した入力メッセージの取得。
@@ -99,12 +222,9 @@ def get_runnable_history(runnable: Runnable) -> RunnableWithMessageHistory:
 
 
 def get_by_session_id(session_id: str) -> BaseChatMessageHistory:
-    if session_id not in store:
-        store[session_id] = InMemoryHistory()
-    return store[session_id]
+    return store.get(session_id)
 
 
-# TODO: replace get_by_session_id
 def create_session_factory(
     base_dir: Union[str, Path],
 ) -> Callable[[str], BaseChatMessageHistory]:
@@ -154,3 +274,27 @@ def _is_valid_identifier(value: str) -> bool:
     # Use a regular expression to match the allowed characters
     valid_characters = re.compile(r"^[a-zA-Z0-9-_]+$")
     return bool(valid_characters.match(value))
+
+
+store = SessionHistoryStore(
+    max_sessions=settings.HISTORY_STORE_MAX_SESSIONS,
+    ttl=settings.HISTORY_STORE_TTL,
+    max_messages=settings.HISTORY_STORE_MAX_MESSAGES,
+    spill_dir=settings.HISTORY_STORE_SPILL_DIR,
+)
+
+
+def test():
+    from langchain_core.messages import HumanMessage
+
+    history_store = SessionHistoryStore(max_sessions=2, max_messages=3)
+    history_store.get("a").add_messages([HumanMessage(content=str(i)) for i in range(5)])
+    assert [message.content for message in history_store.get("a").messages] == ["2", "3", "4"]
+    history_store.get("b")
+    history_store.get("c")
+    assert "a" not in history_store.sessions
+    print("metrics=", history_store.metrics())
+
+
+if __name__ == "__main__":
+    test()
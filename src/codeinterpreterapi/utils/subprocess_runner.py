@@ -0,0 +1,81 @@
+import asyncio
+import codecs
+from typing import Callable, List, Optional, Tuple
+
+OutputCallback = Callable[[str], None]
+
+
+async def _read_stream(stream: asyncio.StreamReader, chunks: List[str], on_output: Optional[OutputCallback]) -> None:
+    # 改行のない巨大な出力でも詰まらないように行単位ではなく固定サイズで読む
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = await stream.read(4096)
+        text = decoder.decode(data, final=not data)
+        if text:
+            chunks.append(text)
+            if on_output:
+                on_output(text)
+        if not data:
+            return
+
+
+async def _terminate(proc: asyncio.subprocess.Process) -> None:
+    if proc.returncode is None:
+        proc.kill()
+        await proc.wait()
+
+
+async def arun_subprocess(
+    args: List[str],
+    cwd: Optional[str] = None,
+    timeout: Optional[float] = None,
+    merge_stderr: bool = False,
+    on_stdout: Optional[OutputCallback] = None,
+    on_stderr: Optional[OutputCallback] = None,
+) -> Tuple[int, str, str]:
+    """
+    asyncio.create_subprocess_execでコマンドを実行し、出力をストリームしながら収集する
+
+    Args:
+        args: 実行するコマンド(シェルは経由しない)
+        cwd: 作業ディレクトリ
+        timeout: タイムアウト秒数。超えた場合はプロセスをkillしてasyncio.TimeoutErrorを送出する
+        merge_stderr: Trueならstderrをstdoutに合流させる(stderrの戻り値は常に空)
+        on_stdout: stdoutを受け取るたびに呼ばれるコールバック
+        on_stderr: stderrを受け取るたびに呼ばれるコールバック
+
+    Returns:
+        (exitcode, stdout, stderr)
+
+    キャンセルされた場合もプロセスをkillしてからCancelledErrorを再送出する。
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT if merge_stderr else asyncio.subprocess.PIPE,
+        cwd=cwd,
+    )
+    stdout_chunks: List[str] = []
+    stderr_chunks: List[str] = []
+    readers = [_read_stream(proc.stdout, stdout_chunks, on_stdout)]
+    if not merge_stderr:
+        readers.append(_read_stream(proc.stderr, stderr_chunks, on_stderr))
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*readers, proc.wait()), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        await _terminate(proc)
+        raise
+
+    return proc.returncode, "".join(stdout_chunks), "".join(stderr_chunks)
+
+
+def test():
+    exitcode, stdout, stderr = asyncio.run(arun_subprocess(["echo", "test output"], on_stdout=print))
+    print("result=", exitcode, stdout, stderr)
+    assert exitcode == 0
+    assert "test output" in stdout
+
+
+if __name__ == "__main__":
+    test()